@@ -0,0 +1,134 @@
+import functools
+import hashlib
+import json
+import os
+
+from lazy_import import lazy_import
+
+np = lazy_import('numpy')
+
+# --- سجل تخطيطات ورقة الإجابة (Bubble Layout Registry) ---
+# تخطيط الفقاعات لا يعتمد على الطالب بل على عدد الأسئلة وثوابت التخطيط فقط،
+# لذلك يُحفظ مرة واحدة لكل "توقيع تخطيط" كملف NumPy مضغوط الحجم ويُشار إليه بمعرف ثابت (layout_id)
+# يُكتب داخل رمز QR، بدلاً من ملف BubbleData JSON لكل طالب.
+
+LAYOUT_DIR = 'bubble_layouts'
+LAYOUT_FORMAT_VERSION = 1
+LAYOUT_CACHE_SIZE = 32
+
+# حروف الخيارات بالترتيب (نفس ترتيب الأعمدة في ورقة الإجابة)
+OPTION_LETTERS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
+
+# أبعاد الصفحة الافتراضية (A4 عند 150 DPI) للتخطيطات القديمة التي لا تحفظ أبعادها
+DEFAULT_PAGE_SIZE = (1240, 1754)
+
+# علامات التسجيل (Fiducials): مربعات سوداء مصمتة في زوايا الصفحة الأربع داخل الهامش
+FIDUCIAL_SIZE = 30
+FIDUCIAL_OFFSET = 30
+
+
+def fiducial_boxes(width, height, size=FIDUCIAL_SIZE, offset=FIDUCIAL_OFFSET):
+    """مربعات علامات التسجيل (x_min, y_min, x_max, y_max) بالترتيب: أعلى يسار، أعلى يمين، أسفل يمين، أسفل يسار."""
+    return [
+        (offset, offset, offset + size, offset + size),
+        (width - offset - size, offset, width - offset, offset + size),
+        (width - offset - size, height - offset - size, width - offset, height - offset),
+        (offset, height - offset - size, offset + size, height - offset),
+    ]
+
+
+def fiducial_centers(width, height, size=FIDUCIAL_SIZE, offset=FIDUCIAL_OFFSET):
+    """مراكز علامات التسجيل كمصفوفة (4, 2) بنفس ترتيب fiducial_boxes."""
+    return np.array([((x0 + x1) / 2.0, (y0 + y1) / 2.0)
+                     for x0, y0, x1, y1 in fiducial_boxes(width, height, size, offset)], dtype=np.float32)
+
+
+def layout_id_for(num_questions, layout_config, first_question=1):
+    """
+    معرف ثابت وقصير للتخطيط مشتق من (عدد الأسئلة، ثوابت التخطيط). صفحات الإجابة التالية لورقة متعددة الصفحات
+    تبدأ بسؤال آخر (first_question)، وللصفحة الأولى نفس معرف ورقة الصفحة الواحدة.
+    """
+    signature = {
+        'version': LAYOUT_FORMAT_VERSION,
+        'num_questions': num_questions,
+        'config': list(layout_config),
+    }
+    if first_question != 1:
+        signature['first_question'] = first_question
+    signature = json.dumps(signature, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()[:12]
+
+
+def layout_path(layout_id, layout_dir=LAYOUT_DIR):
+    return os.path.join(layout_dir, f"{layout_id}.npz")
+
+
+def bubble_list_to_arrays(bubble_data_list, num_options):
+    """تحويل قائمة الفقاعات (كما في BubbleData JSON) إلى (question_nums (Q,), bboxes (Q, O, 4))."""
+    by_question = {}
+    for bubble in bubble_data_list:
+        by_question.setdefault(bubble['question_num'], []).append(bubble)
+
+    question_nums = sorted(by_question)
+    bboxes = np.zeros((len(question_nums), num_options, 4), dtype=np.int16)
+    for row, q_num in enumerate(question_nums):
+        for bubble in by_question[q_num]:
+            bboxes[row, OPTION_LETTERS.index(bubble['option_letter'])] = bubble['bbox']
+    return np.array(question_nums, dtype=np.int16), bboxes
+
+
+def save_layout(layout_id, question_nums, bboxes, layout_dir=LAYOUT_DIR,
+                page_size=DEFAULT_PAGE_SIZE, fiducials=None):
+    """
+    حفظ التخطيط مرة واحدة (إن لم يكن موجوداً). الكتابة ذرية (ملف مؤقت ثم os.replace)
+    لأن عدة عمليات توليد قد تحاول حفظ نفس التخطيط في الوقت نفسه.
+    """
+    path = layout_path(layout_id, layout_dir)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(layout_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, question_nums=np.asarray(question_nums, dtype=np.int16),
+                 bboxes=np.asarray(bboxes, dtype=np.int16),
+                 page_size=np.asarray(page_size, dtype=np.int16),
+                 fiducials=np.asarray(fiducials if fiducials is not None else fiducial_centers(*page_size),
+                                      dtype=np.float32))
+    os.replace(tmp_path, path)
+    return path
+
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def load_layout(layout_id, layout_dir=LAYOUT_DIR):
+    """
+    تحميل التخطيط مرة واحدة لكل عملية وإرجاعه بنفس صيغة مصفوفات الماسح الضوئي:
+    question_nums (Q,) ، bboxes (Q, O, 4) ، bubble_ids و option_letters (قوائم Q × O)،
+    إضافة إلى page_size (العرض، الارتفاع) ومراكز علامات التسجيل fiducials (4, 2).
+    يرفع FileNotFoundError إذا لم يكن التخطيط مسجلاً.
+    """
+    with np.load(layout_path(layout_id, layout_dir)) as data:
+        question_nums = data['question_nums']
+        bboxes = data['bboxes']
+        page_size = tuple(data['page_size'].tolist()) if 'page_size' in data else DEFAULT_PAGE_SIZE
+        fiducials = data['fiducials'] if 'fiducials' in data else None
+        return build_layout(layout_id, question_nums, bboxes, page_size, fiducials)
+
+
+def build_layout(layout_id, question_nums, bboxes, page_size=DEFAULT_PAGE_SIZE, fiducials=None):
+    """
+    قاموس التخطيط بصيغة الماسح الضوئي من مصفوفاته مباشرة، دون المرور بملف في السجل
+    (مثلاً تخطيط ورقة مرسومة في الذاكرة يُمرر إلى الماسح في نفس العملية).
+    """
+    question_nums = np.asarray(question_nums, dtype=np.int32)
+    bboxes = np.asarray(bboxes, dtype=np.int32)
+    letters = OPTION_LETTERS[:bboxes.shape[1]]
+    return {
+        'layout_id': layout_id,
+        'question_nums': question_nums,
+        'bboxes': bboxes,
+        'bubble_ids': [[f"Q{q}-{letter}" for letter in letters] for q in question_nums.tolist()],
+        'option_letters': [list(letters) for _ in range(len(question_nums))],
+        'page_size': tuple(page_size),
+        'fiducials': np.asarray(fiducials if fiducials is not None else fiducial_centers(*page_size), dtype=np.float32),
+    }
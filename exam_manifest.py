@@ -0,0 +1,115 @@
+import functools
+import hashlib
+import json
+import os
+
+# --- سجل التوليد (Generation Manifest) ---
+# يُحفظ في مجلد الإخراج ملف JSONL يسجل لكل طالب بصمة (hash) لمدخلاته (بيانات الطالب، الأسئلة، ثوابت التخطيط، الخط)
+# وقائمة الملفات التي أُنتجت له. عند إعادة التشغيل يُتخطى الطالب الذي لم تتغير بصمته وما زالت ملفاته موجودة،
+# ويُعاد توليد من تغيّر فقط. كل طالب يُضاف كسطر فور انتهائه، لذلك يُستأنف التشغيل المتوقف من حيث توقف.
+
+MANIFEST_FILE = 'generation_manifest.jsonl'
+MANIFEST_VERSION = 1
+FILE_DIGEST_CACHE_SIZE = 32
+
+
+def content_hash(*parts):
+    """بصمة SHA-256 لأي بيانات قابلة للتسلسل كـ JSON (ترتيب المفاتيح لا يؤثر)."""
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=FILE_DIGEST_CACHE_SIZE)
+def _file_digest(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """بصمة محتوى ملف (مثل الخط)، تُحسب مرة واحدة ما دام الملف لم يتغير. تُرجع None إذا لم يوجد."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return _file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class GenerationManifest:
+    """
+    سجل مخرجات التوليد لكل طالب داخل مجلد الإخراج.
+    entries: {مفتاح الطالب: {"hash", "outputs", "requires"}} حيث outputs ملفات الطالب نفسه
+    و requires ملفات مشتركة (مثل تخطيط الفقاعات) يجب أن تبقى موجودة لكن لا تُحذف معه.
+    """
+
+    def __init__(self, output_dir, file_name=MANIFEST_FILE):
+        self.path = os.path.join(output_dir, file_name)
+        self.entries = {}
+        self._journal = None
+        self._load()
+
+    def _load(self):
+        try:
+            f = open(self.path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # سطر مبتور من تشغيل توقف أثناء الكتابة
+                    continue
+                if entry.get('version') == MANIFEST_VERSION and 'key' in entry:
+                    self.entries[entry['key']] = entry
+
+    def is_up_to_date(self, key, digest):
+        """هل ملفات الطالب موجودة ومولدة من نفس المدخلات تماماً؟"""
+        entry = self.entries.get(key)
+        if entry is None or entry.get('hash') != digest:
+            return False
+        return all(os.path.exists(path) for path in entry.get('outputs', []) + entry.get('requires', []))
+
+    def record(self, key, digest, outputs, requires=()):
+        """تسجيل نجاح توليد طالب، وحذف ملفاته القديمة التي لم تعد ضمن المخرجات (مثل صفحة زائدة أو اسم تغيّر)."""
+        previous = self.entries.get(key)
+        if previous:
+            for stale_path in set(previous.get('outputs', [])) - set(outputs):
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+
+        entry = {'version': MANIFEST_VERSION, 'key': key, 'hash': digest,
+                 'outputs': list(outputs), 'requires': list(requires)}
+        self.entries[key] = entry
+
+        if self._journal is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._journal = open(self.path, 'a', encoding='utf-8')
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._journal.flush()
+
+    def compact(self):
+        """إعادة كتابة السجل بآخر إدخال لكل طالب فقط (كتابة ذرية عبر ملف مؤقت)."""
+        self.close()
+        if not self.entries:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,295 @@
+import json
+import os
+import tempfile
+
+# --- قراءة تدريجية (Streaming) لملف jsonQ.json ---
+# الملف الأصلي يكرر نص الأسئلة والخيارات داخل قائمة exam لكل طالب، لذلك لا نحمّله كاملاً في الذاكرة:
+# تُقرأ بيانات الامتحان العامة أولاً، ثم يُعاد الطلاب واحداً تلو الآخر من data.users.
+#
+# الصيغة المختصرة (Normalized) تخزن الأسئلة مرة واحدة لكل نموذج في data.models،
+# ويكتفي كل طالب بالإشارة إليها عبر الحقل exam_ref (أو model_type):
+#   {"data": {"stage": ..., "models": {"Group A": [ ...أسئلة... ]},
+#             "users": [{"id": 1, "name": "...", "model_type": "Group A", "exam_ref": "Group A"}]}}
+
+STREAM_CHUNK_SIZE = 1 << 16
+
+# بيانات الامتحان العامة التي يجب معرفتها قبل البدء بالطلاب
+REQUIRED_META_KEYS = ('stage', 'subject_name', 'subject_id', 'model_type')
+
+
+class _JsonTokenReader:
+    """قارئ JSON تدريجي فوق ملف نصي، يفك قيمة واحدة في كل مرة باستخدام raw_decode."""
+
+    def __init__(self, f, chunk_size=STREAM_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, min_size=0):
+        """قراءة جزء جديد من الملف مع التخلص من الجزء الذي تمت معالجته من المخزن."""
+        if self.eof:
+            return False
+        chunk = self.f.read(max(self.chunk_size, min_size))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """إرجاع أول حرف غير فارغ دون استهلاكه ('' عند نهاية الملف)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """استهلاك أحد الحروف المتوقعة وإرجاعه، أو رفع خطأ JSON."""
+        ch = self.peek()
+        if not ch or ch not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", self.buf, self.pos)
+        self.pos += 1
+        return ch
+
+    def read_value(self):
+        """فك قيمة JSON كاملة واحدة (كائن، قائمة، نص أو رقم) من الموضع الحالي."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # رقم ينتهي عند حافة المخزن قد يكون مقطوعاً؛ نقرأ المزيد للتأكد
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # مضاعفة حجم القراءة حتى يبقى إعادة الفك بتكلفة خطية
+            self._fill(min_size=len(self.buf) - self.pos)
+
+    def iter_object(self):
+        """المرور على مفاتيح كائن JSON؛ على المستدعي استهلاك قيمة كل مفتاح قبل المتابعة."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_object_tail(self):
+        """متابعة المرور على مفاتيح كائن تم فتحه مسبقاً (بعد قيمة استُهلكت للتو)."""
+        while self.expect(',}') == ',':
+            key = self.read_value()
+            self.expect(':')
+            yield key
+
+    def iter_array(self):
+        """إرجاع عناصر قائمة JSON واحداً تلو الآخر."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.expect(',]') == ']':
+                return
+
+    def iter_array_tail(self):
+        """متابعة المرور على عناصر قائمة تم فتحها مسبقاً (بعد عنصر استُهلك للتو)."""
+        while self.expect(',]') == ',':
+            yield self.read_value()
+
+
+def resolve_user_exam(user, models, meta):
+    """
+    قائمة أسئلة الطالب في أي من الصيغتين: مضمّنة فيه (الصيغة الأصلية)، أو مرجعاً exam_ref إلى نموذج في models
+    (الصيغة المختصرة). تعمل على بيانات في الذاكرة كما على الملف المقروء تدريجياً.
+    """
+    if user.get('exam'):
+        return user['exam']
+    ref = user.get('exam_ref', user.get('model_type', meta.get('model_type')))
+    return (models or {}).get(ref, [])
+
+
+class ExamStream:
+    """
+    قارئ تدريجي لملف بيانات الامتحان.
+    meta: بيانات الامتحان العامة (كل مفاتيح data ما عدا users و models).
+    models: أسئلة كل نموذج في الصيغة المختصرة (قاموس فارغ في الصيغة الأصلية).
+    المرور على الكائن (for user in stream) يعيد الطلاب واحداً تلو الآخر مع قائمة exam جاهزة.
+    """
+
+    def __init__(self, file_path, chunk_size=STREAM_CHUNK_SIZE):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.meta = {}
+        self.models = {}
+        self._seen = set()
+        self._handle = None
+        self._reader = None
+        self._open()
+
+    def _open(self):
+        """
+        قراءة البيانات العامة حتى بداية data.users؛ وإن لزم، مسح سريع للملف لجمع ما يأتي بعدها:
+        بيانات عامة ناقصة، أو models بعد users في الصيغة المختصرة (أول طالب بلا قائمة exam).
+        """
+        if not self._seek_users(store=True):
+            self.close()
+            return
+
+        if self._header_complete():
+            if 'models' in self._seen:
+                return
+            # لم تظهر models قبل الطلاب: أول طالب يحدد الصيغة (الأصلية تضمّن exam فيه)
+            first_user = next(self._reader.iter_array(), None)
+            if not isinstance(first_user, dict) or first_user.get('exam'):
+                self._reopen()
+                return
+            users = self._reader.iter_array_tail()
+        else:
+            users = self._reader.iter_array()
+
+        # بعض البيانات العامة تأتي بعد قائمة الطلاب: مسح الملف مرة أولى دون الاحتفاظ بالطلاب
+        for _ in users:
+            pass
+        for data_key in self._reader.iter_object_tail():
+            self._store(data_key, self._reader.read_value())
+        self._reopen()
+
+    def _seek_users(self, store=False):
+        """فتح الملف والتقدم حتى قيمة data.users (مع حفظ ما قبلها إذا store). تُرجع False إذا لم توجد."""
+        self._handle = open(self.file_path, 'r', encoding='utf-8')
+        self._reader = _JsonTokenReader(self._handle, self.chunk_size)
+        for key in self._reader.iter_object():
+            if key != 'data':
+                self._reader.read_value()
+                continue
+            for data_key in self._reader.iter_object():
+                if data_key == 'users':
+                    return True
+                value = self._reader.read_value()
+                if store:
+                    self._store(data_key, value)
+            return False
+        return False
+
+    def _reopen(self):
+        self.close()
+        self._seek_users()
+
+    def _store(self, key, value):
+        self._seen.add(key)
+        if key == 'models':
+            self.models = value or {}
+        else:
+            self.meta[key] = value
+
+    def _header_complete(self):
+        """
+        هل أصبحت البيانات العامة معروفة قبل الطلاب؟ (models يكفي أن يسبق users ليُقرأ الملف مرة واحدة،
+        وهو ما تضمنه normalize_exam_file؛ وإلا يُجمع بمسح أول كما في _open.)
+        """
+        return all(key in self.meta for key in REQUIRED_META_KEYS)
+
+    def resolve_exam(self, user):
+        """إرجاع قائمة أسئلة الطالب، سواء كانت مضمّنة فيه أو مرجعاً إلى نموذج في data.models."""
+        return resolve_user_exam(user, self.models, self.meta)
+
+    def __iter__(self):
+        if self._reader is None:
+            return
+        try:
+            for user in self._reader.iter_array():
+                if isinstance(user, dict) and not user.get('exam') and self.models:
+                    user['exam'] = self.resolve_exam(user)
+                yield user
+        finally:
+            self.close()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+        self._handle = None
+        self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def normalize_exam_file(src_path, dst_path):
+    """
+    تحويل ملف jsonQ.json الأصلي إلى الصيغة المختصرة: تُخزن قائمة الأسئلة مرة واحدة لكل نموذج،
+    ويحمل كل طالب مرجعاً (exam_ref) إليها. تتم القراءة والكتابة تدريجياً بذاكرة ثابتة تقريباً.
+    تُرجع (عدد الطلاب، عدد النماذج المميزة).
+    """
+    stream = ExamStream(src_path)
+    models = {}
+    # مفتاح كل نموذج هو نص أسئلته بعد التسلسل، لاكتشاف النماذج المتطابقة بين الطلاب
+    model_refs = {}
+    num_users = 0
+
+    dst_dir = os.path.dirname(os.path.abspath(dst_path))
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=dst_dir) as users_tmp:
+        for user in stream:
+            exam = user.pop('exam', None) or []
+            exam_key = json.dumps(exam, sort_keys=True, ensure_ascii=False)
+            ref = model_refs.get(exam_key)
+            if ref is None:
+                base_ref = str(user.get('model_type', stream.meta.get('model_type', 'N/A')))
+                ref = base_ref
+                suffix = 2
+                while ref in models:
+                    ref = f"{base_ref}#{suffix}"
+                    suffix += 1
+                model_refs[exam_key] = ref
+                models[ref] = exam
+            user['exam_ref'] = ref
+
+            if num_users:
+                users_tmp.write(',\n')
+            json.dump(user, users_tmp, ensure_ascii=False)
+            num_users += 1
+
+        users_tmp.seek(0)
+        with open(dst_path, 'w', encoding='utf-8') as out:
+            out.write('{"data": {')
+            for key, value in stream.meta.items():
+                out.write(f"{json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}, ")
+            out.write('"models": ')
+            json.dump(models, out, ensure_ascii=False)
+            out.write(', "users": [\n')
+            while True:
+                chunk = users_tmp.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+            out.write('\n]}}\n')
+
+    return num_users, len(models)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="تحويل ملف بيانات الامتحان إلى الصيغة المختصرة (أسئلة مرة واحدة لكل نموذج).")
+    parser.add_argument('src', help="ملف jsonQ.json الأصلي")
+    parser.add_argument('dst', help="مسار الملف المختصر الناتج")
+    args = parser.parse_args()
+
+    num_users, num_models = normalize_exam_file(args.src, args.dst)
+    print(f"✅ تم تحويل {num_users} طالب/طالبة إلى {num_models} نموذج في: {args.dst}")
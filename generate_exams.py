@@ -1,515 +1,1140 @@
-import json
-import os
-import sys
-import textwrap
-from PIL import Image, ImageDraw, ImageFont
-import qrcode 
-import arabic_reshaper
-from bidi.algorithm import get_display
-
-# --- الإعدادات الأساسية والثوابت ---
-JSON_FILE = 'jsonQ.json' 
-OUTPUT_DIR = 'exam_sheets_output_images'
-FONT_PATH = 'NotoKufiArabic-Regular.ttf' 
-
-# أبعاد ورقة A4 بالبيكسل (تقريباً عند 150 DPI)
-WIDTH, HEIGHT = 1240, 1754
-MARGIN = 70 
-
-# قائمة الحروف للخيار
-OPTION_LETTERS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
-
-# إنشاء مجلد الإخراج إذا لم يكن موجوداً
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
-
-# --- دوال المساعدة (نفسها) ---
-
-def load_exam_data(file_path):
-    """قراءة وتحليل بيانات الامتحان من ملف JSON."""
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            full_data = json.load(f)
-        return full_data.get('data', {})
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"❌ خطأ في قراءة ملف JSON: {e}")
-        return {}
-
-def generate_qrcode(data_to_encode, output_path):
-    """إنشاء وحفظ رمز الاستجابة السريعة (QR Code) كملف صورة PNG."""
-    try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_H,
-            box_size=6,
-            border=4,
-        )
-        qr.add_data(data_to_encode)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        img.save(output_path)
-        display_text = data_to_encode if len(data_to_encode) < 100 else f"{data_to_encode[:100]}..."
-        print(f"✅ تم إنشاء QR Code بنجاح. البيانات المشفرة: {display_text}")
-        return True
-    except Exception as e:
-        print(f"❌ خطأ في إنشاء QR Code: {e}")
-        return False
-
-def fix_arabic_text(text):
-    """
-    تقوم بتوصيل الأحرف العربية وعكس ترتيب النص ليناسب الطباعة من اليمين إلى اليسار.
-    """
-    if not text:
-        return ""
-    reshaped_text = arabic_reshaper.reshape(text)
-    bidi_text = get_display(reshaped_text)
-    return bidi_text
-
-def get_text_metrics(draw, text, font):
-    bbox = draw.textbbox((0, 0), text, font=font)
-    return bbox[2] - bbox[0], bbox[3] - bbox[1]
-
-def draw_header(img, draw, exam_info, user_data, qrcode_path, font_large, font_medium, cursor_y, is_first_page):
-    """رسم رأس الصفحة الذي يحتوي على العنوان وتفاصيل الطالب ورمز الاستجابة السريعة (QR Code)."""
-    
-    subject_name = exam_info.get('subject_name', 'امتحان غير محدد')
-    stage = exam_info.get('stage', 'N/A')
-    model_type = user_data.get('model_type', exam_info.get('model_type', 'N/A'))
-    
-    if is_first_page:
-        
-        # 1. العنوان الرئيسي
-        header_text = f"ورقة امتحان: {subject_name} - المرحلة: {stage}"
-        processed_header = fix_arabic_text(header_text)
-        
-        text_width, text_height = get_text_metrics(draw, processed_header, font_large)
-        draw.text(((WIDTH - text_width) / 2, cursor_y), processed_header, fill='black', font=font_large)
-        cursor_y += text_height + 20 
-        
-        # 2. تفاصيل الطالبة
-        student_name = user_data.get('name', 'غير متوفر')
-        student_id = user_data.get('id', 'غير متوفر')
-        
-        details_x_ref = WIDTH - MARGIN
-
-        details = [
-            f"اسم الطالب: {student_name}",
-            f"رقم الطالب: {student_id}",
-            f"نموذج الأسئلة: {model_type}"
-        ]
-        
-        for detail in details:
-            processed_detail = fix_arabic_text(detail)
-            
-            text_width, text_height = get_text_metrics(draw, processed_detail, font_medium)
-
-            draw.text((details_x_ref - text_width, cursor_y), processed_detail, fill='black', font=font_medium)
-            cursor_y += text_height + 8 
-
-        # 3. وضع رمز الاستجابة السريعة (QR Code)
-        if os.path.exists(qrcode_path):
-            try:
-                qrcode_img = Image.open(qrcode_path).convert("RGBA")
-                qrcode_size = 150 
-                qrcode_img = qrcode_img.resize((qrcode_size, qrcode_size))
-                
-                qrcode_x = MARGIN
-                qrcode_y = MARGIN + 10
-
-                img.paste(qrcode_img, (qrcode_x, qrcode_y), qrcode_img)
-                
-                qrcode_bottom_y = qrcode_y + qrcode_size
-                cursor_y = max(cursor_y, qrcode_bottom_y) + 20 
-                
-            except Exception as e:
-                print(f"❌ فشل في دمج صورة QR Code: {e}")
-        
-    else:
-        cursor_y = MARGIN + 30 
-        
-    cursor_y += 15 
-    return cursor_y
-
-def create_student_exam_image(exam_info, user_data, output_filename, qrcode_path):
-    """إنشاء ورقة امتحان كصورة PNG (صفحة الأسئلة)."""
-    
-    # 1. إعداد الخطوط
-    try:
-        font_large = ImageFont.truetype(FONT_PATH, 40)
-        font_medium = ImageFont.truetype(FONT_PATH, 30)
-        font_small = ImageFont.truetype(FONT_PATH, 24)
-    except IOError as e:
-        print(f"\n\n🛑 خطأ فادح: فشل في تحميل الخط العربي. تأكد من أن الملف '{FONT_PATH}' موجود في نفس المجلد.")
-        if not os.path.exists(FONT_PATH):
-            print(f"🛑 الملف '{FONT_PATH}' غير موجود. يرجى تحميله ووضعه في نفس مجلد السكربت.")
-        sys.exit(1)
-
-    questions = user_data.get('exam', [])
-    content_width = WIDTH - 2 * MARGIN
-    question_num = 1
-    page_num = 1
-    
-    img = Image.new('RGB', (WIDTH, HEIGHT), color='white')
-    draw = ImageDraw.Draw(img)
-    cursor_y = MARGIN
-    cursor_y = draw_header(img, draw, exam_info, user_data, qrcode_path, font_large, font_medium, cursor_y, is_first_page=True)
-    
-    images_to_save = []
-    
-    for q_item in questions:
-        
-        q_text = q_item.get('question_text', {}).get('text', 'نص السؤال غير متوفر')
-        q_type = q_item.get('question_type_translation', 'N/A')
-        
-        chars_per_line = int(content_width / font_small.size * 0.7) 
-        question_lines = textwrap.wrap(fix_arabic_text(f"{question_num}. ({q_type}) {q_text}"), width=chars_per_line)
-        question_height_est = len(question_lines) * 30 
-        
-        options_height_est = 0
-        options = q_item.get('options', [])
-        if options:
-            options_lines = (len(options) + 1) // 2 
-            options_height_est = options_lines * 35 
-            
-        estimated_total_height = question_height_est + options_height_est + 50 
-
-        if cursor_y + estimated_total_height > HEIGHT - MARGIN: 
-            images_to_save.append(img.copy())
-            
-            page_num += 1
-            img = Image.new('RGB', (WIDTH, HEIGHT), color='white')
-            draw = ImageDraw.Draw(img)
-            cursor_y = MARGIN
-            
-            cursor_y = draw_header(img, draw, exam_info, user_data, qrcode_path, font_large, font_medium, cursor_y, is_first_page=False)
-
-        # 1. طباعة نص السؤال
-        question_line = f"{question_num}. ({q_type}) {q_text}"
-        processed_question = fix_arabic_text(question_line)
-        
-        wrapped_text = textwrap.wrap(processed_question, width=chars_per_line)
-        
-        for line in wrapped_text:
-            text_width, text_height = get_text_metrics(draw, line, font_small)
-            draw.text((WIDTH - MARGIN - text_width, cursor_y), line, fill='black', font=font_small)
-            cursor_y += text_height + 3 
-
-        # 2. طباعة الخيارات
-        if options:
-            col_width = content_width / 2 
-            _, option_height = get_text_metrics(draw, fix_arabic_text("مثال"), font_small)
-            
-            cursor_y += 5 
-            
-            for j, opt in enumerate(options):
-                option_text = opt.get('text', 'خيار غير متوفر')
-                
-                if j < len(OPTION_LETTERS):
-                    option_letter = OPTION_LETTERS[j]
-                else:
-                    option_letter = chr(65 + j)
-                
-                prefix = f"({option_letter}) "
-                
-                processed_option_text = fix_arabic_text(prefix + option_text)
-                text_width, _ = get_text_metrics(draw, processed_option_text, font_small)
-                
-                padding = 15
-                if j % 2 == 0:
-                    col_end_x = WIDTH - MARGIN 
-                    text_x = col_end_x - text_width - padding
-                    draw.text((text_x, cursor_y), processed_option_text, fill='black', font=font_small)
-                else:
-                    col_end_x = WIDTH - MARGIN - col_width 
-                    text_x = col_end_x - text_width - padding
-                    draw.text((text_x, cursor_y), processed_option_text, fill='black', font=font_small)
-                
-                if (j + 1) % 2 == 0:
-                    cursor_y += option_height + 8
-                elif j == len(options) - 1:
-                    cursor_y += option_height + 8
-            
-            if len(options) % 2 != 0:
-                cursor_y += 5 
-        
-        cursor_y += 15
-        question_num += 1
-
-    images_to_save.append(img.copy())
-    
-    successful = True
-    for i, final_img in enumerate(images_to_save):
-        final_output_filename = output_filename.replace('.png', f'_Questions_Page_{i+1}.png')
-        try:
-            final_img.save(final_output_filename)
-        except Exception as e:
-            print(f"❌ فشل في إخراج الصورة لملف {final_output_filename}: {e}")
-            successful = False
-            
-    if len(images_to_save) > 1:
-        print(f"🎉 تم توزيع الـ {len(questions)} سؤالاً بنجاح على {len(images_to_save)} صفحة.")
-
-    return successful
-
-def create_bubble_sheet_image(exam_info, user_data, output_filename, qrcode_path):
-    """
-    🔥 إصدار مصحح من Bubble Sheet - متوافق مع كود المسح الضوئي
-    يضيف ID فريدًا لكل فقاعة ويسجل إحداثياتها في ملف JSON.
-    """
-
-    # 1. إعداد الخطوط
-    try:
-        font_large = ImageFont.truetype(FONT_PATH, 40)
-        font_medium = ImageFont.truetype(FONT_PATH, 30)
-        font_small = ImageFont.truetype(FONT_PATH, 24)
-    except IOError as e:
-        print(f"\n\n🛑 خطأ فادح: فشل في تحميل الخط العربي.")
-        sys.exit(1)
-
-    # 2. إعداد الصورة والرسام
-    img = Image.new('RGB', (WIDTH, HEIGHT), color='white')
-    draw = ImageDraw.Draw(img)
-    cursor_y = MARGIN
-    
-    # رسم رأس الصفحة
-    cursor_y = draw_header(img, draw, exam_info, user_data, qrcode_path, font_large, font_medium, cursor_y, is_first_page=True)
-    
-    questions = user_data.get('exam', [])
-    num_questions = len(questions)
-    
-    # --- إعدادات الأعمدة والفقاعات ---
-    MAX_OPTIONS = 4 
-    QUESTIONS_PER_COLUMN = 20 
-    NUM_COLUMNS = 3 
-    
-    available_width = WIDTH - 2 * MARGIN
-    column_width = available_width / NUM_COLUMNS 
-    
-    bubble_radius = 20 
-    bubble_x_spacing = 15
-    q_num_label_width = 80 
-    
-    # قائمة لتخزين بيانات كل فقاعة
-    bubble_data_list = []
-    
-    # 3. رسم الأعمدة (LTR Layout)
-    start_y_content = cursor_y + 10
-
-    option_letters_ltr = ['A', 'B', 'C', 'D']
-    
-    for col_index in range(NUM_COLUMNS):
-        
-        # 🔥 التصحيح: حساب إحداثيات العمود بشكل صحيح
-        col_start_x = MARGIN + (column_width * col_index) 
-        content_start_x = col_start_x + 10 
-        
-        # 3.1. رسم رؤوس الأعمدة (A, B, C, D) 
-        header_y = start_y_content
-        
-        # مكان بدء الفقاعات (بعد رقم السؤال)
-        bubbles_x_start = content_start_x + q_num_label_width
-        
-        for i, letter in enumerate(option_letters_ltr):
-            
-            text_width, text_height = get_text_metrics(draw, letter, font_medium)
-            
-            center_x = bubbles_x_start + (i * (2 * bubble_radius + bubble_x_spacing)) + bubble_radius 
-            
-            draw.text((center_x - text_width / 2, header_y),
-                         letter, fill='black', font=font_medium)
-        
-        # 3.2. رسم الأسئلة داخل العمود
-        current_y = header_y + text_height + 45
-        
-        # 🔥 التصحيح: ترقيم الأسئلة بشكل صحيح
-        start_q = col_index * QUESTIONS_PER_COLUMN + 1
-        end_q = min((col_index + 1) * QUESTIONS_PER_COLUMN, num_questions)
-
-        for q_num in range(start_q, end_q + 1):
-            
-            if current_y + (bubble_radius * 2) > HEIGHT - MARGIN:
-                break
-            
-            # 1. رسم رقم السؤال
-            q_num_text = f"{q_num}."
-            num_text_width, num_text_height = get_text_metrics(draw, q_num_text, font_small)
-            
-            num_x = content_start_x
-            num_y = current_y + bubble_radius - (num_text_height / 2) 
-            
-            draw.text((num_x, num_y), q_num_text, fill='black', font=font_small)
-            
-            # 2. رسم الدوائر (الببلز)
-            for i in range(MAX_OPTIONS):
-                
-                center_x = bubbles_x_start + (i * (2 * bubble_radius + bubble_x_spacing)) + bubble_radius
-                center_y = current_y + bubble_radius
-                
-                bbox_bubble = [
-                    center_x - bubble_radius, 
-                    center_y - bubble_radius, 
-                    center_x + bubble_radius, 
-                    center_y + bubble_radius
-                ]
-                
-                draw.ellipse(bbox_bubble, outline='black', width=3) 
-                
-                # --- 🔥 إضافة ID للفقاعة وتسجيل البيانات 🔥 ---
-                option_letter = option_letters_ltr[i]
-                # إنشاء ID فريد (رقم السؤال + حرف الخيار)
-                bubble_id = f"Q{q_num}-{option_letter}" 
-                
-                bubble_data_list.append({
-                    'id': bubble_id,
-                    'question_num': q_num,
-                    'option_letter': option_letter,
-                    'center_x': int(center_x),
-                    'center_y': int(center_y),
-                    # يتم تسجيل مربع الإحاطة (bounding box) بحدوده الأربعة لسهولة معالجته بالصور
-                    'bbox': [int(b) for b in bbox_bubble] 
-                })
-                # --------------------------------------------------
-                
-            current_y += bubble_radius * 2 + 5 
-            
-        cursor_y = max(cursor_y, current_y)
-
-    # 🔥 إضافة تعليمات التظليل
-    instructions_y = cursor_y + 30
-    instructions = [
-        "تعليمات:",
-        "- استخدم قلم رصاص 2B للتظليل",
-        "- ظلل الدائرة بالكامل",
-        "- لا تضع علامات خارج الدوائر",
-        "- تأكد من أن التظليل داكن وكافي"
-    ]
-    
-    for instruction in instructions:
-        processed_instruction = fix_arabic_text(instruction)
-        text_width, text_height = get_text_metrics(draw, processed_instruction, font_small)
-        draw.text((WIDTH - MARGIN - text_width, instructions_y), processed_instruction, fill='black', font=font_small)
-        instructions_y += text_height + 10
-
-    # حفظ الصورة
-    final_output_filename = output_filename.replace('.png', '_AnswerSheet.png')
-    
-    successful = True
-    try:
-        if num_questions > QUESTIONS_PER_COLUMN * NUM_COLUMNS:
-            print(f"⚠️ تنبيه: تم تصميم ورقة الإجابة لـ {QUESTIONS_PER_COLUMN * NUM_COLUMNS} سؤال فقط.")
-            
-        img.save(final_output_filename)
-        print(f"✅ تم إنشاء ورقة الإجابة (Bubble Sheet مصححة) بنجاح: {final_output_filename}")
-        print(f"📊 توزيع الأسئلة: العمود1: 1-20, العمود2: 21-40, العمود3: 41-60")
-        
-    except Exception as e:
-        print(f"❌ فشل في إخراج ورقة الإجابة: {e}")
-        successful = False
-
-    # 🔥 حفظ بيانات الفقاعات في ملف JSON منفصل
-    if successful:
-        data_output_filename = final_output_filename.replace('.png', '_BubbleData.json')
-        try:
-            with open(data_output_filename, 'w', encoding='utf-8') as f:
-                json.dump(bubble_data_list, f, indent=4, ensure_ascii=False)
-            print(f"✅ تم حفظ بيانات الفقاعات (بما في ذلك الـ IDs) في: {data_output_filename}")
-            
-            # طباعة مثال لأول 5 فقاعات
-            print("🔍 مثال على بيانات الفقاعات (أول 5):")
-            for item in bubble_data_list[:5]:
-                print(f"   -> ID: {item['id']}, Q: {item['question_num']}, Option: {item['option_letter']}, Center: ({item['center_x']}, {item['center_y']}), BBox: {item['bbox']}")
-                
-        except Exception as e:
-            print(f"❌ فشل في حفظ ملف بيانات الفقاعات: {e}")
-            successful = False
-
-    return successful
-
-# --- الدالة الرئيسية للتنفيذ ---
-
-def generate_all_exam_sheets():
-    """المرور على بيانات الامتحان وإنشاء ملفي صورة (الأسئلة والإجابة) لكل طالب، بالإضافة إلى ملف بيانات الفقاعات."""
-    
-    exam_group_data = load_exam_data(JSON_FILE)
-    
-    if not exam_group_data:
-        print("لا توجد بيانات امتحان رئيسية لمعالجتها.")
-        return
-
-    users = exam_group_data.get('users', [])
-    
-    if not users:
-        print("لا توجد بيانات مستخدمين (طلاب) في ملف JSON لمعالجتها.")
-        return
-
-    exam_info = {
-        'stage': exam_group_data.get('stage', 'N/A'),
-        'subject_name': exam_group_data.get('subject_name', 'N/A'),
-        'subject_id': exam_group_data.get('subject_id', 'N/A'),
-        'model_type': exam_group_data.get('model_type', 'N/A') 
-    }
-    
-    num_questions_to_print = 0
-    if users and users[0].get('exam'):
-        num_questions_to_print = len(users[0].get('exam', []))
-        
-    print(f"🌟 جارٍ إنشاء أوراق الامتحان (الأسئلة والإجابة لـ {num_questions_to_print} سؤال) كصور لـ {len(users)} طالب/طالبة...")
-
-    for user in users:
-        user_id = user.get('id')
-        user_name = user.get('name')
-        
-        if not user_id or not user.get('exam') or len(user.get('exam', [])) < 1:
-            if user_name:
-                print(f"⚠️ تنبيه: تم تخطي الطالب {user_name} - البيانات غير كاملة.")
-            continue
-
-        user_model_type = user.get('model_type', exam_info['model_type'])
-        
-        qrcode_data_dict = {
-            "اسم الطالب": user_name,
-            "ID الطالب": user_id,
-            "معرف المادة": exam_info['subject_id'],
-            "عدد الأسئلة": num_questions_to_print,
-            "معلومات الامتحان": {
-                "المرحلة": exam_info['stage'],
-                "اسم المادة": exam_info['subject_name'],
-                "نوع النموذج": user_model_type
-            }
-        }
-
-        qrcode_data = json.dumps(qrcode_data_dict, ensure_ascii=False)
-
-        qrcode_path = os.path.join(OUTPUT_DIR, f"qrcode_{user_id}.png")
-        # تم تغيير امتداد الملف الأساسي ليعكس أنه سيتم إنشاء عدة ملفات
-        base_filename = os.path.join(OUTPUT_DIR, f"Exam_{exam_info['subject_name']}_{user_model_type}_{user_id}_{user_name}.png").replace(' ', '_')
-        
-        if generate_qrcode(qrcode_data, qrcode_path):
-            try:
-                # 1. إنشاء صفحة الأسئلة
-                create_student_exam_image(exam_info, user, base_filename, qrcode_path)
-                
-                # 2. إنشاء صفحة الإجابة (Bubble Sheet المصححة)
-                # هذه الدالة ستقوم الآن بحفظ ملف JSON لبيانات الفقاعات
-                create_bubble_sheet_image(exam_info, user, base_filename, qrcode_path)
-                
-            except SystemExit:
-                print("🛑 توقف التنفيذ بسبب خطأ في الخط.")
-                return
-            except Exception as e:
-                print(f"🛑 خطأ غير متوقع أثناء إنشاء الصورة للطالب {user_name}: {e}")
-            finally:
-                if os.path.exists(qrcode_path):
-                    os.remove(qrcode_path)
-                    
-        else:
-            print(f"❌ تم تخطي الطالب {user_name} بسبب فشل إنشاء QR Code.")
-
-# --- تشغيل البرنامج ---
-if __name__ == '__main__':
-    if not os.path.exists(FONT_PATH):
-        print(f"🛑 خطأ فادح: ملف الخط '{FONT_PATH}' غير موجود.")
-    else:
-        generate_all_exam_sheets()
\ No newline at end of file
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from typing import NamedTuple
+
+from bubble_layout import (
+    FIDUCIAL_OFFSET, FIDUCIAL_SIZE, LAYOUT_DIR, build_layout, bubble_list_to_arrays, fiducial_boxes, fiducial_centers,
+    layout_id_for, layout_path, save_layout,
+)
+from exam_manifest import GenerationManifest, content_hash, file_digest
+from exam_stream import ExamStream, resolve_user_exam
+import instrumentation
+from lazy_import import lazy_import
+from print_document import PRINT_DPI, PRINT_FORMATS, PrintBatchWriter, PrintDocument, document_bytes
+from text_layout import arabic_reshaper, bidi_algorithm, clear_layout_caches, layout_cache_stats, wrap_paragraph
+from tile_cache import TileCache
+
+# المكتبات الثقيلة تُحمّل عند أول استخدام فقط (استيراد الوحدة كمكتبة أو عرض --help لا يدفع كلفتها)
+Image = lazy_import('PIL.Image')
+ImageDraw = lazy_import('PIL.ImageDraw')
+ImageFont = lazy_import('PIL.ImageFont')
+qrcode = lazy_import('qrcode')
+
+# --- الإعدادات الأساسية والثوابت ---
+JSON_FILE = 'jsonQ.json' 
+OUTPUT_DIR = 'exam_sheets_output_images'
+FONT_PATH = 'NotoKufiArabic-Regular.ttf' 
+
+# أبعاد ورقة A4 بالبيكسل (تقريباً عند 150 DPI)
+WIDTH, HEIGHT = 1240, 1754
+MARGIN = 70 
+
+# قائمة الحروف للخيار
+OPTION_LETTERS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
+
+# أحجام ذاكرة التخزين المؤقت (LRU) لموارد الرسم داخل كل عملية
+FONT_CACHE_SIZE = 16
+TEXT_CACHE_SIZE = 4096
+BUBBLE_TEMPLATE_CACHE_SIZE = 8
+# مربعات الأسئلة المرسومة مسبقاً: الحد بالبايت لأن حجم المربع يعتمد على طول السؤال
+QUESTION_TILE_CACHE_BYTES = 64 * 1024 * 1024
+
+# رمز QR المطبوع في رأس الصفحة: حجم المربع (Module) عدد صحيح من البكسلات حتى يبقى قابلاً للقراءة آلياً،
+# بأكبر حجم ممكن دون تجاوز QR_MAX_SIZE (حتى لا يتداخل مع شبكة الفقاعات)
+QR_MAX_SIZE = 210
+QR_MIN_BOX_SIZE = 3
+QR_PAYLOAD_VERSION = 1
+
+# إصدار طريقة الرسم: يُزاد عند أي تعديل يغيّر شكل الأوراق حتى يُعاد توليد جميع الطلاب رغم سجل التوليد
+RENDER_VERSION = 3
+
+# صيغ الإخراج: صورة PNG لكل صفحة (الافتراضي)، أو مستند طباعة واحد متعدد الصفحات لكل طالب (PDF / TIFF)
+PAGE_FORMATS = ('png',) + PRINT_FORMATS
+# نمط ألوان الصفحات: "1" أبيض وأسود (الأصغر والأسرع ترميزاً للطباعة)، "L" رمادي، "RGB" ملون
+PAGE_MODES = ('RGB', 'L', '1')
+DEFAULT_PRINT_MODE = '1'
+
+# --- إعدادات تخطيط ورقة الإجابة (Bubble Sheet) ---
+BUBBLE_MAX_OPTIONS = 4
+BUBBLE_QUESTIONS_PER_COLUMN = 20
+BUBBLE_NUM_COLUMNS = 3
+BUBBLE_RADIUS = 20
+BUBBLE_X_SPACING = 15
+BUBBLE_Q_NUM_LABEL_WIDTH = 80
+# بداية شبكة الفقاعات ثابتة أسفل منطقة الرأس، حتى يكون التخطيط واحداً لجميع الطلاب
+BUBBLE_GRID_TOP = 302
+# الامتحانات الأطول من صفحة واحدة تُقسم ورقة إجابتها على عدة صفحات، لكل منها QR وتخطيط خاص
+BUBBLE_QUESTIONS_PER_PAGE = BUBBLE_QUESTIONS_PER_COLUMN * BUBBLE_NUM_COLUMNS
+
+# --- دوال المساعدة (نفسها) ---
+
+def load_exam_data(file_path):
+    """قراءة وتحليل بيانات الامتحان من ملف JSON."""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            full_data = json.load(f)
+        return full_data.get('data', {})
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"❌ خطأ في قراءة ملف JSON: {e}")
+        return {}
+
+def generate_qrcode(data_to_encode, output_path=None, verbose=True):
+    """
+    إنشاء رمز الاستجابة السريعة (QR Code) كصورة في الذاكرة بالحجم النهائي مباشرة (حتى QR_MAX_SIZE)،
+    ليُعاد استخدامها في جميع صفحات الطالب دون كتابة أو قراءة ملفات مؤقتة.
+    عند تمرير output_path (وضع التصحيح) يتم حفظ نسخة PNG منها أيضاً. verbose=False لا يطبع رسالة النجاح.
+    تُرجع الصورة، أو None عند الفشل.
+    """
+    try:
+        with instrumentation.timer('gen.qr'):
+            qr = qrcode.QRCode(
+                version=1,
+                error_correction=qrcode.constants.ERROR_CORRECT_M,
+                box_size=1,
+                border=4,
+            )
+            qr.add_data(data_to_encode)
+            qr.make(fit=True)
+
+            # اختيار أكبر حجم صحيح للمربع يناسب QR_MAX_SIZE (دون أي إعادة تحجيم تُفسد حواف المربعات)
+            modules = qr.modules_count + 2 * qr.border
+            qr.box_size = max(QR_MIN_BOX_SIZE, QR_MAX_SIZE // modules)
+            img = qr.make_image(fill_color="black", back_color="white").get_image().convert('L')
+
+        if output_path:
+            img.save(output_path)
+        if verbose:
+            display_text = data_to_encode if len(data_to_encode) < 100 else f"{data_to_encode[:100]}..."
+            print(f"✅ تم إنشاء QR Code بنجاح. البيانات المشفرة: {display_text}")
+        return img
+    except Exception as e:
+        print(f"❌ خطأ في إنشاء QR Code: {e}")
+        return None
+
+# --- ذاكرة التخزين المؤقت لموارد الرسم (الخطوط، النصوص المعالجة، القياسات) ---
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path, size):
+    """تحميل الخط مرة واحدة لكل (مسار، حجم) داخل العملية وإعادة استخدامه لكل الطلاب."""
+    with instrumentation.timer('gen.font_load'):
+        return ImageFont.truetype(font_path, size)
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def fix_arabic_text(text):
+    """
+    تقوم بتوصيل الأحرف العربية وعكس ترتيب النص ليناسب الطباعة من اليمين إلى اليسار.
+    النتيجة محفوظة مؤقتاً لأن العناوين والتعليمات والخيارات تتكرر لكل طالب.
+    """
+    if not text:
+        return ""
+    with instrumentation.timer('gen.shaping'):
+        reshaped_text = arabic_reshaper.reshape(text)
+        bidi_text = bidi_algorithm.get_display(reshaped_text)
+    return bidi_text
+
+def get_text_metrics(draw, text, font):
+    return _text_metrics(text, font, draw.fontmode)
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _text_metrics(text, font, fontmode):
+    """قياس (العرض، الارتفاع) للنص بخط معين؛ مطابق لـ draw.textbbox لكن محفوظ مؤقتاً."""
+    bbox = font.getbbox(text, mode=fontmode)
+    return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+QUESTION_TILES = TileCache(QUESTION_TILE_CACHE_BYTES)
+
+def render_cache_stats():
+    """إحصائيات ذاكرة التخزين المؤقت (hits / misses / currsize) لكل نوع من الموارد."""
+    return {
+        'fonts': load_font.cache_info()._asdict(),
+        'shaped_text': fix_arabic_text.cache_info()._asdict(),
+        'text_metrics': _text_metrics.cache_info()._asdict(),
+        'bubble_templates': _bubble_sheet_template.cache_info()._asdict(),
+        'question_tiles': QUESTION_TILES.cache_info(),
+        **layout_cache_stats(),
+    }
+
+def clear_render_caches():
+    """تفريغ جميع ذاكرات التخزين المؤقت لموارد الرسم (مثلاً بعد تغيير ملف الخط)."""
+    load_font.cache_clear()
+    fix_arabic_text.cache_clear()
+    _text_metrics.cache_clear()
+    _bubble_sheet_template.cache_clear()
+    QUESTION_TILES.clear()
+    clear_layout_caches()
+
+def draw_header(img, draw, exam_info, user_data, qrcode_img, font_large, font_medium, cursor_y, is_first_page):
+    """رسم رأس الصفحة الذي يحتوي على العنوان وتفاصيل الطالب ورمز الاستجابة السريعة (QR Code)."""
+    
+    subject_name = exam_info.get('subject_name', 'امتحان غير محدد')
+    stage = exam_info.get('stage', 'N/A')
+    model_type = user_data.get('model_type', exam_info.get('model_type', 'N/A'))
+    
+    if is_first_page:
+        
+        # 1. العنوان الرئيسي
+        header_text = f"ورقة امتحان: {subject_name} - المرحلة: {stage}"
+        processed_header = fix_arabic_text(header_text)
+        
+        text_width, text_height = get_text_metrics(draw, processed_header, font_large)
+        draw.text(((WIDTH - text_width) / 2, cursor_y), processed_header, fill='black', font=font_large)
+        cursor_y += text_height + 20 
+        
+        # 2. تفاصيل الطالبة
+        student_name = user_data.get('name', 'غير متوفر')
+        student_id = user_data.get('id', 'غير متوفر')
+        
+        details_x_ref = WIDTH - MARGIN
+
+        details = [
+            f"اسم الطالب: {student_name}",
+            f"رقم الطالب: {student_id}",
+            f"نموذج الأسئلة: {model_type}"
+        ]
+        
+        for detail in details:
+            processed_detail = fix_arabic_text(detail)
+            
+            text_width, text_height = get_text_metrics(draw, processed_detail, font_medium)
+
+            draw.text((details_x_ref - text_width, cursor_y), processed_detail, fill='black', font=font_medium)
+            cursor_y += text_height + 8 
+
+        # 3. وضع رمز الاستجابة السريعة (QR Code)
+        if qrcode_img is not None:
+            qrcode_x = MARGIN
+            qrcode_y = MARGIN + 10
+
+            img.paste(qrcode_img, (qrcode_x, qrcode_y))
+            
+            qrcode_bottom_y = qrcode_y + qrcode_img.height
+            cursor_y = max(cursor_y, qrcode_bottom_y) + 20 
+        
+    else:
+        cursor_y = MARGIN + 30 
+        
+    cursor_y += 15 
+    return cursor_y
+
+def layout_question_block(draw, q_item, question_num, font_small, content_width):
+    """
+    تخطيط سؤال واحد (النص + الخيارات) بقياس حقيقي بالبكسل.
+    تُرجع (block, block_height, content_height) حيث block قائمة (x، الإزاحة الرأسية، السطر)،
+    و block_height التقدم الكامل للمؤشر بعد السؤال، و content_height ارتفاع المحتوى المرسوم فعلاً.
+    """
+    q_text = q_item.get('question_text', {}).get('text', 'نص السؤال غير متوفر')
+    q_type = q_item.get('question_type_translation', 'N/A')
+
+    block = []
+    offset_y = 0
+    content_height = 0
+
+    # 1. نص السؤال: تقسيم حسب العرض الحقيقي قبل bidi
+    for line in wrap_paragraph(f"{question_num}. ({q_type}) {q_text}", font_small, content_width):
+        text_width, text_height = get_text_metrics(draw, line, font_small)
+        block.append((WIDTH - MARGIN - text_width, offset_y, line))
+        content_height = offset_y + text_height
+        offset_y += text_height + 3
+
+    # 2. الخيارات في عمودين، وكل خيار يُقسم داخل عرض عموده
+    options = q_item.get('options', [])
+    if options:
+        col_width = content_width / 2
+        padding = 15
+        _, option_height = get_text_metrics(draw, fix_arabic_text("مثال"), font_small)
+
+        offset_y += 5
+
+        row_lines = 1
+        for j, opt in enumerate(options):
+            option_text = opt.get('text', 'خيار غير متوفر')
+
+            if j < len(OPTION_LETTERS):
+                option_letter = OPTION_LETTERS[j]
+            else:
+                option_letter = chr(65 + j)
+
+            col_end_x = WIDTH - MARGIN if j % 2 == 0 else WIDTH - MARGIN - col_width
+            option_lines = wrap_paragraph(f"({option_letter}) {option_text}", font_small, col_width - 2 * padding)
+            for k, line in enumerate(option_lines):
+                text_width, _ = get_text_metrics(draw, line, font_small)
+                block.append((col_end_x - text_width - padding, offset_y + k * (option_height + 3), line))
+            row_lines = max(row_lines, len(option_lines))
+
+            if (j + 1) % 2 == 0 or j == len(options) - 1:
+                content_height = offset_y + (row_lines - 1) * (option_height + 3) + option_height
+                offset_y += (row_lines - 1) * (option_height + 3) + option_height + 8
+                row_lines = 1
+
+        if len(options) % 2 != 0:
+            offset_y += 5
+
+    offset_y += 15
+    return block, offset_y, content_height
+
+def question_tile_key(q_item, question_num, font, content_width, fontmode):
+    """بصمة كل ما يؤثر في شكل السؤال المرسوم: النص والنوع والخيارات والترقيم وإعدادات الخط والصفحة."""
+    return content_hash(
+        question_num,
+        q_item.get('question_type_translation', 'N/A'),
+        q_item.get('question_text', {}).get('text', 'نص السؤال غير متوفر'),
+        [opt.get('text', 'خيار غير متوفر') for opt in q_item.get('options', [])],
+        font.path, font.size, content_width, WIDTH, MARGIN, fontmode,
+    )
+
+def render_question_tile(draw, q_item, question_num, font_small, content_width):
+    """
+    السؤال مرسوماً كقناع (Mask) جاهز للصق: تُرجع (tile, x, y, block_height, content_height)
+    حيث (x, y) موضع المربع بالنسبة لبداية السؤال، و tile قص لحدود الحبر فقط (None لسؤال بلا نص).
+    يُرسم كل سؤال مرة واحدة لكل عملية ثم يُعاد من QUESTION_TILES لجميع الطلاب بنفس النموذج.
+    """
+    key = question_tile_key(q_item, question_num, font_small, content_width, draw.fontmode)
+    cached = QUESTION_TILES.get(key)
+    if cached is not None:
+        instrumentation.count('gen.tile_hits')
+        return cached
+
+    instrumentation.count('gen.tile_misses')
+    block, block_height, content_height = layout_question_block(draw, q_item, question_num, font_small, content_width)
+    with instrumentation.timer('gen.tile_render'):
+        # هامش رأسي لأن حبر بعض الحروف (العلامات والنقاط) قد يتجاوز حدود السطر المقاسة
+        pad = font_small.size
+        mask = Image.new('L', (WIDTH, content_height + 2 * pad), 0)
+        mask_draw = ImageDraw.Draw(mask)
+        mask_draw.fontmode = draw.fontmode
+        for text_x, offset_y, line in block:
+            mask_draw.text((text_x, pad + offset_y), line, fill=255, font=font_small)
+
+        bbox = mask.getbbox()
+        if bbox is None:
+            tile, tile_x, tile_y = None, 0, 0
+        else:
+            tile, tile_x, tile_y = mask.crop(bbox), bbox[0], bbox[1] - pad
+    return QUESTION_TILES.put(key, (tile, tile_x, tile_y, block_height, content_height))
+
+def _save_page(img, path, document=None):
+    """إخراج صفحة مكتملة فوراً: إضافتها إلى مستند الطباعة إن وُجد، وإلا حفظها كملف PNG."""
+    with instrumentation.timer('gen.page_encode'):
+        if document is not None:
+            document.add_page(img)
+        else:
+            img.save(path)
+
+
+def create_student_exam_image(exam_info, user_data, output_filename, qrcode_img, outputs=None,
+                              document=None, page_mode='RGB', verbose=True):
+    """
+    إنشاء صفحات الأسئلة بنمط الألوان page_mode، وإخراج كل صفحة فور اكتمالها (لا تُجمع الصفحات في الذاكرة).
+    تُضاف الصفحات إلى document (مستند طباعة) إن مُرر، وإلا تُحفظ كملفات PNG وتُضاف مساراتها إلى outputs.
+    verbose=False لا يطبع رسائل التقدم (رسائل الأخطاء تُطبع دائماً).
+    """
+    
+    # 1. إعداد الخطوط
+    try:
+        font_large = load_font(FONT_PATH, 40)
+        font_medium = load_font(FONT_PATH, 30)
+        font_small = load_font(FONT_PATH, 24)
+    except IOError as e:
+        print(f"\n\n🛑 خطأ فادح: فشل في تحميل الخط العربي. تأكد من أن الملف '{FONT_PATH}' موجود في نفس المجلد.")
+        if not os.path.exists(FONT_PATH):
+            print(f"🛑 الملف '{FONT_PATH}' غير موجود. يرجى تحميله ووضعه في نفس مجلد السكربت.")
+        sys.exit(1)
+
+    questions = user_data.get('exam', [])
+    content_width = WIDTH - 2 * MARGIN
+    question_num = 1
+    page_num = 1
+
+    def save_page(page_img, number):
+        final_output_filename = output_filename.replace('.png', f'_Questions_Page_{number}.png')
+        try:
+            _save_page(page_img, final_output_filename, document)
+        except Exception as e:
+            print(f"❌ فشل في إخراج الصفحة {number} لملف {document.path if document else final_output_filename}: {e}")
+            return False
+        instrumentation.count('gen.question_pages')
+        if outputs is not None and document is None:
+            outputs.append(final_output_filename)
+        return True
+    
+    img = Image.new(page_mode, (WIDTH, HEIGHT), color='white')
+    draw = ImageDraw.Draw(img)
+    cursor_y = MARGIN
+    cursor_y = draw_header(img, draw, exam_info, user_data, qrcode_img, font_large, font_medium, cursor_y, is_first_page=True)
+    
+    # بداية منطقة المحتوى في الصفحة الحالية (لا يُنقل سؤال لصفحة جديدة إذا كانت الصفحة الحالية فارغة)
+    page_top = cursor_y
+    
+    with instrumentation.timer('gen.draw_questions'):
+        for q_item in questions:
+        
+            # السؤال مرسوم مسبقاً: نفس الارتفاعات تُستخدم لتقسيم الصفحات، والمربع يُلصق دون إعادة رسم النص
+            tile, tile_x, tile_y, block_height, content_height = render_question_tile(
+                draw, q_item, question_num, font_small, content_width)
+
+            if cursor_y + content_height > HEIGHT - MARGIN and cursor_y > page_top: 
+                if not save_page(img, page_num):
+                    return False
+            
+                page_num += 1
+                img = Image.new(page_mode, (WIDTH, HEIGHT), color='white')
+                draw = ImageDraw.Draw(img)
+                cursor_y = MARGIN
+            
+                cursor_y = draw_header(img, draw, exam_info, user_data, qrcode_img, font_large, font_medium, cursor_y, is_first_page=False)
+                page_top = cursor_y
+
+            if tile is not None:
+                img.paste('black', (tile_x, cursor_y + tile_y), mask=tile)
+            cursor_y += block_height
+            question_num += 1
+
+    if not save_page(img, page_num):
+        return False
+            
+    if page_num > 1 and verbose:
+        print(f"🎉 تم توزيع الـ {len(questions)} سؤالاً بنجاح على {page_num} صفحة.")
+
+    return True
+
+def _bubble_layout_config():
+    """ثوابت التخطيط التي يعتمد عليها شكل ورقة الإجابة؛ تغيّر أي منها يعني قالباً جديداً."""
+    return (
+        WIDTH, HEIGHT, MARGIN, FONT_PATH,
+        BUBBLE_MAX_OPTIONS, BUBBLE_QUESTIONS_PER_COLUMN, BUBBLE_NUM_COLUMNS,
+        BUBBLE_RADIUS, BUBBLE_X_SPACING, BUBBLE_Q_NUM_LABEL_WIDTH, BUBBLE_GRID_TOP,
+        FIDUCIAL_SIZE, FIDUCIAL_OFFSET,
+    )
+
+def answer_sheet_pages(num_questions):
+    """تقسيم الأسئلة على صفحات ورقة الإجابة: قائمة (رقم أول سؤال، عدد أسئلة الصفحة) لكل صفحة."""
+    return [(first, min(BUBBLE_QUESTIONS_PER_PAGE, num_questions - first + 1))
+            for first in range(1, num_questions + 1, BUBBLE_QUESTIONS_PER_PAGE)]
+
+@functools.lru_cache(maxsize=BUBBLE_TEMPLATE_CACHE_SIZE)
+def _bubble_sheet_template(num_questions, layout_config, page_mode='RGB', first_question=1):
+    """
+    رسم الجزء الثابت من صفحة ورقة الإجابة مرة واحدة لكل (عدد الأسئلة، إعدادات التخطيط، نمط الألوان، أول سؤال):
+    رؤوس الأعمدة، أرقام الأسئلة، الفقاعات، والتعليمات، مع جدول إحداثيات الفقاعات.
+    منطقة الرأس (أعلى BUBBLE_GRID_TOP) تبقى فارغة ليتم ختم بيانات كل طالب عليها.
+    ترفع ValueError إذا لم تتسع الصفحة لأسئلتها (بدلاً من إسقاط الفقاعات بصمت).
+    """
+    font_medium = load_font(FONT_PATH, 30)
+    font_small = load_font(FONT_PATH, 24)
+
+    img = Image.new(page_mode, (WIDTH, HEIGHT), color='white')
+    draw = ImageDraw.Draw(img)
+    cursor_y = BUBBLE_GRID_TOP
+
+    # علامات التسجيل في الزوايا الأربع، يستخدمها الماسح لتصحيح الميلان والإزاحة وتغير المقياس
+    for box in fiducial_boxes(WIDTH, HEIGHT):
+        draw.rectangle(box, fill='black')
+
+    available_width = WIDTH - 2 * MARGIN
+    column_width = available_width / BUBBLE_NUM_COLUMNS 
+    
+    bubble_radius = BUBBLE_RADIUS
+    
+    # قائمة لتخزين بيانات كل فقاعة
+    bubble_data_list = []
+    
+    # 3. رسم الأعمدة (LTR Layout)
+    start_y_content = BUBBLE_GRID_TOP
+
+    option_letters_ltr = OPTION_LETTERS[:BUBBLE_MAX_OPTIONS]
+    
+    for col_index in range(BUBBLE_NUM_COLUMNS):
+        
+        # 🔥 التصحيح: حساب إحداثيات العمود بشكل صحيح
+        col_start_x = MARGIN + (column_width * col_index) 
+        content_start_x = col_start_x + 10 
+        
+        # 3.1. رسم رؤوس الأعمدة (A, B, C, D) 
+        header_y = start_y_content
+        
+        # مكان بدء الفقاعات (بعد رقم السؤال)
+        bubbles_x_start = content_start_x + BUBBLE_Q_NUM_LABEL_WIDTH
+        
+        for i, letter in enumerate(option_letters_ltr):
+            
+            text_width, text_height = get_text_metrics(draw, letter, font_medium)
+            
+            center_x = bubbles_x_start + (i * (2 * bubble_radius + BUBBLE_X_SPACING)) + bubble_radius 
+            
+            draw.text((center_x - text_width / 2, header_y),
+                         letter, fill='black', font=font_medium)
+        
+        # 3.2. رسم الأسئلة داخل العمود
+        current_y = header_y + text_height + 45
+        
+        # 🔥 التصحيح: ترقيم الأسئلة بشكل صحيح
+        start_q = first_question + col_index * BUBBLE_QUESTIONS_PER_COLUMN
+        end_q = first_question - 1 + min((col_index + 1) * BUBBLE_QUESTIONS_PER_COLUMN, num_questions)
+
+        for q_num in range(start_q, end_q + 1):
+            
+            if current_y + (bubble_radius * 2) > HEIGHT - MARGIN:
+                raise ValueError(f"ورقة الإجابة لا تتسع للسؤال {q_num}: قلل BUBBLE_QUESTIONS_PER_COLUMN")
+            
+            # 1. رسم رقم السؤال
+            q_num_text = f"{q_num}."
+            num_text_width, num_text_height = get_text_metrics(draw, q_num_text, font_small)
+            
+            num_x = content_start_x
+            num_y = current_y + bubble_radius - (num_text_height / 2) 
+            
+            draw.text((num_x, num_y), q_num_text, fill='black', font=font_small)
+            
+            # 2. رسم الدوائر (الببلز)
+            for i in range(BUBBLE_MAX_OPTIONS):
+                
+                center_x = bubbles_x_start + (i * (2 * bubble_radius + BUBBLE_X_SPACING)) + bubble_radius
+                center_y = current_y + bubble_radius
+                
+                bbox_bubble = [
+                    center_x - bubble_radius, 
+                    center_y - bubble_radius, 
+                    center_x + bubble_radius, 
+                    center_y + bubble_radius
+                ]
+                
+                draw.ellipse(bbox_bubble, outline='black', width=3) 
+                
+                # --- 🔥 إضافة ID للفقاعة وتسجيل البيانات 🔥 ---
+                option_letter = option_letters_ltr[i]
+                # إنشاء ID فريد (رقم السؤال + حرف الخيار)
+                bubble_id = f"Q{q_num}-{option_letter}" 
+                
+                bubble_data_list.append({
+                    'id': bubble_id,
+                    'question_num': q_num,
+                    'option_letter': option_letter,
+                    'center_x': int(center_x),
+                    'center_y': int(center_y),
+                    # يتم تسجيل مربع الإحاطة (bounding box) بحدوده الأربعة لسهولة معالجته بالصور
+                    'bbox': [int(b) for b in bbox_bubble] 
+                })
+                # --------------------------------------------------
+                
+            current_y += bubble_radius * 2 + 5 
+            
+        cursor_y = max(cursor_y, current_y)
+
+    # 🔥 إضافة تعليمات التظليل
+    instructions_y = cursor_y + 30
+    instructions = [
+        "تعليمات:",
+        "- استخدم قلم رصاص 2B للتظليل",
+        "- ظلل الدائرة بالكامل",
+        "- لا تضع علامات خارج الدوائر",
+        "- تأكد من أن التظليل داكن وكافي"
+    ]
+    
+    for instruction in instructions:
+        processed_instruction = fix_arabic_text(instruction)
+        text_width, text_height = get_text_metrics(draw, processed_instruction, font_small)
+        draw.text((WIDTH - MARGIN - text_width, instructions_y), processed_instruction, fill='black', font=font_small)
+        instructions_y += text_height + 10
+
+    return img, tuple(bubble_data_list)
+
+def bubble_layout_id(num_questions, first_question=1):
+    """معرف تخطيط صفحة ورقة الإجابة لعدد أسئلة معين (يُكتب في QR ليجد الماسح التخطيط مباشرة)."""
+    return layout_id_for(num_questions, _bubble_layout_config(), first_question)
+
+def answer_sheet_layout_ids(total_questions):
+    """معرفات تخطيطات صفحات ورقة الإجابة بالترتيب لامتحان من total_questions سؤالاً."""
+    return [bubble_layout_id(count, first) for first, count in answer_sheet_pages(total_questions)]
+
+@functools.lru_cache(maxsize=BUBBLE_TEMPLATE_CACHE_SIZE)
+def _register_bubble_layout(num_questions, layout_config, layout_dir, first_question=1, page_mode='RGB'):
+    """
+    حفظ تخطيط الفقاعات في السجل المشترك مرة واحدة لكل عملية (بدلاً من ملف JSON لكل طالب).
+    page_mode لا يغير التخطيط، لكنه يعيد استخدام القالب المرسوم بنفس النمط من الذاكرة المؤقتة.
+    """
+    _, bubble_data_list = _bubble_sheet_template(num_questions, layout_config, page_mode, first_question)
+    question_nums, bboxes = bubble_list_to_arrays(bubble_data_list, BUBBLE_MAX_OPTIONS)
+    layout_id = layout_id_for(num_questions, layout_config, first_question)
+    save_layout(layout_id, question_nums, bboxes, layout_dir,
+                page_size=(WIDTH, HEIGHT), fiducials=fiducial_centers(WIDTH, HEIGHT))
+    print(f"🧩 تم تسجيل تخطيط الفقاعات ({num_questions} سؤال من {first_question}) بالمعرف: {layout_id}")
+    return layout_id
+
+def create_bubble_sheet_image(exam_info, user_data, output_filename, qrcode_img, write_bubble_json=False, outputs=None,
+                              document=None, page_mode='RGB', page_qrcodes=None,
+                              layout_dir=os.path.join(OUTPUT_DIR, LAYOUT_DIR), verbose=True):
+    """
+    🔥 إصدار مصحح من Bubble Sheet - متوافق مع كود المسح الضوئي
+    يضيف ID فريدًا لكل فقاعة ويسجل تخطيطها مرة واحدة في سجل التخطيطات المشترك (LAYOUT_DIR).
+    الجزء الثابت (الشبكة والتعليمات) يُؤخذ من قالب محفوظ، ويُختم عليه رأس الطالب و QR فقط.
+    الامتحان الأطول من BUBBLE_QUESTIONS_PER_PAGE سؤالاً يُقسم على عدة صفحات، لكل منها تخطيط مستقل و QR خاص
+    بها من page_qrcodes (بالترتيب؛ qrcode_img يكفي لورقة الصفحة الواحدة).
+    write_bubble_json=True يحفظ أيضاً ملف BubbleData JSON الخاص بالطالب (الصيغة القديمة).
+    تُضاف مسارات الملفات المحفوظة إلى outputs إن مُررت. مع document تُضاف الصفحات في آخر مستند الطباعة.
+    التخطيطات تُسجل في layout_dir، و layout_dir=None لا يكتب شيئاً (الرسم في الذاكرة عبر render_student_pages).
+    verbose=False لا يطبع رسائل التقدم (رسائل الأخطاء تُطبع دائماً).
+    """
+
+    # 1. إعداد الخطوط
+    try:
+        font_large = load_font(FONT_PATH, 40)
+        font_medium = load_font(FONT_PATH, 30)
+        font_small = load_font(FONT_PATH, 24)
+    except IOError as e:
+        print(f"\n\n🛑 خطأ فادح: فشل في تحميل الخط العربي.")
+        sys.exit(1)
+
+    questions = user_data.get('exam', [])
+    pages = answer_sheet_pages(len(questions))
+    page_qrcodes = page_qrcodes or [qrcode_img]
+    if len(page_qrcodes) != len(pages):
+        raise ValueError(f"ورقة الإجابة من {len(pages)} صفحة تحتاج {len(pages)} رمز QR (مُرر {len(page_qrcodes)})")
+
+    successful = True
+    for page_num, ((first_question, num_questions), page_qrcode) in enumerate(zip(pages, page_qrcodes), start=1):
+
+        # 2. نسخ القالب ورسم رأس الصفحة الخاص بالطالب (ورقم الصفحة عند تعدد الصفحات)
+        with instrumentation.timer('gen.draw_answer_sheet'):
+            template_img, bubble_data_list = _bubble_sheet_template(num_questions, _bubble_layout_config(), page_mode,
+                                                                    first_question)
+            img = template_img.copy()
+            draw = ImageDraw.Draw(img)
+            draw_header(img, draw, exam_info, user_data, page_qrcode, font_large, font_medium, MARGIN, is_first_page=True)
+            if len(pages) > 1:
+                page_label = fix_arabic_text(f"ورقة الإجابة: صفحة {page_num} من {len(pages)}")
+                text_width, text_height = get_text_metrics(draw, page_label, font_small)
+                draw.text(((WIDTH - text_width) / 2, HEIGHT - MARGIN - text_height), page_label, fill='black', font=font_small)
+
+        # حفظ الصورة
+        suffix = '_AnswerSheet.png' if len(pages) == 1 else f'_AnswerSheet_Page_{page_num}.png'
+        final_output_filename = output_filename.replace('.png', suffix)
+
+        try:
+            _save_page(img, final_output_filename, document)
+            if outputs is not None and document is None:
+                outputs.append(final_output_filename)
+            if verbose:
+                print(f"✅ تم إنشاء ورقة الإجابة (Bubble Sheet مصححة) بنجاح: {document.path if document else final_output_filename}")
+                print(f"📊 توزيع الأسئلة: {first_question}-{first_question + num_questions - 1} على {BUBBLE_NUM_COLUMNS} أعمدة")
+
+        except Exception as e:
+            print(f"❌ فشل في إخراج ورقة الإجابة: {e}")
+            successful = False
+            break
+
+        # 🔥 تسجيل تخطيط الفقاعات (مرة واحدة لكل تخطيط)
+        try:
+            if layout_dir:
+                _register_bubble_layout(num_questions, _bubble_layout_config(), layout_dir, first_question, page_mode)
+        except Exception as e:
+            print(f"❌ فشل في حفظ تخطيط الفقاعات: {e}")
+            successful = False
+            break
+
+        # حفظ بيانات الفقاعات في ملف JSON منفصل (الصيغة القديمة، عند الطلب فقط)
+        if write_bubble_json:
+            data_output_filename = final_output_filename.replace('.png', '_BubbleData.json')
+            try:
+                with open(data_output_filename, 'w', encoding='utf-8') as f:
+                    json.dump(list(bubble_data_list), f, indent=4, ensure_ascii=False)
+                if outputs is not None:
+                    outputs.append(data_output_filename)
+                print(f"✅ تم حفظ بيانات الفقاعات (بما في ذلك الـ IDs) في: {data_output_filename}")
+
+                # طباعة مثال لأول 5 فقاعات
+                print("🔍 مثال على بيانات الفقاعات (أول 5):")
+                for item in bubble_data_list[:5]:
+                    print(f"   -> ID: {item['id']}, Q: {item['question_num']}, Option: {item['option_letter']}, Center: ({item['center_x']}, {item['center_y']}), BBox: {item['bbox']}")
+
+            except Exception as e:
+                print(f"❌ فشل في حفظ ملف بيانات الفقاعات: {e}")
+                successful = False
+                break
+
+    return successful
+
+# --- الدالة الرئيسية للتنفيذ ---
+
+def exam_info_from_meta(meta):
+    """بيانات الامتحان المطبوعة على الأوراق من البيانات العامة في ملف الامتحان (مفاتيح data ما عدا users و models)."""
+    return {
+        'stage': meta.get('stage', 'N/A'),
+        'subject_name': meta.get('subject_name', 'N/A'),
+        'subject_id': meta.get('subject_id', 'N/A'),
+        'model_type': meta.get('model_type', 'N/A'),
+        'exam_id': (meta.get('exam_info') or {}).get('id'),
+    }
+
+def build_qr_payload(exam_info, user, model_type, num_questions, page=1):
+    """
+    محتوى رمز QR بصيغة مختصرة (مفاتيح قصيرة، بدون مسافات) حتى يبقى الرمز صغير الإصدار وقابلاً للقراءة:
+    v: إصدار الصيغة، sid: رقم الطالب، name: اسمه، sub: معرف المادة، eid: معرف الامتحان،
+    n: عدد الأسئلة، m: نوع النموذج، lid: معرف تخطيط الفقاعات لهذه الصفحة (يستخدمه الماسح لاختيار التخطيط).
+    لورقة الإجابة متعددة الصفحات يُضاف p: رقم الصفحة و pc: عدد الصفحات، ليجمع الماسح صفحات الطالب بأي ترتيب.
+    """
+    layout_ids = answer_sheet_layout_ids(len(user['exam']))
+    payload = {
+        "v": QR_PAYLOAD_VERSION,
+        "sid": user.get('id'),
+        "name": user.get('name'),
+        "sub": exam_info['subject_id'],
+        "eid": exam_info.get('exam_id'),
+        "n": num_questions,
+        "m": model_type,
+        "lid": layout_ids[page - 1],
+    }
+    if len(layout_ids) > 1:
+        payload.update(p=page, pc=len(layout_ids))
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+class RenderJob(NamedTuple):
+    """
+    مهمة رسم طالب واحد (تُرسل كما هي إلى العملية العاملة). digest بصمة مدخلات الطالب في سجل التوليد،
+    و unchanged يعني أن ملفاته محدّثة فلا تُرسم.
+    """
+    exam_info: dict
+    user: dict
+    num_questions: int
+    options: dict
+    digest: str
+    unchanged: bool
+
+
+def _render_student(job):
+    """
+    مهمة طالب واحد داخل العملية العاملة: الرسم مع القياسات (instrumentation) عند تفعيلها،
+    وتحت cProfile/tracemalloc إذا كان الطالب ضمن profile_ids.
+    تُرجع (الحالة، رسالة، الملفات المحفوظة، قياسات العملية منذ آخر مهمة أو None).
+    """
+    options = job.options
+    instrumentation.enable(options.get('metrics'))
+    QUESTION_TILES.resize(options.get('tile_cache_bytes', QUESTION_TILE_CACHE_BYTES))
+    user_id = job.user.get('id')
+
+    profile_ids = options.get('profile_ids') or ()
+    if str(user_id) in profile_ids:
+        profile = instrumentation.profiled(f"student_{user_id}", options['profile_dir'])
+    else:
+        profile = contextlib.nullcontext()
+
+    with profile, instrumentation.timer('gen.student'):
+        status, message, outputs = _render_student_sheets(job)
+    instrumentation.count(f"gen.students_{status}")
+    return status, message, outputs, instrumentation.drain()
+
+
+def _render_student_sheets(job):
+    """
+    رسم أوراق طالب واحد (الأسئلة + الإجابة) بشكل مستقل، ليتم تنفيذها داخل عملية عاملة (Worker).
+    تُرجع (الحالة، رسالة، الملفات المحفوظة) بدلاً من رفع الاستثناء، حتى لا يُوقف فشل طالب واحد بقية الدفعة.
+    الحالات الممكنة: 'ok' ، 'skipped' ، 'failed' ، 'fatal' (خطأ في الخط يستوجب إيقاف التنفيذ).
+    """
+    exam_info, user, num_questions_to_print, options = job.exam_info, job.user, job.num_questions, job.options
+
+    user_id = user.get('id')
+    user_name = user.get('name')
+
+    if not user_id or not user.get('exam') or len(user.get('exam', [])) < 1:
+        return 'skipped', f"البيانات غير كاملة للطالب {user_name}", []
+
+    user_model_type = user.get('model_type', exam_info['model_type'])
+
+    num_answer_pages = len(answer_sheet_pages(len(user['exam'])))
+    output_dir = options.get('output_dir', OUTPUT_DIR)
+
+    # في وضع التصحيح فقط يُحفظ QR كملف PNG ويُترك في مجلد الإخراج للفحص
+    qrcode_path = os.path.join(output_dir, f"qrcode_{user_id}.png") if options.get('debug_qr') else None
+    # تم تغيير امتداد الملف الأساسي ليعكس أنه سيتم إنشاء عدة ملفات
+    base_filename = os.path.join(output_dir, f"Exam_{exam_info['subject_name']}_{user_model_type}_{user_id}_{user_name}.png").replace(' ', '_')
+
+    # في الوضع المتوازي يتم حجز مخرجات الدوال حتى لا تتداخل رسائل العمليات مع تقرير التقدم
+    log = io.StringIO()
+    redirect = contextlib.redirect_stdout(log) if options.get('capture_output') else contextlib.nullcontext()
+
+    outputs = [qrcode_path] if qrcode_path else []
+
+    # في وضع الطباعة تُكتب صفحات الطالب كلها (الأسئلة ثم ورقة الإجابة) في مستند واحد، صفحة بصفحة
+    page_format = options.get('page_format', 'png')
+    page_mode = options.get('page_mode', 'RGB')
+    document = PrintDocument(f"{os.path.splitext(base_filename)[0]}.{page_format}") if page_format != 'png' else None
+
+    with redirect, document or contextlib.nullcontext():
+        try:
+            # رمز QR لكل صفحة من ورقة الإجابة؛ رمز الصفحة الأولى يُطبع أيضاً على صفحة الأسئلة الأولى
+            page_qrcodes = [generate_qrcode(build_qr_payload(exam_info, user, user_model_type, num_questions_to_print, page),
+                                            qrcode_path if page == 1 else None)
+                            for page in range(1, num_answer_pages + 1)]
+            if any(qr_img is None for qr_img in page_qrcodes):
+                return 'failed', "فشل إنشاء QR Code", outputs
+            qrcode_img = page_qrcodes[0]
+
+            # 1. إنشاء صفحة الأسئلة
+            if not create_student_exam_image(exam_info, user, base_filename, qrcode_img, outputs, document, page_mode):
+                return 'failed', "فشل إخراج صفحات الأسئلة", outputs
+
+            # 2. إنشاء صفحة الإجابة (Bubble Sheet المصححة) وتسجيل تخطيط الفقاعات
+            if not create_bubble_sheet_image(exam_info, user, base_filename, qrcode_img,
+                                             write_bubble_json=options.get('bubble_json', False), outputs=outputs,
+                                             document=document, page_mode=page_mode, page_qrcodes=page_qrcodes,
+                                             layout_dir=os.path.join(output_dir, LAYOUT_DIR)):
+                return 'failed', "فشل إخراج ورقة الإجابة", outputs
+
+            if document is not None:
+                outputs.append(document.finish())
+
+        except SystemExit:
+            return 'fatal', "توقف التنفيذ بسبب خطأ في الخط.", outputs
+        except Exception as e:
+            return 'failed', f"{type(e).__name__}: {e}", outputs
+
+    return 'ok', base_filename, outputs
+
+
+def _render_fingerprint(options):
+    """بصمة كل ما يؤثر على الرسم ولا يخص طالباً بعينه: إصدار الرسم، ثوابت التخطيط، QR، ومحتوى ملف الخط."""
+    return content_hash(
+        RENDER_VERSION, _bubble_layout_config(), OPTION_LETTERS,
+        QR_MAX_SIZE, QR_MIN_BOX_SIZE, QR_PAYLOAD_VERSION,
+        file_digest(FONT_PATH), options.get('debug_qr'), options.get('bubble_json'),
+        options.get('page_format', 'png'), options.get('page_mode', 'RGB'), PRINT_DPI,
+    )
+
+
+def _student_requires(user, output_dir=OUTPUT_DIR):
+    """الملفات المشتركة التي تعتمد عليها أوراق الطالب (تخطيطات صفحات ورقة الإجابة في السجل)."""
+    return [layout_path(layout_id, os.path.join(output_dir, LAYOUT_DIR))
+            for layout_id in answer_sheet_layout_ids(len(user.get('exam') or []))]
+
+
+def _iter_results_in_order(executor, jobs, window):
+    """
+    توزيع المهام على مجمع العمليات مع إبقاء عدد محدود منها قيد التنفيذ (window)،
+    وإرجاع (المهمة، النتيجة) بنفس ترتيب الطلاب في ملف الإدخال.
+    الطلاب المحدّثة ملفاتهم (حسب سجل التوليد) لا تُرسل إلى المجمع أصلاً.
+    """
+    pending = collections.deque()
+    for job in jobs:
+        pending.append((job, None if job.unchanged else executor.submit(_render_student, job)))
+        if len(pending) >= window:
+            job, future = pending.popleft()
+            yield job, _future_result(future)
+    while pending:
+        job, future = pending.popleft()
+        yield job, _future_result(future)
+
+
+def _future_result(future):
+    """قراءة نتيجة مهمة من المجمع، مع تحويل أعطال العملية نفسها إلى حالة فشل للطالب."""
+    if future is None:
+        return _UNCHANGED_RESULT
+    try:
+        return future.result()
+    except Exception as e:
+        return 'failed', f"{type(e).__name__}: {e}", [], None
+
+
+# نتيجة الطالب الذي لم تتغير مدخلاته وما زالت ملفاته موجودة
+_UNCHANGED_RESULT = ('unchanged', None, [], None)
+
+
+def _run_job(job):
+    """تنفيذ مهمة طالب في الوضع التسلسلي (مع تخطي المحدّث منها)."""
+    return _UNCHANGED_RESULT if job.unchanged else _render_student(job)
+
+
+# --- واجهة المكتبة: التوليد في الذاكرة دون ملفات (In-process API) ---
+# لخادم الويب أو أي برنامج يستورد الوحدة مباشرة: المدخلات قواميس في الذاكرة، والمخرجات صور Pillow
+# (np.asarray(page) للمصفوفة) أو bytes، ولا يُكتب أي ملف (لا صفحات، ولا سجل تخطيطات، ولا سجل توليد).
+
+class PageCollector:
+    """
+    مستند في الذاكرة بنفس واجهة PrintDocument التي تستخدمها دوال الرسم (add_page و path):
+    يحتفظ بصور الصفحات نفسها بالترتيب بدلاً من ترميزها في ملف.
+    """
+
+    path = '<memory>'
+
+    def __init__(self):
+        self.pages = []
+
+    def add_page(self, img):
+        self.pages.append(img)
+
+
+def answer_sheet_layouts(total_questions, page_mode='RGB'):
+    """
+    تخطيطات صفحات ورقة الإجابة {layout_id: تخطيط بصيغة الماسح} لامتحان من total_questions سؤالاً،
+    من قوالب الرسم نفسها ودون سجل التخطيطات على القرص؛ تُمرر إلى omr_scanner.scan_image(layouts=...).
+    """
+    layouts = {}
+    for first_question, num_questions in answer_sheet_pages(total_questions):
+        _, bubble_data_list = _bubble_sheet_template(num_questions, _bubble_layout_config(), page_mode, first_question)
+        question_nums, bboxes = bubble_list_to_arrays(bubble_data_list, BUBBLE_MAX_OPTIONS)
+        layout_id = bubble_layout_id(num_questions, first_question)
+        layouts[layout_id] = build_layout(layout_id, question_nums, bboxes, (WIDTH, HEIGHT),
+                                          fiducial_centers(WIDTH, HEIGHT))
+    return layouts
+
+
+def render_student_pages(exam_info, user, num_questions=None, page_mode='RGB'):
+    """
+    رسم أوراق طالب واحد في الذاكرة. exam_info كما تُرجعه exam_info_from_meta، و user قاموس الطالب مع قائمة exam،
+    و num_questions العدد المكتوب في QR (الافتراضي عدد أسئلة الطالب).
+    تُرجع {"question_pages": [صور]، "answer_pages": [صور]، "layouts": answer_sheet_layouts، "qr_payloads": [نص QR لكل
+    صفحة إجابة]}. ترفع OSError إذا تعذر تحميل الخط، و ValueError لبيانات ناقصة أو عند فشل الرسم.
+    لا تطبع رسائل التقدم (verbose=False في دوال الرسم)، فتصلح للاستدعاء من خادم ويب.
+    """
+    if not user.get('id') or not user.get('exam'):
+        raise ValueError(f"البيانات غير كاملة للطالب {user.get('name')}")
+    # تحميل الخط هنا يرفع الخطأ للمستدعي بدلاً من إنهاء العملية (sys.exit) داخل دوال الرسم
+    load_font(FONT_PATH, 40)
+
+    model_type = user.get('model_type', exam_info['model_type'])
+    qr_payloads = [build_qr_payload(exam_info, user, model_type, num_questions or len(user['exam']), page)
+                   for page in range(1, len(answer_sheet_pages(len(user['exam']))) + 1)]
+    page_qrcodes = [generate_qrcode(payload, verbose=False) for payload in qr_payloads]
+    if any(qr_img is None for qr_img in page_qrcodes):
+        raise ValueError("فشل إنشاء QR Code")
+
+    questions, answers = PageCollector(), PageCollector()
+    if not create_student_exam_image(exam_info, user, '', page_qrcodes[0], document=questions, page_mode=page_mode,
+                                     verbose=False):
+        raise ValueError("فشل رسم صفحات الأسئلة")
+    if not create_bubble_sheet_image(exam_info, user, '', page_qrcodes[0], document=answers, page_mode=page_mode,
+                                     page_qrcodes=page_qrcodes, layout_dir=None, verbose=False):
+        raise ValueError("فشل رسم ورقة الإجابة")
+    return {'question_pages': questions.pages, 'answer_pages': answers.pages,
+            'layouts': answer_sheet_layouts(len(user['exam']), page_mode), 'qr_payloads': qr_payloads}
+
+
+def render_student_document(exam_info, user, fmt='pdf', num_questions=None, page_mode=DEFAULT_PRINT_MODE):
+    """مستند طباعة الطالب (الأسئلة ثم ورقة الإجابة) كـ bytes بصيغة fmt ('pdf' أو 'tiff')، كما في --format."""
+    rendered = render_student_pages(exam_info, user, num_questions, page_mode)
+    return document_bytes(rendered['question_pages'] + rendered['answer_pages'], fmt)
+
+
+def encode_page(img, fmt='png'):
+    """ترميز صفحة مرسومة إلى bytes بأي صيغة صور يدعمها Pillow (PNG افتراضياً)."""
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def render_exam(exam_data, page_mode='RGB'):
+    """
+    رسم امتحان كامل من قاموس في الذاكرة: exam_data هو محتوى "data" في ملف الامتحان (الصيغة الأصلية أو المختصرة
+    ذات models). مولّد يُرجع (الطالب، نتيجة render_student_pages) بترتيب الطلاب، طالباً تلو الآخر حتى لا تُجمع
+    صفحات الجميع في الذاكرة. الطلاب ذوو البيانات الناقصة يُتخطون، وعدد الأسئلة في QR هو عدد أسئلة أول طالب
+    كما في generate_all_exam_sheets.
+    """
+    meta = {key: value for key, value in exam_data.items() if key not in ('users', 'models')}
+    exam_info = exam_info_from_meta(meta)
+    models = exam_data.get('models') or {}
+    num_questions = None
+    for user in exam_data.get('users') or []:
+        user = {**user, 'exam': resolve_user_exam(user, models, meta)}
+        if num_questions is None:
+            num_questions = len(user['exam'])
+        if not user.get('id') or not user['exam']:
+            continue
+        yield user, render_student_pages(exam_info, user, num_questions, page_mode)
+
+
+def generate_all_exam_sheets(workers=1, debug_qr=False, bubble_json=False, force=False,
+                             metrics_path=None, profile_ids=None, profile_dir=None,
+                             page_format='png', page_mode=None, print_batch=0,
+                             tile_cache_bytes=QUESTION_TILE_CACHE_BYTES, json_file=JSON_FILE, output_dir=OUTPUT_DIR):
+    """
+    المرور على بيانات الامتحان وإنشاء ملفي صورة (الأسئلة والإجابة) لكل طالب، مع تسجيل تخطيط الفقاعات المشترك.
+    عند workers > 1 يتم توزيع الطلاب على مجمع عمليات (Process Pool) ويُرسم كل طالب بشكل مستقل.
+    يُقرأ ملف JSON تدريجياً (طالب تلو الآخر) حتى تبقى الذاكرة ثابتة مهما زاد عدد الطلاب.
+    سجل التوليد (GenerationManifest) يتخطى الطلاب الذين لم تتغير مدخلاتهم، ويسمح باستئناف تشغيل متوقف؛
+    force=True يعيد توليد الجميع.
+    metrics_path يفعّل قياس زمن المراحل ويصدرها في نهاية التشغيل، و profile_ids (أرقام طلاب) تُحلل أداءها
+    بـ cProfile/tracemalloc في profile_dir.
+    page_format: 'png' (صورة لكل صفحة) أو 'pdf' / 'tiff' (مستند طباعة واحد لكل طالب)، و page_mode نمط الألوان
+    (الافتراضي "RGB" لـ PNG و "1" للطباعة). print_batch > 0 يجمع كل print_batch طالباً بالترتيب في مستند دفعة
+    طباعة واحد بصيغة page_format؛ مستندات الطلاب عندها TIFF (G4) تبقى لإعادة الطباعة والتوليد التزايدي.
+    tile_cache_bytes حد ذاكرة مربعات الأسئلة المرسومة مسبقاً لكل عملية؛ يكفي ليحوي أسئلة جميع النماذج معاً،
+    وإلا تتناوب النماذج على إخراج مربعات بعضها.
+    json_file ملف بيانات الامتحان، و output_dir مجلد الإخراج (يُنشأ عند الحاجة).
+    """
+    
+    try:
+        stream = ExamStream(json_file)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"❌ خطأ في قراءة ملف JSON: {e}")
+        return
+
+    exam_group_data = stream.meta
+    if not exam_group_data:
+        print("لا توجد بيانات امتحان رئيسية لمعالجتها.")
+        stream.close()
+        return
+
+    users = iter(stream)
+    first_user = next(users, None)
+    
+    if first_user is None:
+        print("لا توجد بيانات مستخدمين (طلاب) في ملف JSON لمعالجتها.")
+        stream.close()
+        return
+
+    users = itertools.chain([first_user], users)
+
+    exam_info = exam_info_from_meta(exam_group_data)
+    
+    num_questions_to_print = 0
+    if first_user.get('exam'):
+        num_questions_to_print = len(first_user.get('exam', []))
+
+    if not workers or workers < 1:
+        workers = os.cpu_count() or 1
+        
+    print(f"🌟 جارٍ إنشاء أوراق الامتحان (الأسئلة والإجابة لـ {num_questions_to_print} سؤال) كصور للطلاب...")
+    if workers > 1:
+        print(f"⚙️ الوضع المتوازي: {workers} عملية.")
+
+    instrumentation.enable(bool(metrics_path))
+    if page_format == 'png' and print_batch:
+        print("🛑 دفعات الطباعة تتطلب صيغة pdf أو tiff.")
+        stream.close()
+        return
+    student_format = 'tiff' if print_batch else page_format
+    options = {'capture_output': workers > 1, 'debug_qr': debug_qr, 'bubble_json': bubble_json,
+               'page_format': student_format,
+               'page_mode': page_mode or ('RGB' if page_format == 'png' else DEFAULT_PRINT_MODE),
+               'tile_cache_bytes': tile_cache_bytes,
+               'metrics': bool(metrics_path), 'profile_ids': frozenset(str(i) for i in profile_ids or ()),
+               'profile_dir': profile_dir or os.path.join(output_dir, 'profiles'), 'output_dir': output_dir}
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = GenerationManifest(output_dir)
+    fingerprint = _render_fingerprint(options)
+
+    def make_job(user):
+        # بصمة مدخلات الطالب: بياناته كاملة (مع الأسئلة) + بيانات الامتحان + بصمة الرسم المشتركة
+        with instrumentation.timer('gen.manifest_hash'):
+            digest = content_hash(fingerprint, exam_info, num_questions_to_print, user)
+        unchanged = not force and manifest.is_up_to_date(str(user.get('id')), digest)
+        return RenderJob(exam_info, user, num_questions_to_print, options, digest, unchanged)
+
+    jobs = (make_job(user) for user in users)
+
+    counts = {'ok': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0}
+    failures = []
+    start_time = time.perf_counter()
+
+    # العمليات العاملة المنسوخة (fork) تبدأ بقياسات فارغة حتى لا تُحسب قياسات العملية الرئيسية مرتين عند الدمج
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=instrumentation.reset) \
+        if workers > 1 else None
+    # النتائج تصل بترتيب الطلاب، فتُلحق مستنداتهم بدفعة الطباعة الحالية فور انتهاء كل طالب
+    batches = PrintBatchWriter(output_dir, page_format, print_batch) if print_batch else contextlib.nullcontext()
+    try:
+        if executor:
+            results = _iter_results_in_order(executor, jobs, window=workers * 2)
+        else:
+            results = ((job, _run_job(job)) for job in jobs)
+
+        with batches:
+            for index, (job, (status, message, outputs, metrics)) in enumerate(results, start=1):
+                instrumentation.merge(metrics)
+                user = job.user
+                user_name = user.get('name')
+
+                if status == 'fatal':
+                    print(f"🛑 {message}")
+                    break
+
+                if print_batch and status in ('ok', 'unchanged'):
+                    if status == 'unchanged':
+                        outputs = manifest.entries[str(user.get('id'))]['outputs']
+                    with instrumentation.timer('gen.print_batch'):
+                        batches.add_document(next(path for path in outputs if path.endswith('.tiff')))
+
+                counts[status] += 1
+                if status == 'ok':
+                    manifest.record(str(user.get('id')), job.digest, outputs, _student_requires(user, output_dir))
+                    print(f"[{index}] ✅ {user_name}")
+                elif status == 'unchanged':
+                    print(f"[{index}] ⏭️ {user_name} (بدون تغيير)")
+                elif status == 'skipped':
+                    print(f"[{index}] ⚠️ تنبيه: تم تخطي الطالب {user_name} - البيانات غير كاملة.")
+                else:
+                    failures.append((user.get('id'), user_name, message))
+                    print(f"[{index}] 🛑 خطأ أثناء إنشاء الصورة للطالب {user_name}: {message}")
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        # التوقف قبل آخر طالب (خطأ قاتل أو مقاطعة) لا يستنفد القارئ فيغلقه
+        stream.close()
+        manifest.compact()
+
+    elapsed = time.perf_counter() - start_time
+    rate = counts['ok'] / elapsed if elapsed > 0 else 0.0
+
+    print("\n📋 ملخص التنفيذ:")
+    print(f"   ✅ أعيد توليده: {counts['ok']}  |  ⏭️ بدون تغيير: {counts['unchanged']}  |  "
+          f"⚠️ متخطى: {counts['skipped']}  |  🛑 فاشل: {counts['failed']}")
+    print(f"   ⏱️ الزمن: {elapsed:.1f} ثانية ({rate:.2f} طالب/ثانية)")
+    for user_id, user_name, message in failures:
+        print(f"   - {user_id} | {user_name}: {message}")
+
+    if metrics_path:
+        instrumentation.write_metrics(metrics_path, {'pipeline': 'generate', 'workers': workers,
+                                                     'elapsed_s': round(elapsed, 3), **counts})
+        print(f"   📈 القياسات: {metrics_path}")
+
+    # في الوضع المتوازي لكل عملية ذاكرتها المؤقتة الخاصة، لذا تُعرض الإحصائيات للوضع التسلسلي فقط
+    if not executor:
+        for name, info in render_cache_stats().items():
+            print(f"   🗃️ {name}: hits={info['hits']} misses={info['misses']} size={info['currsize']}"
+                  + (f" ({info['bytes'] / (1024 * 1024):.1f} MB، محذوف {info['evictions']})" if 'bytes' in info else ""))
+
+    return counts
+
+# --- تشغيل البرنامج ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="إنشاء أوراق الأسئلة والإجابة لكل طالب.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="عدد العمليات المتوازية (0 = عدد أنوية المعالج).")
+    parser.add_argument('--debug-qr', action='store_true',
+                        help="حفظ صور QR كملفات PNG في مجلد الإخراج للفحص.")
+    parser.add_argument('--bubble-json', action='store_true',
+                        help="حفظ ملف BubbleData JSON لكل طالب أيضاً (الصيغة القديمة).")
+    parser.add_argument('--force', action='store_true',
+                        help="إعادة توليد جميع الطلاب وتجاهل سجل التوليد.")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="تفعيل قياس زمن المراحل وتصديره (JSON lines، أو Prometheus إذا انتهى المسار بـ .prom).")
+    parser.add_argument('--profile-students', metavar='IDS',
+                        help="أرقام طلاب مفصولة بفواصل لتحليلهم بـ cProfile/tracemalloc.")
+    parser.add_argument('--profile-dir', help="مجلد ملفات التحليل (الافتراضي: مجلد الإخراج/profiles).")
+    parser.add_argument('--format', choices=PAGE_FORMATS, default='png',
+                        help="صيغة الإخراج: png (صورة لكل صفحة) أو pdf / tiff (مستند طباعة متعدد الصفحات لكل طالب).")
+    parser.add_argument('--mode', choices=PAGE_MODES,
+                        help="نمط ألوان الصفحات (الافتراضي RGB لـ png و 1 أي أبيض وأسود لـ pdf/tiff).")
+    parser.add_argument('--print-batch', type=int, default=0, metavar='N',
+                        help="جمع كل N طالباً في مستند طباعة واحد (PrintBatch_001.pdf ...)؛ يتطلب --format pdf أو tiff.")
+    parser.add_argument('--input', default=JSON_FILE, help="ملف بيانات الامتحان (JSON).")
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help="مجلد الإخراج (يُنشأ عند الحاجة).")
+    parser.add_argument('--tile-cache-mb', type=int, default=QUESTION_TILE_CACHE_BYTES // (1024 * 1024),
+                        help="حد ذاكرة مربعات الأسئلة المرسومة مسبقاً لكل عملية بالميغابايت (0 = تعطيل).")
+    args = parser.parse_args()
+
+    if not os.path.exists(FONT_PATH):
+        print(f"🛑 خطأ فادح: ملف الخط '{FONT_PATH}' غير موجود.")
+    else:
+        generate_all_exam_sheets(workers=args.workers, debug_qr=args.debug_qr, bubble_json=args.bubble_json,
+                                 force=args.force, metrics_path=args.metrics,
+                                 profile_ids=args.profile_students.split(',') if args.profile_students else None,
+                                 profile_dir=args.profile_dir, page_format=args.format, page_mode=args.mode,
+                                 print_batch=args.print_batch, tile_cache_bytes=args.tile_cache_mb * 1024 * 1024,
+                                 json_file=args.input, output_dir=args.output_dir)
@@ -0,0 +1,213 @@
+import json
+import os
+
+from bubble_layout import OPTION_LETTERS
+from lazy_import import lazy_import
+
+np = lazy_import('numpy')
+
+# --- تصحيح الإجابات دفعة واحدة (Vectorized Grading) ---
+# إجابات كل الطلاب تُرمَّز كمصفوفة أعداد صغيرة (الطلاب × الأسئلة)، ومفاتيح الإجابة كمصفوفة (النماذج × الأسئلة)،
+# ثم تُحسب الدرجات وصحة كل سؤال والمجاميع بعمليات NumPy على المصفوفات كاملة بدلاً من حلقة لكل طالب.
+#
+# ملف مفاتيح الإجابة: لكل نموذج قائمة حروف بترتيب الأسئلة، أو قاموس {رقم السؤال: الحرف}.
+# السؤال الذي لا مفتاح له (null أو "") لا يدخل في التصحيح:
+#   {"Group A": ["A", "C", "B", ...], "Group B": {"1": "D", "2": "A", ...}}
+
+GRADES_FILE = 'grades.json'
+# حقول درجة الطالب المرفقة بسجل الورقة في التصحيح الفوري (الاستقبال المستمر وخدمة المسح)
+GRADE_FIELDS = ("graded", "score", "max_score", "percent", "wrong", "unanswered")
+
+# ترميز الإجابات داخل المصفوفات
+UNANSWERED_CODE = -1
+NO_KEY_CODE = -2
+LETTER_CODES = {letter: code for code, letter in enumerate(OPTION_LETTERS)}
+
+
+def load_answer_keys(path):
+    """تحميل مفاتيح الإجابة لكل نموذج من ملف JSON. تُرجع قاموساً فارغاً عند الفشل."""
+    if not path:
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"❌ خطأ في قراءة ملف مفاتيح الإجابة {path}: {e}")
+        return {}
+
+
+def _key_items(key):
+    """(رقم السؤال، الحرف) لمفتاح نموذج واحد سواء كان قائمة أو قاموساً."""
+    if isinstance(key, dict):
+        return [(int(q), letter) for q, letter in key.items()]
+    return [(q, letter) for q, letter in enumerate(key, start=1)]
+
+
+def key_length(key):
+    """عدد أسئلة مفتاح نموذج واحد: أعلى رقم سؤال له حرف إجابة (0 للمفتاح الفارغ)."""
+    return max((q_num for q_num, letter in _key_items(key or []) if letter in LETTER_CODES), default=0)
+
+
+def build_key_matrix(answer_keys, model_names, num_questions):
+    """
+    مصفوفة المفاتيح (النماذج + 1، الأسئلة) بنوع int8. الصف الأخير للأوراق بلا نموذج معروف
+    ولا يحتوي مفاتيح، فيُرجَع لها صفر من صفر بدلاً من درجة خاطئة.
+    num_questions لا يقل عن أطول مفتاح (انظر key_length)، وإلا سقطت أسئلته الأخيرة من التصحيح.
+    """
+    keys = np.full((len(model_names) + 1, num_questions), NO_KEY_CODE, dtype=np.int8)
+    for row, model in enumerate(model_names):
+        for q_num, letter in _key_items(answer_keys.get(model) or []):
+            if 1 <= q_num <= num_questions and letter in LETTER_CODES:
+                keys[row, q_num - 1] = LETTER_CODES[letter]
+    return keys
+
+
+def build_answer_matrix(records, min_questions=0):
+    """
+    بناء مصفوفة الإجابات (الطلاب × الأسئلة) من سجلات المسح دفعة واحدة.
+    كل سجل يحمل "answers" كقائمة {"id", "answer"} و "model_type".
+    عدد الأسئلة أعلى رقم سؤال مقروء، ولا يقل عن min_questions (طول مفاتيح الإجابة)، فالأسئلة التي لم تُقرأ
+    (مثل صفحات ناقصة في ورقة مدمجة) تُحسب بلا إجابة بدلاً من أن تسقط من التصحيح.
+    تُرجع (answers int8 (S, Q)، model_types قائمة بطول S، num_questions).
+    """
+    lengths = np.fromiter((len(r["answers"]) for r in records), dtype=np.int64, count=len(records))
+    question_ids = np.fromiter((a["id"] for r in records for a in r["answers"]), dtype=np.int64, count=int(lengths.sum()))
+    num_questions = max(int(question_ids.max()) if question_ids.size else 0, min_questions)
+
+    answers = np.full((len(records), num_questions), UNANSWERED_CODE, dtype=np.int8)
+    if question_ids.size:
+        codes = np.fromiter((LETTER_CODES.get(a["answer"], UNANSWERED_CODE) for r in records for a in r["answers"]),
+                            dtype=np.int8, count=question_ids.size)
+        rows = np.repeat(np.arange(len(records)), lengths)
+        answers[rows, question_ids - 1] = codes
+
+    return answers, [r.get("model_type") for r in records], num_questions
+
+
+def grade_matrix(answers, model_index, keys):
+    """
+    تصحيح مصفوفة الإجابات (S, Q) مقابل مصفوفة المفاتيح (M, Q) حيث model_index (S,) هو صف مفتاح كل طالب.
+    تُرجع قاموس مصفوفات: correct / wrong / unanswered (S, Q) منطقية، scores و max_scores (S,)،
+    وإحصائيات كل سؤال question_correct و question_scored (Q,).
+    """
+    student_keys = keys[model_index]
+    scored = student_keys != NO_KEY_CODE
+    correct = (answers == student_keys) & scored
+    unanswered = (answers == UNANSWERED_CODE) & scored
+    wrong = scored & ~correct & ~unanswered
+
+    return {
+        "correct": correct,
+        "wrong": wrong,
+        "unanswered": unanswered,
+        "scores": correct.sum(axis=1),
+        "max_scores": scored.sum(axis=1),
+        "question_correct": correct.sum(axis=0),
+        "question_scored": scored.sum(axis=0),
+    }
+
+
+def grade_records(records, answer_keys):
+    """
+    تصحيح سجلات المسح الناجحة (status == 'ok') لكل النماذج معاً.
+    تُرجع قاموس التقرير: درجات الطلاب، ملخص كل نموذج، ونسبة الإجابة الصحيحة لكل سؤال.
+    """
+    ok_records = [r for r in records if r.get("status", "ok") == "ok"]
+    model_names = sorted(answer_keys)
+    longest_key = max((key_length(answer_keys[model]) for model in model_names), default=0)
+    answers, model_types, num_questions = build_answer_matrix(ok_records, longest_key)
+
+    model_rows = {model: row for row, model in enumerate(model_names)}
+    model_index = np.array([model_rows.get(m, len(model_names)) for m in model_types], dtype=np.int64)
+
+    keys = build_key_matrix(answer_keys, model_names, num_questions)
+    result = grade_matrix(answers, model_index, keys)
+
+    scores = result["scores"]
+    max_scores = result["max_scores"]
+    percents = np.divide(scores * 100.0, max_scores, out=np.zeros(len(scores)), where=max_scores > 0)
+    num_wrong = result["wrong"].sum(axis=1)
+    num_unanswered = result["unanswered"].sum(axis=1)
+
+    students = []
+    for i, record in enumerate(ok_records):
+        student = record.get("student") or {}
+        students.append({
+            "id": student.get("id"),
+            "name": student.get("name"),
+            "model_type": model_types[i],
+            "source": record.get("source"),
+            "graded": bool(max_scores[i]),
+            "score": int(scores[i]),
+            "max_score": int(max_scores[i]),
+            "percent": round(float(percents[i]), 2),
+            "wrong": int(num_wrong[i]),
+            "unanswered": int(num_unanswered[i]),
+        })
+
+    models = {}
+    for row, model in enumerate(model_names):
+        in_model = model_index == row
+        if in_model.any():
+            models[model] = {
+                "students": int(in_model.sum()),
+                "mean_score": round(float(scores[in_model].mean()), 2),
+                "max_score": int(max_scores[in_model].max()),
+            }
+
+    question_scored = result["question_scored"]
+    question_rate = np.divide(result["question_correct"], question_scored,
+                              out=np.zeros(num_questions), where=question_scored > 0)
+
+    return {
+        "num_students": len(students),
+        "num_ungraded": int((max_scores == 0).sum()),
+        "models": models,
+        "question_correct_rate": [round(float(rate), 4) if scored else None
+                                  for rate, scored in zip(question_rate.tolist(), question_scored.tolist())],
+        "students": students,
+    }
+
+
+def load_scan_records(path):
+    """
+    تحميل سجلات المسح من ملف batch_results.json (المفتاح results) أو من ملف الإجابات
+    بالبنية المطلوبة (data.users[].exam[].answer).
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    if "results" in data:
+        return data["results"]
+
+    records = []
+    for user in data.get("data", {}).get("users", []):
+        exam = (user.get("exam") or [{}])[0]
+        records.append({
+            "status": "ok",
+            "student": {"id": user.get("id"), "name": user.get("name")},
+            "model_type": user.get("model_type", data["data"].get("model_type")),
+            "answers": exam.get("answer", []),
+        })
+    return records
+
+
+def save_grades(report, output_path):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    return output_path
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="تصحيح نتائج المسح مقابل مفاتيح الإجابة لكل نموذج.")
+    parser.add_argument('results', help="ملف batch_results.json أو ملف الإجابات بالبنية المطلوبة")
+    parser.add_argument('--answer-keys', required=True, help="ملف JSON لمفاتيح الإجابة لكل نموذج")
+    parser.add_argument('-o', '--output', default=GRADES_FILE, help="مسار ملف الدرجات الناتج")
+    args = parser.parse_args()
+
+    report = grade_records(load_scan_records(args.results), load_answer_keys(args.answer_keys))
+    save_grades(report, args.output)
+    print(f"✅ تم تصحيح {report['num_students']} ورقة (بدون مفتاح: {report['num_ungraded']}) في: {args.output}")
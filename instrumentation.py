@@ -0,0 +1,182 @@
+import contextlib
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+# --- قياس زمن المراحل والعدادات (Instrumentation) ---
+# مؤقتات وعدادات مسماة حول مراحل التوليد والمسح. عند التعطيل (الافتراضي) يعيد timer() كائناً ثابتاً لا يفعل شيئاً،
+# فتبقى الكلفة استدعاء دالة واحداً لكل مرحلة. كل عملية عاملة تجمع قياساتها محلياً، وتُرسلها مع نتيجة المهمة
+# عبر drain() لتُدمج في العملية الرئيسية بـ merge()، ثم تُصدّر في نهاية التشغيل كـ JSON lines أو Prometheus.
+
+PROFILE_TOP_N = 25
+
+ENABLED = False
+
+# الاسم -> [عدد المرات، الزمن الكلي، أقصى زمن] (بالثواني)
+_TIMERS = {}
+# الاسم -> القيمة
+_COUNTERS = {}
+
+
+def enable(flag=True):
+    global ENABLED
+    ENABLED = bool(flag)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timer(name):
+    """مؤقت مسمى للاستخدام مع with؛ لا يقيس شيئاً عند التعطيل."""
+    return _Timer(name) if ENABLED else _NULL_TIMER
+
+
+def add_time(name, seconds):
+    stats = _TIMERS.get(name)
+    if stats is None:
+        _TIMERS[name] = [1, seconds, seconds]
+    else:
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+
+
+def count(name, value=1):
+    """زيادة عداد مسمى (لا شيء عند التعطيل)."""
+    if ENABLED:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def drain():
+    """إرجاع قياسات العملية الحالية وتصفيرها (تُرسل من العمليات العاملة مع كل نتيجة). None عند التعطيل."""
+    if not ENABLED:
+        return None
+    data = {'timers': {name: list(stats) for name, stats in _TIMERS.items()}, 'counters': dict(_COUNTERS)}
+    _TIMERS.clear()
+    _COUNTERS.clear()
+    return data
+
+
+def merge(data):
+    """دمج قياسات مرسلة من عملية عاملة في قياسات العملية الحالية."""
+    if not data:
+        return
+    for name, (calls, total, peak) in data['timers'].items():
+        stats = _TIMERS.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += calls
+        stats[1] += total
+        stats[2] = max(stats[2], peak)
+    for name, value in data['counters'].items():
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def reset():
+    _TIMERS.clear()
+    _COUNTERS.clear()
+
+
+def snapshot():
+    """القياسات الحالية كقاموس: timers (calls, total_s, mean_ms, max_ms) و counters."""
+    return {
+        'timers': {
+            name: {'calls': calls, 'total_s': round(total, 6), 'mean_ms': round(total / calls * 1000, 4),
+                   'max_ms': round(peak * 1000, 4)}
+            for name, (calls, total, peak) in sorted(_TIMERS.items())
+        },
+        'counters': dict(sorted(_COUNTERS.items())),
+    }
+
+
+def _prometheus_name(name):
+    return ''.join(ch if ch.isalnum() else '_' for ch in name)
+
+
+def prometheus_text(data=None):
+    """القياسات (snapshot) بصيغة Prometheus النصية."""
+    data = data or snapshot()
+    lines = ["# TYPE omr_stage_seconds_total counter"]
+    lines += [f'omr_stage_seconds_total{{stage="{name}"}} {stats["total_s"]}' for name, stats in data['timers'].items()]
+    lines.append("# TYPE omr_stage_calls_total counter")
+    lines += [f'omr_stage_calls_total{{stage="{name}"}} {stats["calls"]}' for name, stats in data['timers'].items()]
+    lines.append("# TYPE omr_stage_seconds_max gauge")
+    lines += [f'omr_stage_seconds_max{{stage="{name}"}} {round(stats["max_ms"] / 1000, 7)}'
+              for name, stats in data['timers'].items()]
+    for name, value in data['counters'].items():
+        metric = f"omr_{_prometheus_name(name)}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, run_info=None):
+    """
+    تصدير القياسات في نهاية التشغيل. الامتداد .prom يعني صيغة Prometheus النصية،
+    وغير ذلك JSON lines (سطر لكل مؤقت وعداد، بعد سطر وصف التشغيل).
+    """
+    data = snapshot()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        if path.endswith('.prom'):
+            f.write(prometheus_text(data))
+        else:
+            f.write(json.dumps({'type': 'run', 'time': time.time(), **(run_info or {})}, ensure_ascii=False) + '\n')
+            for name, stats in data['timers'].items():
+                f.write(json.dumps({'type': 'timer', 'name': name, **stats}, ensure_ascii=False) + '\n')
+            for name, value in data['counters'].items():
+                f.write(json.dumps({'type': 'counter', 'name': name, 'value': value}, ensure_ascii=False) + '\n')
+    return path
+
+
+@contextlib.contextmanager
+def profiled(label, output_dir):
+    """
+    تشغيل كتلة تحت cProfile و tracemalloc (لطالب أو ورقة مختارة فقط)، وحفظ:
+    <label>.prof (يُفتح بـ pstats أو snakeviz) و <label>_memory.txt (أكبر مواقع حجز الذاكرة).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        memory = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+
+        profiler.dump_stats(os.path.join(output_dir, f"{label}.prof"))
+        with open(os.path.join(output_dir, f"{label}_memory.txt"), 'w', encoding='utf-8') as f:
+            f.write(f"peak traced memory: {peak / 1024:.1f} KiB\n")
+            for stat in memory.statistics('lineno')[:PROFILE_TOP_N]:
+                f.write(f"{stat}\n")
@@ -0,0 +1,37 @@
+import importlib.util
+import sys
+
+# --- الاستيراد المؤجل للمكتبات الثقيلة (Lazy Imports) ---
+# استيراد OpenCV و NumPy و Pillow و qrcode ومكتبات تشكيل العربية يستغرق معظم زمن بدء البرامج،
+# بينما يحتاج كثير من الاستخدامات (عرض --help، استيراد الوحدات كمكتبة في خادم، أدوات المخزن) بعضها فقط أو لا شيء منها.
+# lazy_import تُرجع كائن الوحدة فوراً، ولا تُنفذ الوحدة نفسها إلا عند أول وصول إلى أحد أسمائها.
+
+
+def lazy_import(name):
+    """
+    وحدة مؤجلة التحميل (importlib.util.LazyLoader) تُسجل في sys.modules فيشاركها كل من يستوردها بعدها،
+    حتى بـ "from ... import" العادية. إذا كانت الوحدة محمّلة مسبقاً تُرجع كما هي.
+    يرفع ModuleNotFoundError فوراً إذا لم تكن الوحدة مثبتة (بحث المسار فقط، دون تنفيذها).
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def preload(*modules):
+    """
+    تنفيذ وحدات مؤجلة فوراً (أي وصول إلى صفاتها يحمّلها). LazyLoader غير آمن بين الخيوط في Python 3.11:
+    وصول خيطين معاً إلى وحدة لم تُحمّل بعد قد يترك أحدهما بوحدة نصف محمّلة، لذلك تُحمّل الوحدات في الخيط
+    الرئيسي قبل تشغيل مجمع خيوط يستخدمها.
+    """
+    for module in modules:
+        getattr(module, '__dict__')
@@ -0,0 +1,380 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import generate_exams
+import omr_scanner
+from bubble_layout import OPTION_LETTERS, load_layout
+from lazy_import import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# --- قياس الأداء الشامل (Benchmark): توليد ← تظليل صناعي ← مسح ---
+# يولد قائمة طلاب صناعية بنفس بنية jsonQ.json، ويرسمها عبر create_student_exam_image / create_bubble_sheet_image،
+# ثم يظلل الفقاعات برمجياً على أوراق الإجابة (مع ضوضاء ودوران وتمويه اختيارية) ويمسحها عبر scan_image.
+# يُقارن الناتج بملف baseline محفوظ لمعرفة أثر أي تعديل على السرعة والدقة.
+
+# مجلد العمل مؤقت افتراضياً (tempfile.mkdtemp)؛ المجلد المحدد بـ --work-dir يُعلَّم بهذا الملف ليُعرف أنه للقياس
+BENCH_WORK_MARKER = '.omr_bench_work'
+BENCH_BASELINE_FILE = 'omr_bench_baseline.json'
+# الإصدار 2: مرحلة scan تقيس scan_image وحدها (الإصدار 1 كان يشمل مخزن النتائج وملفات process_omr_sheet)
+BENCH_FORMAT_VERSION = 2
+
+# نسبة التراجع المسموح بها قبل اعتبار المقياس أسوأ من الـ baseline
+REGRESSION_TOLERANCE = 0.10
+
+# لون الحبر وهامش الدائرة المظللة داخل الفقاعة
+FILL_INK = 40
+FILL_INSET = 4
+
+_WORDS = ['ما', 'هو', 'الحاسوب', 'وحدة', 'المعالجة', 'المركزية', 'الذاكرة', 'البيانات', 'الشبكة', 'نظام',
+          'التشغيل', 'البرمجة', 'لغة', 'الملف', 'التخزين', 'Python', 'CPU', 'RAM', 'أي', 'مما', 'يلي', 'يعتبر']
+
+
+def synthesize_roster(num_students, num_questions, num_models=4, seed=0):
+    """قائمة طلاب صناعية بنية jsonQ.json: لكل نموذج ترتيب أسئلة مختلف، وأطوال نصوص متفاوتة."""
+    rng = random.Random(seed)
+    bank = []
+    for q_id in range(1, num_questions + 1):
+        text = ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(5, 40))) + '؟'
+        bank.append({
+            "id": q_id,
+            "question_text": {"text": text, "files": []},
+            "question_type": "options",
+            "question_type_translation": "خيارات",
+            "options": [{"text": ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(1, 6))), "files": []}
+                        for _ in range(4)],
+        })
+
+    models = {}
+    for m in range(num_models):
+        order = list(range(num_questions))
+        rng.shuffle(order)
+        models[f"Group {chr(65 + m)}"] = [bank[i] for i in order]
+
+    model_names = sorted(models)
+    users = []
+    for student_id in range(1, num_students + 1):
+        model = model_names[(student_id - 1) % num_models]
+        users.append({"id": student_id, "name": f"طالب {student_id}", "model_type": model, "exam": models[model]})
+
+    return {"data": {"stage": "stage 1", "subject_id": 1, "subject_name": "اختبار", "exam_info": {"id": 1},
+                     "n_of_Q": 1, "model_type": model_names[0], "number_of_groups": str(num_models),
+                     "number_of_questions": num_questions, "users": users}}
+
+
+def fill_answer_sheet(sheet_path, layout, answers, out_path, rotation=0.0, noise=0.0, blur=0.0, rng=None):
+    """
+    تظليل الفقاعات على صفحة ورقة الإجابة المولدة (answers: رقم الخيار أو None لكل سؤال في الامتحان كله،
+    تُظلل منها أسئلة تخطيط الصفحة فقط)، ثم محاكاة المسح: هامش أبيض، دوران بزاوية عشوائية ضمن ±rotation،
+    تمويه Gaussian وضوضاء.
+    """
+    rng = rng or np.random.default_rng()
+    img = cv2.imread(sheet_path, cv2.IMREAD_GRAYSCALE)
+    for row, q_num in enumerate(layout['question_nums'].tolist()):
+        option = answers[q_num - 1]
+        if option is None:
+            continue
+        x_min, y_min, x_max, y_max = (int(v) for v in layout['bboxes'][row, option])
+        cv2.circle(img, ((x_min + x_max) // 2, (y_min + y_max) // 2), (x_max - x_min) // 2 - FILL_INSET, FILL_INK, -1)
+
+    img = cv2.copyMakeBorder(img, 40, 40, 40, 40, cv2.BORDER_CONSTANT, value=255)
+    if rotation:
+        h, w = img.shape
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), float(rng.uniform(-rotation, rotation)), 1.0)
+        img = cv2.warpAffine(img, matrix, (w, h), borderValue=255)
+    if blur:
+        img = cv2.GaussianBlur(img, (0, 0), blur)
+    if noise:
+        img = np.clip(img + rng.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+    cv2.imwrite(out_path, img)
+
+
+def percentiles(samples):
+    """p50 / p90 / p99 / max بالمللي ثانية."""
+    if not samples:
+        return None
+    values = np.asarray(samples) * 1000.0
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50_ms": round(float(p50), 2), "p90_ms": round(float(p90), 2),
+            "p99_ms": round(float(p99), 2), "max_ms": round(float(values.max()), 2)}
+
+
+def peak_rss_mb():
+    """أقصى ذاكرة مقيمة للعملية (MB)، أو None إذا لم تتوفر الوحدة resource (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss بالكيلوبايت على Linux وبالبايت على macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def prepare_work_dir(work_dir=None):
+    """
+    تجهيز مجلد العمل وتعليمه بـ BENCH_WORK_MARKER. تُرجع (المسار، owned): owned يعني أن القياس أنشأه
+    (مؤقت أو غير موجود سابقاً أو من قياس سابق) فيُحذف كاملاً في النهاية، وإلا (مجلد فارغ موجود) تُحذف محتوياته فقط.
+    ترفع ValueError لمجلد موجود غير فارغ لم ينشئه القياس، بدلاً من مسح محتوياته.
+    """
+    if work_dir is None:
+        work_dir, owned = tempfile.mkdtemp(prefix='omr_bench_'), True
+    elif os.path.exists(os.path.join(work_dir, BENCH_WORK_MARKER)):
+        shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        owned = True
+    elif os.path.exists(work_dir):
+        if not os.path.isdir(work_dir) or os.listdir(work_dir):
+            raise ValueError(f"مجلد العمل {work_dir} موجود وغير فارغ ولم ينشئه القياس؛ اختر مجلداً جديداً أو فارغاً")
+        owned = False
+    else:
+        os.makedirs(work_dir)
+        owned = True
+    open(os.path.join(work_dir, BENCH_WORK_MARKER), 'w').close()
+    return work_dir, owned
+
+
+def clean_work_dir(work_dir, owned):
+    if owned:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return
+    for entry in os.scandir(work_dir):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+
+
+def run_benchmark(num_students=20, num_questions=60, num_models=4, rotation=2.0, noise=4.0, blur=0.0,
+                  blank_ratio=0.2, seed=0, work_dir=None, keep=False):
+    """
+    تشغيل القياس كاملاً وإرجاع تقرير النتائج كقاموس. work_dir=None يعمل في مجلد مؤقت يُحذف في النهاية
+    (انظر prepare_work_dir)، و keep يبقي الصور المولدة في work_dir.
+    """
+    rng = np.random.default_rng(seed)
+    roster = synthesize_roster(num_students, num_questions, num_models, seed)
+    exam_meta = roster["data"]
+    exam_info = {'stage': exam_meta['stage'], 'subject_name': exam_meta['subject_name'],
+                 'subject_id': exam_meta['subject_id'], 'model_type': exam_meta['model_type'],
+                 'exam_id': exam_meta['exam_info']['id']}
+
+    stages = {"render_questions": [], "render_answer_sheet": [], "fill": [], "scan": []}
+    # ورقة الإجابة الأطول من BUBBLE_QUESTIONS_PER_PAGE سؤالاً تُولد وتُظلل وتُمسح صفحة صفحة، لكل صفحة تخطيطها و QR خاص بها
+    pages = generate_exams.answer_sheet_pages(num_questions)
+    num_pages = num_students * len(pages)
+    correct = 0
+    total = 0
+    exact_sheets = 0
+    flagged_sheets = 0
+    flagged_questions = 0
+    qr_ok = 0
+
+    work_dir, owned = prepare_work_dir(work_dir)
+    # السكربتات تستخدم مسارات نسبية (مجلد الإخراج، سجل التخطيطات، ملفات الناتج)، لذا يتم التشغيل داخل مجلد العمل
+    previous_font_path = generate_exams.FONT_PATH
+    generate_exams.FONT_PATH = os.path.abspath(generate_exams.FONT_PATH)
+    previous_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        os.makedirs(generate_exams.OUTPUT_DIR, exist_ok=True)
+
+        # 1. التوليد
+        render_start = time.perf_counter()
+        sheets = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for user in exam_meta["users"]:
+                model = user["model_type"]
+                page_qrcodes = [generate_exams.generate_qrcode(
+                                    generate_exams.build_qr_payload(exam_info, user, model, num_questions, page))
+                                for page in range(1, len(pages) + 1)]
+                base = os.path.join(generate_exams.OUTPUT_DIR, f"bench_{user['id']}.png")
+
+                t = time.perf_counter()
+                generate_exams.create_student_exam_image(exam_info, user, base, page_qrcodes[0])
+                stages["render_questions"].append(time.perf_counter() - t)
+
+                t = time.perf_counter()
+                generate_exams.create_bubble_sheet_image(exam_info, user, base, page_qrcodes[0],
+                                                         page_qrcodes=page_qrcodes)
+                stages["render_answer_sheet"].append(time.perf_counter() - t)
+                if len(pages) == 1:
+                    sheets.append((user, [base.replace('.png', '_AnswerSheet.png')]))
+                else:
+                    sheets.append((user, [base.replace('.png', f'_AnswerSheet_Page_{page}.png')
+                                          for page in range(1, len(pages) + 1)]))
+        render_seconds = time.perf_counter() - render_start
+
+        layouts = [load_layout(generate_exams.bubble_layout_id(count, first), omr_scanner.LAYOUT_SEARCH_DIR)
+                   for first, count in pages]
+
+        # 2. التظليل الصناعي (كل صفحة بتخطيطها)
+        scans = []
+        for user, sheet_paths in sheets:
+            answers = [None if rng.random() < blank_ratio else int(rng.integers(0, 4)) for _ in range(num_questions)]
+            scan_paths = []
+            for sheet_path, layout in zip(sheet_paths, layouts):
+                scan_path = sheet_path.replace('.png', '_scan.png')
+                t = time.perf_counter()
+                fill_answer_sheet(sheet_path, layout, answers, scan_path, rotation, noise, blur, rng)
+                stages["fill"].append(time.perf_counter() - t)
+                scan_paths.append(scan_path)
+            scans.append((user, scan_paths, [OPTION_LETTERS[a] if a is not None else "Unanswered" for a in answers]))
+
+        # 3. المسح: كل صفحات الطالب، ثم دمج إجاباتها حسب رقم السؤال قبل المقارنة.
+        # يُقاس التعرف وحده (scan_image: فك الترميز، QR، التسجيل، الاستخراج) من محتوى الملف في الذاكرة، دون
+        # مخزن النتائج وملفات الإخراج في process_omr_sheet التي يتبع زمنها عدد الأوراق المخزنة وسرعة القرص
+        for user, scan_paths, expected in scans:
+            scanned_answers = []
+            identified = True
+            for scan_path in scan_paths:
+                with open(scan_path, 'rb') as f:
+                    content = f.read()
+                t = time.perf_counter()
+                record = omr_scanner.scan_image(content, layout_dir=omr_scanner.LAYOUT_SEARCH_DIR, name=scan_path)
+                stages["scan"].append(time.perf_counter() - t)
+
+                scanned_answers += record["answers"] if record["status"] == "ok" else []
+                identified = identified and (record.get("student") or {}).get("id") == user["id"]
+            scanned_answers.sort(key=lambda a: a["id"])
+            got = [a["answer"] for a in scanned_answers]
+            flagged = sum(1 for a in scanned_answers if a.get("flags"))
+            flagged_questions += flagged
+            flagged_sheets += flagged > 0
+            matches = sum(1 for g, e in zip(got, expected) if g == e)
+            correct += matches
+            total += len(expected)
+            exact_sheets += matches == len(expected)
+            qr_ok += identified
+        scan_seconds = sum(stages["scan"])
+    finally:
+        os.chdir(previous_cwd)
+        generate_exams.FONT_PATH = previous_font_path
+        if not keep:
+            clean_work_dir(work_dir, owned)
+
+    return {
+        "version": BENCH_FORMAT_VERSION,
+        "params": {"students": num_students, "questions": num_questions, "models": num_models, "rotation": rotation,
+                   "noise": noise, "blur": blur, "blank_ratio": blank_ratio, "seed": seed},
+        "throughput": {
+            "students_per_second": round(num_students / render_seconds, 3) if render_seconds else None,
+            "sheets_per_second": round(num_pages / scan_seconds, 3) if scan_seconds else None,
+        },
+        "stages": {name: percentiles(samples) for name, samples in stages.items()},
+        "peak_rss_mb": peak_rss_mb(),
+        "accuracy": {
+            "answers": round(correct / total, 5) if total else None,
+            "exact_sheets": round(exact_sheets / num_students, 5) if num_students else None,
+            "qr_identity": round(qr_ok / num_students, 5) if num_students else None,
+        },
+        # نسبة ما يُرسل للمراجعة اليدوية (أسئلة مشكوك فيها)
+        "review": {
+            "sheets": round(flagged_sheets / num_students, 5) if num_students else None,
+            "questions": round(flagged_questions / total, 5) if total else None,
+        },
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    مقارنة التقرير بالـ baseline. تُرجع قائمة (المقياس، القديم، الجديد، نسبة التغير، تراجع؟).
+    المقاييس الأعلى أفضل: الإنتاجية والدقة؛ والأقل أفضل: زمن المراحل (p50) والذاكرة.
+    """
+    rows = []
+
+    def add(name, old, new, higher_is_better):
+        if old is None or new is None:
+            return
+        change = (new - old) / old if old else 0.0
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        if name.startswith('accuracy.'):
+            # أي انخفاض في الدقة يُعتبر تراجعاً
+            regressed = new < old
+        rows.append((name, old, new, change, regressed))
+
+    for key in ("students_per_second", "sheets_per_second"):
+        add(f"throughput.{key}", baseline["throughput"].get(key), report["throughput"].get(key), True)
+    for stage, stats in report["stages"].items():
+        old_stats = baseline["stages"].get(stage)
+        if stats and old_stats:
+            add(f"stages.{stage}.p50_ms", old_stats["p50_ms"], stats["p50_ms"], False)
+    add("peak_rss_mb", baseline.get("peak_rss_mb"), report.get("peak_rss_mb"), False)
+    for key in ("answers", "exact_sheets", "qr_identity"):
+        add(f"accuracy.{key}", baseline["accuracy"].get(key), report["accuracy"].get(key), True)
+    return rows
+
+
+def print_report(report):
+    print("\n📊 نتائج القياس:")
+    print(f"   ⚙️ {report['params']}")
+    print(f"   🚀 التوليد: {report['throughput']['students_per_second']} طالب/ثانية | "
+          f"المسح: {report['throughput']['sheets_per_second']} ورقة/ثانية")
+    for stage, stats in report["stages"].items():
+        if stats:
+            print(f"   ⏱️ {stage}: p50={stats['p50_ms']} p90={stats['p90_ms']} p99={stats['p99_ms']} max={stats['max_ms']} ms")
+    print(f"   🧠 أقصى ذاكرة: {report['peak_rss_mb']} MB")
+    accuracy = report["accuracy"]
+    print(f"   🎯 الدقة: الإجابات {accuracy['answers']} | الأوراق المطابقة {accuracy['exact_sheets']} | "
+          f"هوية QR {accuracy['qr_identity']}")
+    review = report.get("review") or {}
+    print(f"   🔍 للمراجعة: الأوراق {review.get('sheets')} | الأسئلة {review.get('questions')}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="قياس أداء ودقة التوليد والمسح على بيانات صناعية.")
+    parser.add_argument('-n', '--students', type=int, default=20, help="عدد الطلاب")
+    parser.add_argument('-q', '--questions', type=int, default=60, help="عدد الأسئلة")
+    parser.add_argument('--models', type=int, default=4, help="عدد النماذج")
+    parser.add_argument('--rotation', type=float, default=2.0, help="أقصى زاوية دوران عشوائية (درجة)")
+    parser.add_argument('--noise', type=float, default=4.0, help="انحراف الضوضاء (مستويات رمادية)")
+    parser.add_argument('--blur', type=float, default=0.0, help="قوة التمويه (sigma)")
+    parser.add_argument('--blank-ratio', type=float, default=0.2, help="نسبة الأسئلة المتروكة")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help="مجلد العمل (افتراضياً مجلد مؤقت)؛ يُرفض مجلد موجود غير فارغ لم ينشئه القياس")
+    parser.add_argument('--keep', action='store_true', help="الإبقاء على الصور المولدة بعد القياس")
+    parser.add_argument('--baseline', help="ملف baseline للمقارنة")
+    parser.add_argument('--save-baseline', metavar='PATH', nargs='?', const=BENCH_BASELINE_FILE,
+                        help="حفظ النتائج كـ baseline جديد")
+    args = parser.parse_args()
+
+    if args.keep and args.work_dir is None:
+        args.work_dir = tempfile.mkdtemp(prefix='omr_bench_')
+    try:
+        report = run_benchmark(args.students, args.questions, args.models, args.rotation, args.noise, args.blur,
+                               args.blank_ratio, args.seed, args.work_dir, args.keep)
+    except ValueError as e:
+        print(f"❌ خطأ: {e}")
+        sys.exit(1)
+    print_report(report)
+    if args.keep:
+        print(f"📁 الصور المولدة في: {os.path.abspath(args.work_dir)}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("params") != report["params"]:
+            print("⚠️ تنبيه: إعدادات الـ baseline مختلفة عن إعدادات هذا القياس.")
+        if baseline.get("version") != report["version"]:
+            print(f"⚠️ تنبيه: الـ baseline بصيغة الإصدار {baseline.get('version')}، ومقاييسه غير قابلة للمقارنة مباشرة.")
+        print(f"\n📈 مقارنة مع {args.baseline}:")
+        for name, old, new, change, regressed in compare_to_baseline(report, baseline):
+            regressions += [name] if regressed else []
+            print(f"   {'🔻' if regressed else '  '} {name}: {old} -> {new} ({change:+.1%})")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+        print(f"✅ تم حفظ الـ baseline في: {args.save_baseline}")
+
+    if regressions:
+        print(f"🛑 تراجع في: {', '.join(regressions)}")
+        sys.exit(1)
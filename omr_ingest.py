@@ -0,0 +1,437 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import signal
+import time
+
+from exam_manifest import file_digest
+from grading import GRADE_FIELDS, grade_records, load_answer_keys
+from omr_scanner import (
+    LAYOUT_SEARCH_DIR, SCAN_IMAGE_EXTENSIONS, TRIAGE_DIR_NAME, PageAssembler, dedup_note, init_scan_worker,
+    load_scan_libraries, new_scan_record, precheck_file, read_scan, review_snippet_path, scan_decoded_sheet,
+    sheet_identity, triage_entries,
+)
+from results_store import RESULTS_DB_FILE, ResultsStore
+from scan_dedup import DEFAULT_RESCAN_POLICY, RESCAN_POLICIES, DedupIndex, settle_scan
+
+# --- الاستقبال المستمر لمجلدات الماسحات الضوئية (Hot Folder Ingest) ---
+# خط معالجة asyncio بمراحل منفصلة تربطها طوابير محدودة الحجم (Backpressure):
+#   مراقبة المجلد ← قراءة الصور (مجمع خيوط) ← استخراج الإجابات (مجمع عمليات) ← كتابة النتائج.
+# لا يُنقل الملف من مجلد الاستقبال إلى processed/ أو failed/ إلا بعد كتابة نتيجته، لذلك أي ملف لم يكتمل
+# (توقف أو انقطاع) يبقى في المجلد ويُعالج مجدداً عند التشغيل التالي (معالجة مرة واحدة على الأقل).
+# صفحات ورقة الإجابة متعددة الصفحات تُسجل كل منها فور وصولها، ويُضاف سطر الطالب المدمج (مع التصحيح) عند وصول
+# آخر صفحاته؛ الصفحات المعلّقة تُستعاد من سجل النتائج عند إعادة التشغيل.
+# الأسئلة المشكوك فيها تُضاف إلى طابور المراجعة triage.jsonl مع قصاصاتها في مجلد triage.
+# كل صفحة تُحفظ أيضاً في مخزن النتائج (omr_results.db) قبل نقل ملفها، وإعادة مسح الورقة تُحدّث سجلها.
+# الملف المعروف في المخزن يُتخطى قبل قراءته، وإعادة مسح ورقة مخزنة قبل استخراجها (scan_dedup)، وتُنقل
+# إلى processed/ بنتيجتها المخزنة.
+
+INGEST_OUTPUT_DIR = 'omr_ingest_results'
+INGEST_LOG_FILE = 'results.jsonl'
+TRIAGE_LOG_FILE = 'triage.jsonl'
+# قصاصات الأوراق قيد المعالجة (باسمها في مجلد الاستقبال، وهو فريد بين الأوراق الجارية) قبل نقلها إلى triage
+PENDING_SNIPPETS_DIR_NAME = '.pending'
+PROCESSED_DIR_NAME = 'processed'
+FAILED_DIR_NAME = 'failed'
+
+POLL_INTERVAL = 1.0
+# مدة بقاء حجم الملف ووقت تعديله ثابتين قبل اعتباره مكتملاً (الماسح انتهى من كتابته)
+SETTLE_SECONDS = 2.0
+# الملف غير القابل للقراءة الذي عُدّل مؤخراً قد يكون ما زال قيد الكتابة: يُؤجل حتى يتغير أو تمضي هذه المدة
+UNREADABLE_RETRY_SECONDS = 10.0
+QUEUE_SIZE = 16
+DECODE_THREADS = 2
+
+
+def decode_scan(image_path, reduce=True):
+    """
+    قراءة صورة الورقة مباشرة كصورة رمادية مصغرة إلى دقة التخطيط (read_scan)، تُنفذ داخل مجمع الخيوط
+    (OpenCV يحرر الـ GIL أثناء فك الترميز). الصورة المصغرة أصغر أيضاً في الطوابير وعند إرسالها لمجمع العمليات.
+    """
+    return read_scan(image_path, reduce=reduce)
+
+
+def _file_signature(stat):
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _is_stale(signature):
+    """هل مضت UNREADABLE_RETRY_SECONDS على آخر تعديل للملف؟"""
+    return time.time() - signature[1] / 1e9 >= UNREADABLE_RETRY_SECONDS
+
+
+def _unique_path(directory, file_name):
+    """مسار غير مستخدم داخل المجلد (الماسحات تعيد استخدام أسماء مثل scan0001.png)."""
+    stem, ext = os.path.splitext(file_name)
+    candidate = os.path.join(directory, file_name)
+    suffix = 1
+    while os.path.exists(candidate):
+        candidate = os.path.join(directory, f"{stem}_{suffix}{ext}")
+        suffix += 1
+    return candidate
+
+
+class IngestPipeline:
+    """
+    خط الاستقبال المستمر لمجلد واحد. once=True يعالج الملفات الموجودة حالياً ثم يتوقف،
+    وإلا يستمر بمراقبة المجلد حتى الإيقاف (Ctrl+C / SIGTERM) مع إنهاء الأوراق قيد المعالجة.
+    """
+
+    def __init__(self, inbox, output_dir=INGEST_OUTPUT_DIR, processed_dir=None, failed_dir=None, workers=0,
+                 decode_threads=DECODE_THREADS, queue_size=QUEUE_SIZE, poll_interval=POLL_INTERVAL,
+                 settle_seconds=SETTLE_SECONDS, once=False,
+                 json_data_path=None, layout_id=None, layout_dir=LAYOUT_SEARCH_DIR, answer_keys_path=None,
+                 full_resolution=False, rescan_policy=DEFAULT_RESCAN_POLICY):
+        self.inbox = inbox
+        self.output_dir = output_dir
+        self.processed_dir = processed_dir or os.path.join(inbox, PROCESSED_DIR_NAME)
+        self.failed_dir = failed_dir or os.path.join(inbox, FAILED_DIR_NAME)
+        self.triage_dir = os.path.join(output_dir, TRIAGE_DIR_NAME)
+        self.pending_snippets_dir = os.path.join(self.triage_dir, PENDING_SNIPPETS_DIR_NAME)
+        self.workers = workers if workers and workers > 0 else (os.cpu_count() or 1)
+        self.decode_threads = max(1, decode_threads)
+        self.queue_size = max(1, queue_size)
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.once = once
+        self.full_resolution = full_resolution
+        self.worker_args = (json_data_path, layout_id, layout_dir, answer_keys_path)
+        self.answer_keys = load_answer_keys(answer_keys_path)
+        self.rescan_policy = rescan_policy
+
+        self.counts = {'ok': 0, 'failed': 0, 'flagged': 0, 'skipped': 0}
+        self.store = None
+        self.dedup = None
+        self.assembler = PageAssembler()
+        self._in_flight = set()
+        # ملفات تعذرت قراءتها وهي حديثة التعديل: المسار -> التوقيع عند الفشل
+        self._deferred = {}
+        self._stop = None
+
+    # --- المرحلة 1: مراقبة المجلد ---
+
+    def _scan_inbox(self):
+        """الملفات الحالية في مجلد الاستقبال مع (الحجم، وقت التعديل) لكل منها."""
+        entries = {}
+        try:
+            with os.scandir(self.inbox) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.lower().endswith(SCAN_IMAGE_EXTENSIONS):
+                        entries[entry.path] = _file_signature(entry.stat())
+        except FileNotFoundError:
+            pass
+        return entries
+
+    async def _watch(self, decode_queue):
+        """
+        إضافة الملفات الجديدة إلى طابور القراءة. الملف يُعتبر جاهزاً عندما يبقى حجمه ووقت تعديله ثابتين
+        مدة settle_seconds. put على طابور ممتلئ ينتظر، فتتوقف المراقبة مؤقتاً (Backpressure).
+        """
+        # المسار -> (التوقيع، وقت آخر تغيير مُلاحظ)
+        seen = {}
+        while not self._stop.is_set():
+            current = await asyncio.to_thread(self._scan_inbox)
+            now = time.monotonic()
+            seen = {path: (sig, seen[path][1] if path in seen and seen[path][0] == sig else now)
+                    for path, sig in current.items()}
+            for path in sorted(current):
+                if path in self._in_flight:
+                    continue
+                if path in self._deferred:
+                    if self._deferred[path] == current[path] and not _is_stale(current[path]):
+                        continue
+                    del self._deferred[path]
+                if self.once or now - seen[path][1] >= self.settle_seconds:
+                    self._in_flight.add(path)
+                    await decode_queue.put((path, time.time(), current[path]))
+
+            if self.once:
+                return
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    # --- المرحلة 2: قراءة الصور (مجمع خيوط) ---
+
+    async def _decode_stage(self, decode_queue, extract_queue, write_queue, thread_pool):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await decode_queue.get()
+            if item is None:
+                return
+            path, queued_at, signature = item
+            record = new_scan_record(path)
+            try:
+                # الملف نفسه مسح سابقاً: لا قراءة ولا استخراج
+                if self.dedup is not None and not await loop.run_in_executor(thread_pool, precheck_file, path,
+                                                                             record, self.dedup):
+                    await write_queue.put((path, queued_at, record))
+                    continue
+                gray = await loop.run_in_executor(thread_pool, decode_scan, path,
+                                                  not self.full_resolution)
+            except Exception as e:
+                gray = None
+                error = f"{type(e).__name__}: {e}"
+            else:
+                error = "could not read image"
+
+            if gray is None and not self.once and not _is_stale(signature):
+                # ربما ما زال قيد الكتابة: يُترك للمراقبة لتعيده عند تغيّره، أو يُعتبر فاشلاً بعد مدة الانتظار
+                self._deferred[path] = signature
+                self._in_flight.discard(path)
+            elif gray is None:
+                record["error"] = error
+                await write_queue.put((path, queued_at, record))
+            else:
+                await extract_queue.put((path, queued_at, gray, record["image_sha256"]))
+
+    # --- المرحلة 3: استخراج الإجابات (مجمع عمليات) ---
+
+    async def _extract_stage(self, extract_queue, write_queue, process_pool):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await extract_queue.get()
+            if item is None:
+                return
+            path, queued_at, gray, image_sha256 = item
+            try:
+                record = await loop.run_in_executor(process_pool, scan_decoded_sheet,
+                                                    (path, gray, self.pending_snippets_dir))
+            except Exception as e:
+                record = new_scan_record(path)
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["image_sha256"] = image_sha256
+            await write_queue.put((path, queued_at, record))
+
+    # --- المرحلة 4: كتابة النتائج ونقل الملف ---
+
+    def _commit(self, path, record, fresh=True):
+        """
+        كتابة سجل الورقة (ذرياً) ثم نقل ملفها إلى processed/ أو failed/. تُرجع المسار الجديد للملف.
+        الورقة المتخطاة (fresh=False) تُسجل بصمة ملفها فقط، فتبقى نتيجتها المخزنة كما هي.
+        """
+        target_dir = self.processed_dir if record["status"] == "ok" else self.failed_dir
+        os.makedirs(target_dir, exist_ok=True)
+        moved_path = _unique_path(target_dir, os.path.basename(path))
+        record["source"] = moved_path
+
+        stem = os.path.splitext(os.path.basename(moved_path))[0]
+        # القصاصات كُتبت باسم الملف في مجلد الاستقبال؛ تُنقل باسمه النهائي (الماسحات تعيد استخدام الأسماء)
+        for item in record.get("review", []):
+            if item.get("snippet"):
+                snippet_path = review_snippet_path(self.triage_dir, stem, item["id"])
+                os.replace(item["snippet"], snippet_path)
+                item["snippet"] = snippet_path
+
+        record["image_sha256"] = record.get("image_sha256") or file_digest(path)
+        record_path = os.path.join(self.output_dir, f"{stem}.json")
+        tmp_path = f"{record_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, record_path)
+
+        if fresh:
+            self.store.upsert_sheet(record)
+        else:
+            self.store.record_fingerprint(record)
+        self._log(record)
+        entries = triage_entries(record)
+        if entries:
+            with open(os.path.join(self.output_dir, TRIAGE_LOG_FILE), 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries)
+
+        shutil.move(path, moved_path)
+        return moved_path
+
+    def _grade(self, record):
+        if record["status"] == "ok" and self.answer_keys:
+            grade = grade_records([record], self.answer_keys)["students"][0]
+            record["grade"] = {key: grade[key] for key in GRADE_FIELDS}
+
+    def _log(self, record):
+        with open(os.path.join(self.output_dir, INGEST_LOG_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _restore_pending_pages(self):
+        """إعادة صفحات الطلاب غير المكتملة من سجل النتائج (تشغيل سابق توقف قبل وصول بقية الصفحات)."""
+        try:
+            f = open(os.path.join(self.output_dir, INGEST_LOG_FILE), 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        completed = set()
+        pages = []
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                key = sheet_identity(record)
+                if key is None or (record.get("page_count") or 1) <= 1:
+                    continue
+                if "pages" in record:
+                    completed.add(key)
+                else:
+                    pages.append(record)
+
+        for record in pages:
+            if sheet_identity(record) in completed:
+                continue
+            student_record = self.assembler.add(record)
+            if student_record is not None:
+                # اكتملت الصفحات قبل التوقف ولم يُكتب سطر الطالب المدمج
+                self._complete_student(student_record)
+        if len(self.assembler):
+            print(f"📎 {len(self.assembler)} طالب بانتظار بقية صفحات ورقة الإجابة.")
+
+    def _complete_student(self, student_record):
+        """تسجيل الطالب المدمج بعد وصول آخر صفحاته (مع تصحيحه)."""
+        self._grade(student_record)
+        self._log(student_record)
+        student = student_record.get("student") or {}
+        grade = student_record.get("grade")
+        print(f"📚 {student.get('name', '؟')}: اكتملت {len(student_record['pages'])} صفحات"
+              + (f" - الدرجة {grade['score']}/{grade['max_score']}" if grade else ""))
+
+    async def _write_stage(self, write_queue):
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                return
+            path, queued_at, record = item
+            fresh = True
+            if self.dedup is not None:
+                # العمليات ترى الفهرس كما كان عند بدء التشغيل؛ تكرار أوراق هذا التشغيل يُحسم هنا
+                record, fresh = settle_scan(record, self.dedup, self.store)
+
+            # صفحة من ورقة متعددة الصفحات لا تُصحح وحدها؛ يُصحح الطالب عند اكتمال صفحاته
+            answer_page = sheet_identity(record) is not None and (record.get("page_count") or 1) > 1
+            if not answer_page:
+                self._grade(record)
+            record["latency_seconds"] = round(time.time() - queued_at, 3)
+
+            try:
+                await asyncio.to_thread(self._commit, path, record, fresh)
+            except OSError as e:
+                # يبقى الملف في مجلد الاستقبال ليُعاد في التشغيل التالي
+                print(f"❌ تعذر حفظ نتيجة {path}: {e}")
+                self._in_flight.discard(path)
+                continue
+            self._in_flight.discard(path)
+            if self.dedup is not None and record["status"] == "ok":
+                self.dedup.add(record)
+            if answer_page:
+                student_record = self.assembler.add(record)
+                if student_record is not None:
+                    await asyncio.to_thread(self._complete_student, student_record)
+
+            # المتخطاة تحمل نتيجتها المخزنة (status='ok') فتُعد ممسوحة سابقاً لا ناجحة
+            self.counts[record["status"] if fresh else 'skipped'] += 1
+            name = os.path.basename(path)
+            if record.get("review"):
+                self.counts['flagged'] += 1
+            if not fresh:
+                student = record.get("student") or {}
+                print(f"⏭️ {name} -> {student.get('name', '؟')} (ممسوحة سابقاً: {dedup_note(record['dedup'])})")
+            elif record["status"] == "ok":
+                student = record.get("student") or {}
+                review = f" 🔍 {len(record['review'])} سؤال للمراجعة" if record.get("review") else ""
+                replaced = f" ♻️ تحل محل مسح سابق: {dedup_note(record['dedup'])}" if record.get("dedup") else ""
+                print(f"✅ {name} -> {student.get('name', '؟')} ({record.get('model_type')}) "
+                      f"[{record['latency_seconds']} ث]{review}{replaced}")
+            else:
+                print(f"❌ {name}: {record['error']}")
+
+    # --- التشغيل ---
+
+    def _install_signal_handlers(self, loop):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop.set)
+            except (NotImplementedError, RuntimeError):
+                # غير مدعوم على Windows؛ Ctrl+C يوقف التشغيل والملفات غير المكتملة تبقى في مجلد الاستقبال
+                pass
+
+    async def run(self):
+        os.makedirs(self.inbox, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.store = ResultsStore(os.path.join(self.output_dir, RESULTS_DB_FILE))
+        if self.rescan_policy:
+            self.dedup = DedupIndex(self.store.fingerprints(), self.rescan_policy)
+        self._restore_pending_pages()
+        self._stop = asyncio.Event()
+        self._install_signal_handlers(asyncio.get_running_loop())
+
+        decode_queue = asyncio.Queue(self.queue_size)
+        extract_queue = asyncio.Queue(self.queue_size)
+        write_queue = asyncio.Queue(self.queue_size)
+
+        # المكتبات المؤجلة تُحمّل هنا وليس لأول مرة داخل خيوط القراءة المتزامنة
+        load_scan_libraries()
+        print(f"📥 مراقبة {self.inbox} ({self.workers} عملية استخراج، {self.decode_threads} خيط قراءة)...")
+        with concurrent.futures.ThreadPoolExecutor(self.decode_threads) as thread_pool, \
+                concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_scan_worker,
+                                                       initargs=self.worker_args + (False, None, False, False,
+                                                                                    self.dedup)) as process_pool:
+            decoders = [asyncio.create_task(self._decode_stage(decode_queue, extract_queue, write_queue, thread_pool))
+                        for _ in range(self.decode_threads)]
+            # ضعف عدد العمليات حتى يبقى المجمع مشغولاً أثناء تسليم النتائج
+            extractors = [asyncio.create_task(self._extract_stage(extract_queue, write_queue, process_pool))
+                          for _ in range(self.workers * 2)]
+            writer = asyncio.create_task(self._write_stage(write_queue))
+
+            # الإيقاف المنظم: كل مرحلة تُنهي ما في طابورها قبل إيقاف المرحلة التالية
+            await self._watch(decode_queue)
+            for _ in decoders:
+                await decode_queue.put(None)
+            await asyncio.gather(*decoders)
+            for _ in extractors:
+                await extract_queue.put(None)
+            await asyncio.gather(*extractors)
+            await write_queue.put(None)
+            await writer
+        self.store.close()
+
+        print(f"\n📋 الاستقبال: ✅ {self.counts['ok']} | ❌ {self.counts['failed']} | 🔍 للمراجعة {self.counts['flagged']}"
+              f" | ⏭️ ممسوحة سابقاً {self.counts['skipped']}")
+        return self.counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="استقبال مستمر لأوراق الإجابة من مجلد الماسح الضوئي وتصحيحها فور وصولها.")
+    parser.add_argument('inbox', help="مجلد الاستقبال الذي يكتب فيه الماسح الضوئي")
+    parser.add_argument('--output-dir', default=INGEST_OUTPUT_DIR, help="مجلد نتائج الأوراق")
+    parser.add_argument('--processed-dir', help="مجلد الأوراق المعالجة (الافتراضي: inbox/processed)")
+    parser.add_argument('--failed-dir', help="مجلد الأوراق الفاشلة (الافتراضي: inbox/failed)")
+    parser.add_argument('-w', '--workers', type=int, default=0, help="عدد عمليات الاستخراج (0 = عدد الأنوية).")
+    parser.add_argument('--decode-threads', type=int, default=DECODE_THREADS, help="عدد خيوط قراءة الصور.")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help="حجم الطابور بين كل مرحلتين.")
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help="الفاصل بين دورات المراقبة (ثانية).")
+    parser.add_argument('--settle-seconds', type=float, default=SETTLE_SECONDS,
+                        help="مدة ثبات الملف قبل اعتباره مكتملاً (ثانية).")
+    parser.add_argument('--once', action='store_true', help="معالجة الملفات الموجودة حالياً ثم التوقف.")
+    parser.add_argument('--bubble-data', help="ملف بيانات الفقاعات كتخطيط احتياطي للأوراق دون QR مقروء.")
+    parser.add_argument('--layout', metavar='LAYOUT_ID', help="معرف تخطيط احتياطي من السجل المشترك.")
+    parser.add_argument('--layout-dir', default=LAYOUT_SEARCH_DIR, help="مجلد سجل تخطيطات الفقاعات.")
+    parser.add_argument('--answer-keys', help="ملف JSON لمفاتيح الإجابة لكل نموذج (تصحيح فوري لكل ورقة).")
+    parser.add_argument('--full-resolution', action='store_true',
+                        help="قراءة الصور بدقتها الكاملة بدلاً من تصغيرها إلى دقة التخطيط (ذاكرة أكبر).")
+    parser.add_argument('--rescan-policy', choices=RESCAN_POLICIES, default=DEFAULT_RESCAN_POLICY,
+                        help="إعادة مسح ورقة مخزنة (نفس هوية QR وصورة قريبة): تخطيها بنتيجتها المخزنة أو استبدالها.")
+    parser.add_argument('--no-dedup', action='store_true',
+                        help="معالجة كل الأوراق كاملة دون كشف الملفات المكررة وإعادة المسح.")
+    args = parser.parse_args()
+
+    pipeline = IngestPipeline(args.inbox, args.output_dir, args.processed_dir, args.failed_dir, args.workers,
+                              args.decode_threads, args.queue_size, args.poll_interval, args.settle_seconds, args.once,
+                              json_data_path=args.bubble_data, layout_id=args.layout, layout_dir=args.layout_dir,
+                              answer_keys_path=args.answer_keys, full_resolution=args.full_resolution,
+                              rescan_policy=None if args.no_dedup else args.rescan_policy)
+    try:
+        asyncio.run(pipeline.run())
+    except KeyboardInterrupt:
+        print("\n🛑 تم الإيقاف؛ الأوراق غير المكتملة ما زالت في مجلد الاستقبال وستُعالج في التشغيل التالي.")
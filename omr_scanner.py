@@ -1,212 +1,1382 @@
-import cv2
-import numpy as np
-import json
-import os
-
-# --- 1. الدوال المساعدة (Helper Functions) ---
-
-def get_filled_ratio(bubble_roi):
-    """حساب نسبة البكسلات المظللة داخل دائرة الإجابة."""
-    # نستخدم عتبة ثابتة لتمييز التظليل الغامق
-    # يجب أن تكون المنطقة بيضاء (255) والتظليل أسود (0)
-    # cv2.THRESH_BINARY_INV يجعل التظليل (الغامق) هو البكسلات التي يتم عدّها
-    _, thresh = cv2.threshold(bubble_roi, 100, 255, cv2.THRESH_BINARY_INV)
-    filled_pixels = cv2.countNonZero(thresh)
-    total_pixels = bubble_roi.shape[0] * bubble_roi.shape[1]
-    
-    # نسبة التعبئة
-    if total_pixels > 0:
-        return filled_pixels / float(total_pixels)
-    return 0.0
-
-def load_bubble_data(json_path):
-    """تحميل بيانات الفقاعات من ملف JSON وتجميعها حسب رقم السؤال."""
-    try:
-        # 🔑 تم استخدام مسار الملف الذي تم رفعه من قبل المستخدم
-        with open(json_path, 'r', encoding='utf-8') as f:
-            all_bubbles = json.load(f)
-    except FileNotFoundError:
-        print(f"❌ خطأ: لم يتم العثور على ملف JSON في المسار: {json_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"❌ خطأ: فشل في فك ترميز JSON من الملف: {json_path}")
-        return None
-
-    questions_data = {}
-    for bubble in all_bubbles:
-        q_num = bubble.get('question_num')
-        if q_num is not None:
-            # تجميع الفقاعات حسب رقم السؤال
-            if q_num not in questions_data:
-                questions_data[q_num] = []
-            questions_data[q_num].append(bubble)
-            
-    # فرز الخيارات داخل كل سؤال حسب حرف الخيار (A, B, C, D) لضمان الترتيب الصحيح
-    for q_num in questions_data:
-        questions_data[q_num].sort(key=lambda x: x.get('option_letter', 'Z')) # 'Z' لضمان أن الخيارات بدون حرف تذهب إلى النهاية
-        
-    return questions_data
-
-
-# --- 2. الإعدادات والمعلمات (Configuration) ---
-
-IMAGE_PATH = 'text_exam.png'
-# 🔑 مسار ملف JSON المُحمَّل
-JSON_DATA_PATH = 'Exam_حاسوب_Group_1_زيد_حسين_محمد_AnswerSheet_BubbleData.json'
-
-TOTAL_QUESTIONS = 60 
-OPTIONS_PER_QUESTION = 4
-
-# الحد الأدنى لنسبة التظليل لاعتبار الفقاعة مُظلّلة
-MIN_MARK_FILL_RATIO = 0.45
-
-
-# --- 3. الدالة الرئيسية (Main Function) ---
-
-def process_omr_sheet(image_path, json_data_path):
-    # 1. تحميل الصورة والتحقق من وجودها
-    image = cv2.imread(image_path)
-    if image is None:
-        print(f"❌ خطأ: تعذر تحميل الصورة من المسار {image_path}. يرجى التأكد من وجود ملف 'text_exam.png' في نفس المجلد.")
-        return None
-    
-    print(f"✅ تم تحميل الصورة بنجاح: {image_path}")
-
-    # 2. تحميل بيانات الفقاعات من JSON
-    questions_data = load_bubble_data(json_data_path)
-    if questions_data is None:
-        return None
-        
-    global TOTAL_QUESTIONS
-    TOTAL_QUESTIONS = len(questions_data)
-    print(f"✅ تم تحميل بيانات {TOTAL_QUESTIONS} سؤال من ملف JSON.")
-
-    # 3. معالجة الصورة
-    output_image = image.copy()
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    # ملاحظة: لم نعد نحتاج إلى Blur، Canny، أو Contours، حيث نعتمد على الإحداثيات مباشرة.
-
-    final_answers = []
-    
-    # 4. معالجة الإجابات سؤالاً بسؤال بناءً على إحداثيات JSON
-    # فرز أرقام الأسئلة لضمان معالجتها بالتسلسل الصحيح (1، 2، 3، ...)
-    sorted_q_nums = sorted(questions_data.keys())
-    
-    for q_num in sorted_q_nums:
-        
-        question_options = questions_data[q_num]
-        
-        # التأكد من وجود 4 خيارات لكل سؤال
-        if len(question_options) != OPTIONS_PER_QUESTION:
-            print(f"⚠️ تنبيه: السؤال رقم {q_num} يحتوي على {len(question_options)} خياراً بدلاً من {OPTIONS_PER_QUESTION}. سيتم تخطيه.")
-            continue
-            
-        marked_bubble_id = None
-        marked_option_letter = "Unanswered"
-        max_ratio = 0.0
-        
-        # حلقة لاكتشاف الإجابة المظللة من بين الخيارات الأربعة
-        for bubble_data in question_options:
-            
-            # استخراج إحداثيات المستطيل (x_min, y_min, x_max, y_max)
-            try:
-                x_min, y_min, x_max, y_max = bubble_data['bbox']
-            except (KeyError, ValueError):
-                print(f"❌ خطأ في بيانات bbox للفقاعة {bubble_data.get('id', 'غير معروف')}.")
-                continue
-            
-            # التأكد من عدم خروج الإحداثيات عن حدود الصورة
-            h, w = gray.shape
-            x_min = max(0, x_min)
-            y_min = max(0, y_min)
-            x_max = min(w, x_max)
-            y_max = min(h, y_max)
-            
-            # استخراج منطقة الاهتمام (ROI) للدائرة من الصورة الرمادية
-            bubble_roi = gray[y_min:y_max, x_min:x_max]
-            
-            if bubble_roi.size == 0 or (x_max - x_min) <= 0 or (y_max - y_min) <= 0:
-                continue # تخطي إذا كانت المنطقة غير صالحة
-
-            fill_ratio = get_filled_ratio(bubble_roi)
-            
-            # إذا كان التظليل هو الأقصى، يتم اعتباره الإجابة المحتملة
-            if fill_ratio > max_ratio:
-                max_ratio = fill_ratio
-                marked_bubble_id = bubble_data['id']
-                marked_option_letter = bubble_data['option_letter']
-                
-        
-        # 5. تحديد الإجابة النهائية
-        is_marked = (max_ratio >= MIN_MARK_FILL_RATIO)
-        
-        current_answer = {
-            "id": q_num, 
-            "answer": marked_option_letter if is_marked else "Unanswered",
-            "bubble_id": marked_bubble_id if is_marked else None # إضافة الـ ID الخاص بالفقاعة المظللة
-        }
-        final_answers.append(current_answer)
-        
-        # 6. رسم مستطيل أخضر حول الإجابة المكتشفة (للتصور)
-        if is_marked and marked_bubble_id:
-            # البحث عن بيانات الفقاعة المظللة لغرض الرسم
-            marked_bubble_data = next((b for b in question_options if b['id'] == marked_bubble_id), None)
-            if marked_bubble_data:
-                x_min, y_min, x_max, y_max = marked_bubble_data['bbox']
-                # رسم مستطيل أخضر (سمك 3) على الإجابة المكتشفة
-                cv2.rectangle(output_image, (x_min, y_min), (x_max, y_max), (0, 255, 0), 3)
-
-
-    # 7. إخراج البيانات JSON بالبنية المطلوبة
-    
-    output_data = {
-      "data": {
-        "stage": "stage 1",
-        "subject_id": 1,
-        "subject_name": "حاسوب",
-        "exam_info": { "id": 1 },
-        "n_of_Q": TOTAL_QUESTIONS,
-        "model_type": "Group A",
-        "number_of_groups": "4",
-        "number_of_questions": TOTAL_QUESTIONS,
-        "users": [
-          {
-            "id": 1,
-            "name": "زيد حسين محمد",
-            "email": "superadmin@example.com",
-            "user_info": { "deb": "ddeee" },
-            "exam": [
-              {
-                "id": 1,
-                "answer": final_answers
-              }
-            ]
-          }
-        ]
-      }
-    }
-
-    # حفظ ملف JSON
-    output_json_path = 'student_answers_structured_json_based.json'
-    with open(output_json_path, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, ensure_ascii=False, indent=4)
-        
-    print(f"\n✅ تم حفظ الإجابات في {output_json_path} بنجاح لـ {len(final_answers)} سؤال.")
-    
-    # حفظ وعرض الصورة المعالجة
-    output_image_path = 'output_answers_structured_json_based_image.png'
-    cv2.imwrite(output_image_path, output_image)
-    print(f"✅ تم حفظ الصورة المعالجة في: {output_image_path}")
-
-    # عرض الصورة المعالجة باستخدام OpenCV
-    if os.path.exists(image_path):
-        cv2.imshow("OMR Answers Detected (JSON Based)", output_image)
-        cv2.waitKey(0)
-        cv2.destroyAllWindows()
-
-
-# --- تنفيذ الكود ---
-if __name__ == "__main__":
-    # تمرير مسار الصورة ومسار ملف JSON إلى الدالة الرئيسية
-    process_omr_sheet(IMAGE_PATH, JSON_DATA_PATH)
\ No newline at end of file
+import argparse
+import concurrent.futures
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import io
+import time
+import json
+import os
+
+from bubble_layout import DEFAULT_PAGE_SIZE, FIDUCIAL_SIZE, LAYOUT_CACHE_SIZE, LAYOUT_DIR, fiducial_centers, load_layout
+from exam_manifest import file_digest
+from grading import GRADE_FIELDS, GRADES_FILE, grade_records, load_answer_keys, save_grades
+import instrumentation
+from lazy_import import lazy_import, preload
+from results_store import RESULTS_DB_FILE, ResultsStore, build_output_data, scan_timestamp
+from scan_dedup import DEFAULT_RESCAN_POLICY, RESCAN_POLICIES, DedupIndex, perceptual_hash, qr_sheet_key, settle_scan
+
+# OpenCV و NumPy و Pillow تُحمّل عند أول ورقة فقط (استيراد الوحدة كمكتبة أو عرض --help لا يدفع كلفتها)
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+# --- 1. الدوال المساعدة (Helper Functions) ---
+
+def load_bubble_data(json_path):
+    """تحميل بيانات الفقاعات من ملف JSON وتجميعها حسب رقم السؤال."""
+    try:
+        # 🔑 تم استخدام مسار الملف الذي تم رفعه من قبل المستخدم
+        with open(json_path, 'r', encoding='utf-8') as f:
+            all_bubbles = json.load(f)
+    except FileNotFoundError:
+        print(f"❌ خطأ: لم يتم العثور على ملف JSON في المسار: {json_path}")
+        return None
+    except json.JSONDecodeError:
+        print(f"❌ خطأ: فشل في فك ترميز JSON من الملف: {json_path}")
+        return None
+
+    questions_data = {}
+    for bubble in all_bubbles:
+        q_num = bubble.get('question_num')
+        if q_num is not None:
+            # تجميع الفقاعات حسب رقم السؤال
+            if q_num not in questions_data:
+                questions_data[q_num] = []
+            questions_data[q_num].append(bubble)
+            
+    # فرز الخيارات داخل كل سؤال حسب حرف الخيار (A, B, C, D) لضمان الترتيب الصحيح
+    for q_num in questions_data:
+        questions_data[q_num].sort(key=lambda x: x.get('option_letter', 'Z')) # 'Z' لضمان أن الخيارات بدون حرف تذهب إلى النهاية
+        
+    return questions_data
+
+
+# --- 2. الإعدادات والمعلمات (Configuration) ---
+
+IMAGE_PATH = 'text_exam.png'
+# 🔑 مسار ملف JSON المُحمَّل
+JSON_DATA_PATH = 'Exam_حاسوب_Group_1_زيد_حسين_محمد_AnswerSheet_BubbleData.json'
+
+# مجلد سجل تخطيطات الفقاعات الذي يكتبه generate_exams.py
+LAYOUT_SEARCH_DIR = os.path.join('exam_sheets_output_images', LAYOUT_DIR)
+
+TOTAL_QUESTIONS = 60 
+OPTIONS_PER_QUESTION = 4
+
+# الحد الأدنى لنسبة التظليل لاعتبار الفقاعة مُظلّلة
+MIN_MARK_FILL_RATIO = 0.45
+
+# عتبة تمييز البكسل الغامق، ونسبة نصف قطر القرص الداخلي المستخدم للقياس (يستبعد الإطار المطبوع بسمك 3px)
+FILL_THRESHOLD = 100
+INNER_DISK_RATIO = 0.75
+
+# تطبيع الشدة لكل ورقة: عتبة FILL_THRESHOLD مُعرّفة لورق أبيض (255) وحبر أسود (0)، وتُنقل إلى المدى الفعلي
+# للورقة بين مستوى الحبر (علامات الزوايا) ومستوى الورق (الفقاعات الفارغة). تباين أقل من هذا يعني مستويات غير موثوقة.
+MIN_INK_CONTRAST = 60
+
+# ثقة الإجابة: بُعد قرار التظليل عن MIN_MARK_FILL_RATIO (لأعلى تظليل وثاني أعلى تظليل) مقسوماً على هذا المقياس
+CONFIDENCE_SCALE = 0.3
+# بُعد أقل من هذا عن العتبة يجعل السؤال موضع شك ويُرسل للمراجعة اليدوية
+REVIEW_MARGIN = 0.12
+# فقاعة غير محتسبة بهذا الغمق (0 ورق، 1 حبر) تعني قلماً باهتاً أو إجابة ممسوحة
+FAINT_MARK_DARKNESS = 0.25
+# مجلد قصاصات الأسئلة المشكوك فيها وملف طابور المراجعة (Triage) داخل مجلد الإخراج
+TRIAGE_DIR_NAME = 'triage'
+TRIAGE_FILE = 'triage_queue.json'
+# عرض منطقة رقم السؤال على يسار الفقاعات في قصاصة المراجعة (بمضاعفات ارتفاع الفقاعة)
+SNIPPET_LABEL_WIDTH = 3.0
+
+
+# إعدادات المعالجة الدفعية (Batch)
+BATCH_OUTPUT_DIR = 'omr_batch_results'
+BATCH_SUMMARY_FILE = 'batch_results.json'
+BATCH_ANSWERS_FILE = 'student_answers.json'
+SCAN_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+
+# إعدادات تسجيل الصفحة (Registration) عبر علامات الزوايا
+REGISTRATION_WIDTH = 400          # عرض النسخة المصغرة المستخدمة للبحث عن العلامات
+REGISTRATION_CORNER_FRACTION = 0.15  # حجم نافذة البحث في كل زاوية كنسبة من أبعاد الصفحة
+REGISTRATION_MIN_EXTENT = 0.7     # أقل نسبة امتلاء لمربع العلامة داخل مستطيله المحيط
+
+# قراءة الأوراق الممسوحة: رمادية مباشرة، ومصغرة أثناء فك الترميز (1/2، 1/4، 1/8) لتقارب دقة التخطيط (150 DPI)
+# ما دام عرضها لا يقل عن هذه النسبة من عرض صفحة التخطيط. مسح 300 DPI يُقرأ بربع البكسلات، و 600 DPI بجزء من 16.
+SCAN_REDUCTION_FACTORS = (8, 4, 2)
+SCAN_MIN_SCALE = 0.9
+
+# منطقة البحث عن رمز QR في رأس الصفحة (كنسب من أبعاد الصفحة: x0, y0, x1, y1)
+QR_SEARCH_REGION = (0.0, 0.0, 0.3, 0.2)
+
+# خطط اقتطاع بكسلات الفقاعات المحفوظة مؤقتاً لكل (تخطيط، أبعاد صورة)
+SAMPLING_PLAN_CACHE_SIZE = 16
+_SAMPLING_PLAN_CACHE = {}
+
+
+# --- 3. الدالة الرئيسية (Main Function) ---
+
+def build_layout_arrays(questions_data):
+    """
+    تحويل بيانات الفقاعات المجمّعة حسب السؤال إلى مصفوفات جاهزة للمعالجة الموجّهة (Vectorized):
+    question_nums (Q,) ، bboxes (Q, O, 4) ، bubble_ids و option_letters (قوائم Q × O).
+    الأسئلة التي لا تحتوي على OPTIONS_PER_QUESTION خياراً يتم تخطيها كما في السابق.
+    """
+    question_nums, bboxes, bubble_ids, option_letters = [], [], [], []
+    for q_num in sorted(questions_data.keys()):
+        question_options = questions_data[q_num]
+        if len(question_options) != OPTIONS_PER_QUESTION:
+            print(f"⚠️ تنبيه: السؤال رقم {q_num} يحتوي على {len(question_options)} خياراً بدلاً من {OPTIONS_PER_QUESTION}. سيتم تخطيه.")
+            continue
+        try:
+            q_bboxes = [list(b['bbox']) for b in question_options]
+        except KeyError:
+            print(f"❌ خطأ في بيانات bbox للسؤال {q_num}.")
+            continue
+        question_nums.append(q_num)
+        bboxes.append(q_bboxes)
+        bubble_ids.append([b.get('id') for b in question_options])
+        option_letters.append([b.get('option_letter') for b in question_options])
+
+    return {
+        'question_nums': np.array(question_nums, dtype=np.int32),
+        'bboxes': np.array(bboxes, dtype=np.int32).reshape(-1, OPTIONS_PER_QUESTION, 4),
+        'bubble_ids': bubble_ids,
+        'option_letters': option_letters,
+        'page_size': DEFAULT_PAGE_SIZE,
+        'fiducials': fiducial_centers(*DEFAULT_PAGE_SIZE),
+    }
+
+
+def _inner_disk_mask(height, width, inner_ratio):
+    """قناع دائري داخلي يستبعد الإطار المطبوع للفقاعة وزوايا المربع المحيط."""
+    yy, xx = np.mgrid[0:height, 0:width]
+    cy, cx = (height - 1) / 2.0, (width - 1) / 2.0
+    radius = min(height, width) / 2.0 * inner_ratio
+    return ((yy - cy) ** 2 + (xx - cx) ** 2) <= radius ** 2
+
+
+def resolve_layout(layout_id=None, json_data_path=None, layout_dir=LAYOUT_SEARCH_DIR):
+    """
+    الحصول على مصفوفات تخطيط الفقاعات: من السجل المشترك عبر layout_id (محفوظ مؤقتاً لكل عملية)،
+    أو من ملف BubbleData JSON القديم. تُرجع None عند الفشل.
+    """
+    if layout_id:
+        try:
+            return load_layout(layout_id, layout_dir)
+        except (FileNotFoundError, KeyError, ValueError) as e:
+            print(f"❌ خطأ: تعذر تحميل التخطيط {layout_id} من {layout_dir}: {e}")
+            return None
+    questions_data = load_bubble_data(json_data_path)
+    return build_layout_arrays(questions_data) if questions_data is not None else None
+
+
+def _find_fiducial(small, corner, expected_area):
+    """
+    البحث عن مربع العلامة داخل نافذة الزاوية في الصورة المصغرة (ثنائية: الحبر = 255).
+    تُرجع المركز (x, y) بإحداثيات الصورة المصغرة، أو None.
+    """
+    h, w = small.shape
+    win_w, win_h = int(w * REGISTRATION_CORNER_FRACTION), int(h * REGISTRATION_CORNER_FRACTION)
+    x0 = 0 if corner in (0, 3) else w - win_w
+    y0 = 0 if corner in (0, 1) else h - win_h
+    window = small[y0:y0 + win_h, x0:x0 + win_w]
+
+    contours, _ = cv2.findContours(window, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    corner_x = 0 if corner in (0, 3) else win_w
+    corner_y = 0 if corner in (0, 1) else win_h
+    best, best_dist = None, None
+    for contour in contours:
+        bx, by, bw, bh = cv2.boundingRect(contour)
+        area = cv2.contourArea(contour)
+        if not (0.3 * expected_area <= bw * bh <= 3.0 * expected_area):
+            continue
+        # مساحة المحيط المضلع أصغر ببكسل واحد تقريباً من المستطيل المحيط في كل بعد
+        if not (0.6 <= bw / float(bh) <= 1.6) or area < REGISTRATION_MIN_EXTENT * (bw - 1) * (bh - 1):
+            continue
+        cx, cy = bx + bw / 2.0, by + bh / 2.0
+        dist = (cx - corner_x) ** 2 + (cy - corner_y) ** 2
+        if best is None or dist < best_dist:
+            best, best_dist = (cx + x0, cy + y0), dist
+    return best
+
+
+def _refine_fiducial(gray, center, half):
+    """
+    تحسين مركز العلامة بدقة كاملة: مركز الكتلة (Moments) للبكسلات الغامقة حول الموضع التقريبي.
+    تُرجع (المركز، مستوى الحبر) حيث مستوى الحبر وسيط شدة بكسلات العلامة (أو None).
+    """
+    h, w = gray.shape
+    x0, y0 = max(0, int(center[0] - half)), max(0, int(center[1] - half))
+    x1, y1 = min(w, int(center[0] + half) + 1), min(h, int(center[1] + half) + 1)
+    roi = gray[y0:y1, x0:x1]
+    if roi.size == 0:
+        return center, None
+    _, binary = cv2.threshold(roi, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    moments = cv2.moments(binary, binaryImage=True)
+    if moments['m00'] <= 0:
+        return center, None
+    ink_level = float(np.median(roi[binary > 0]))
+    return (x0 + moments['m10'] / moments['m00'], y0 + moments['m01'] / moments['m00']), ink_level
+
+
+def register_sheet(gray, layout):
+    """
+    تسجيل الورقة الممسوحة على التخطيط: إيجاد علامات الزوايا على نسخة مصغرة، تقدير التحويل
+    (Homography عند وجود 4 علامات، Affine عند 3، وإلا تغيير مقياس فقط)، ثم تحويل إحداثيات الفقاعات
+    فقط (وليس الصورة). تُرجع (bboxes المحولة (Q, O, 4)، معلومات التسجيل مع مستوى حبر العلامات ink_level).
+    """
+    start_time = time.perf_counter()
+    bboxes = layout['bboxes']
+    page_w, page_h = layout.get('page_size', DEFAULT_PAGE_SIZE)
+    expected = np.asarray(layout.get('fiducials', fiducial_centers(page_w, page_h)), dtype=np.float32)
+    img_h, img_w = gray.shape[:2]
+    scale_x, scale_y = img_w / float(page_w), img_h / float(page_h)
+
+    # 1. البحث عن العلامات على نسخة مصغرة
+    factor = min(1.0, REGISTRATION_WIDTH / float(img_w))
+    small = cv2.resize(gray, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA) if factor < 1.0 else gray
+    _, small_bin = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    expected_area = (FIDUCIAL_SIZE * scale_x * factor) * (FIDUCIAL_SIZE * scale_y * factor)
+
+    found_idx, found_pts, ink_levels = [], [], []
+    for corner in range(4):
+        center = _find_fiducial(small_bin, corner, expected_area)
+        if center is None:
+            continue
+        center = (center[0] / factor, center[1] / factor)
+        found_idx.append(corner)
+        center, ink_level = _refine_fiducial(gray, center, FIDUCIAL_SIZE * max(scale_x, scale_y))
+        found_pts.append(center)
+        if ink_level is not None:
+            ink_levels.append(ink_level)
+
+    # 2. تقدير التحويل من إحداثيات التخطيط إلى إحداثيات الصورة
+    src = expected[found_idx]
+    dst = np.asarray(found_pts, dtype=np.float32).reshape(-1, 2)
+    if len(found_idx) == 4:
+        method = 'homography'
+        matrix = cv2.getPerspectiveTransform(src, dst)
+    elif len(found_idx) == 3:
+        method = 'affine'
+        matrix = np.vstack([cv2.getAffineTransform(src, dst), [0.0, 0.0, 1.0]])
+    else:
+        method = 'scale'
+        matrix = np.array([[scale_x, 0.0, 0.0], [0.0, scale_y, 0.0], [0.0, 0.0, 1.0]])
+
+    info = {'method': method, 'markers': len(found_idx),
+            'ink_level': round(float(np.median(ink_levels)), 1) if ink_levels else None}
+    if method == 'scale' and abs(scale_x - 1.0) < 1e-6 and abs(scale_y - 1.0) < 1e-6:
+        info['ms'] = round((time.perf_counter() - start_time) * 1000, 2)
+        return bboxes, info
+
+    # 3. تحويل مراكز الفقاعات فقط، مع تعديل حجمها بمقياس التحويل
+    flat = bboxes.reshape(-1, 4).astype(np.float32)
+    centers = np.stack([(flat[:, 0] + flat[:, 2]) / 2.0, (flat[:, 1] + flat[:, 3]) / 2.0], axis=1)
+    warped = cv2.perspectiveTransform(centers.reshape(-1, 1, 2), matrix.astype(np.float64)).reshape(-1, 2)
+
+    # المقياس المحلي عند مركز الصفحة (جذر محدد المشتقة)
+    probe = np.array([[[page_w / 2.0, page_h / 2.0]], [[page_w / 2.0 + 1, page_h / 2.0]], [[page_w / 2.0, page_h / 2.0 + 1]]],
+                     dtype=np.float32)
+    p0, px, py = cv2.perspectiveTransform(probe, matrix.astype(np.float64)).reshape(3, 2)
+    dx, dy = px - p0, py - p0
+    local_scale = float(np.sqrt(abs(dx[0] * dy[1] - dx[1] * dy[0])))
+    half_w = np.round((flat[:, 2] - flat[:, 0]) / 2.0 * local_scale)
+    half_h = np.round((flat[:, 3] - flat[:, 1]) / 2.0 * local_scale)
+    cx, cy = np.round(warped[:, 0]), np.round(warped[:, 1])
+    registered = np.stack([cx - half_w, cy - half_h, cx + half_w, cy + half_h], axis=1).astype(np.int32)
+
+    info['ms'] = round((time.perf_counter() - start_time) * 1000, 2)
+    return registered.reshape(bboxes.shape), info
+
+
+def _bubble_sampling_plan(bboxes, image_shape, inner_ratio, use_cache=True):
+    """
+    تجهيز فهارس البكسلات (المسطّحة) الواقعة داخل القرص الداخلي لكل فقاعة، لصورة بأبعاد image_shape.
+    النتيجة محفوظة مؤقتاً لكل (تخطيط، أبعاد صورة)، فتكلفتها تُدفع مرة واحدة لكل دفعة أوراق.
+    الإحداثيات المحولة بالتسجيل تختلف من ورقة لأخرى، فتُحسب دون حفظ (use_cache=False).
+    """
+    key = (bboxes.tobytes(), bboxes.shape, tuple(image_shape[:2]), inner_ratio)
+    plan = _SAMPLING_PLAN_CACHE.get(key) if use_cache else None
+    if plan is not None:
+        return plan
+
+    img_h, img_w = image_shape[:2]
+    flat = bboxes.reshape(-1, 4).astype(np.int64)
+    heights = flat[:, 3] - flat[:, 1]
+    widths = flat[:, 2] - flat[:, 0]
+
+    plan = []
+    # عادةً جميع الفقاعات بنفس الحجم، فتكون هناك مجموعة واحدة فقط
+    for height, width in sorted(set(zip(heights.tolist(), widths.tolist()))):
+        if height <= 0 or width <= 0:
+            continue
+        rows = np.nonzero((heights == height) & (widths == width))[0]
+        mask_y, mask_x = np.nonzero(_inner_disk_mask(height, width, inner_ratio))
+        ys = flat[rows, 1, None] + mask_y
+        xs = flat[rows, 0, None] + mask_x
+        # البكسلات خارج حدود الصورة تُعامل كورق أبيض
+        valid = (ys >= 0) & (ys < img_h) & (xs >= 0) & (xs < img_w)
+        index = np.clip(ys, 0, img_h - 1) * img_w + np.clip(xs, 0, img_w - 1)
+        plan.append((rows, index, None if valid.all() else valid, len(mask_y)))
+
+    if use_cache:
+        if len(_SAMPLING_PLAN_CACHE) >= SAMPLING_PLAN_CACHE_SIZE:
+            _SAMPLING_PLAN_CACHE.pop(next(iter(_SAMPLING_PLAN_CACHE)))
+        _SAMPLING_PLAN_CACHE[key] = plan
+    return plan
+
+
+def compute_fill_matrix(gray, bboxes, threshold=FILL_THRESHOLD, inner_ratio=INNER_DISK_RATIO, use_cache=True):
+    """
+    حساب نسبة التظليل لجميع الفقاعات دفعة واحدة وإرجاع مصفوفة (الأسئلة × الخيارات).
+    بدلاً من 240 استدعاء صغيراً لـ OpenCV، تُجمع بكسلات الأقراص الداخلية لكل الفقاعات بعملية take واحدة،
+    ثم تُطبق العتبة (البكسل الغامق <= العتبة، كما في THRESH_BINARY_INV) ويُحسب المتوسط لكل فقاعة.
+    """
+    num_questions, num_options = bboxes.shape[:2]
+    fills = np.zeros((num_questions, num_options), dtype=np.float32)
+    if num_questions == 0:
+        return fills
+
+    pixels = np.ascontiguousarray(gray).reshape(-1)
+    result = fills.reshape(-1)
+    for rows, index, valid, count in _bubble_sampling_plan(bboxes, gray.shape, inner_ratio, use_cache):
+        dark = pixels.take(index) <= threshold
+        if valid is not None:
+            dark &= valid
+        result[rows] = np.count_nonzero(dark, axis=1) / float(count)
+
+    return fills
+
+
+def bubble_mean_intensity(gray, bboxes, inner_ratio=INNER_DISK_RATIO, use_cache=True):
+    """
+    متوسط شدة القرص الداخلي لكل فقاعة كمصفوفة (الأسئلة × الخيارات)، بنفس خطة الاقتطاع المحفوظة
+    لـ compute_fill_matrix. البكسلات خارج حدود الصورة تُعامل كورق أبيض.
+    """
+    num_questions, num_options = bboxes.shape[:2]
+    means = np.full((num_questions, num_options), 255.0, dtype=np.float32)
+    if num_questions == 0:
+        return means
+
+    pixels = np.ascontiguousarray(gray).reshape(-1)
+    result = means.reshape(-1)
+    for rows, index, valid, count in _bubble_sampling_plan(bboxes, gray.shape, inner_ratio, use_cache):
+        samples = pixels.take(index)
+        if valid is not None:
+            samples = np.where(valid, samples, 255)
+        result[rows] = samples.mean(axis=1)
+    return means
+
+
+def sheet_intensity(means, ink_level=None):
+    """
+    تطبيع الشدة لكل ورقة: مستوى الورق (وسيط متوسطات الفقاعات؛ أغلبها غير مظلل فلا يتأثر بالإجابات)،
+    ومستوى الحبر (من علامات الزوايا؛ 0 إذا لم يُقس)، وعتبة البكسل الغامق بنفس موضع FILL_THRESHOLD بينهما.
+    إذا كان التباين أقل من MIN_INK_CONTRAST تبقى العتبة الثابتة.
+    """
+    paper = float(np.median(means)) if means.size else 255.0
+    ink = ink_level if ink_level is not None else 0.0
+    threshold = FILL_THRESHOLD
+    if paper - ink >= MIN_INK_CONTRAST:
+        threshold = ink + (paper - ink) * FILL_THRESHOLD / 255.0
+    return {"paper": round(paper, 1), "ink": ink_level, "threshold": round(threshold, 1)}
+
+
+def bubble_darkness(means, intensity):
+    """درجة غمق كل فقاعة بعد التطبيع: 0 للورق و 1 للحبر (تكشف التظليل الباهت الذي لا يتجاوز عتبة البكسل)."""
+    paper, ink = intensity["paper"], intensity["ink"] or 0.0
+    return np.clip((paper - means) / max(paper - ink, MIN_INK_CONTRAST), 0.0, 1.0)
+
+
+def answer_confidence(fills, darkness=None):
+    """
+    ثقة قرار كل سؤال من مصفوفة التظليل (الأسئلة × الخيارات): للسؤال المظلل أقل المسافتين
+    (أعلى تظليل فوق العتبة، وثاني أعلى تظليل تحتها) وللسؤال غير المجاب مسافة أعلى تظليل تحت العتبة،
+    مقسومة على CONFIDENCE_SCALE (بين 0 و 1)؛ فالفرق الصغير بين أعلى تظليلين يعني ثقة منخفضة دائماً.
+    تُرجع (confidence, flags) حيث flags قائمة علامات لكل سؤال: 'multi_mark' (أكثر من فقاعة فوق العتبة)،
+    'near_threshold' (القرار على بُعد أقل من REVIEW_MARGIN من العتبة)، و 'faint_mark' (فقاعة غير محتسبة
+    غمقها لا يقل عن FAINT_MARK_DARKNESS حسب darkness: قلم باهت أو إجابة ممسوحة).
+    """
+    if fills.shape[0] == 0:
+        return np.zeros(0, dtype=np.float32), []
+    ordered = np.sort(fills, axis=1)
+    best = ordered[:, -1]
+    second = ordered[:, -2] if fills.shape[1] > 1 else np.zeros_like(best)
+    is_marked = best >= MIN_MARK_FILL_RATIO
+    distance = np.where(is_marked, np.minimum(best - MIN_MARK_FILL_RATIO, MIN_MARK_FILL_RATIO - second),
+                        MIN_MARK_FILL_RATIO - best)
+    confidence = np.clip(distance / CONFIDENCE_SCALE, 0.0, 1.0)
+
+    multi_mark = is_marked & (second >= MIN_MARK_FILL_RATIO)
+    near_threshold = ~multi_mark & (distance < REVIEW_MARGIN)
+    faint_mark = np.zeros_like(is_marked)
+    if darkness is not None:
+        # أغمق فقاعة لم تُحتسب كإجابة
+        uncounted = darkness.copy()
+        rows = np.nonzero(is_marked)[0]
+        uncounted[rows, fills[rows].argmax(axis=1)] = 0.0
+        strongest = uncounted.max(axis=1)
+        faint_mark = ~multi_mark & ~near_threshold & (strongest >= FAINT_MARK_DARKNESS)
+        confidence = np.where(faint_mark, np.minimum(confidence, 1.0 - strongest), confidence)
+
+    flags = [(['multi_mark'] if multi else []) + (['near_threshold'] if near else []) + (['faint_mark'] if faint else [])
+             for multi, near, faint in zip(multi_mark.tolist(), near_threshold.tolist(), faint_mark.tolist())]
+    return confidence, flags
+
+
+def extract_answers(gray, layout, bboxes=None, threshold=FILL_THRESHOLD, darkness=None):
+    """
+    استخراج الإجابة المظللة لكل سؤال من صورة رمادية بناءً على مصفوفات التخطيط (build_layout_arrays).
+    bboxes: إحداثيات الفقاعات بعد التسجيل (register_sheet)؛ الافتراضي إحداثيات التخطيط كما هي.
+    threshold: عتبة البكسل الغامق، و darkness: غمق الفقاعات (بعد تطبيع الشدة للورقة، انظر sheet_intensity).
+    تُرجع (final_answers, marked_bboxes, fills) حيث fills مصفوفة نسب التظليل (الأسئلة × الخيارات)،
+    لكل إجابة ثقة القرار "confidence"، وللإجابات المشكوك فيها فقط قائمة "flags" (answer_confidence).
+    """
+    if bboxes is None:
+        bboxes = layout['bboxes']
+    with instrumentation.timer('scan.fill'):
+        fills = compute_fill_matrix(gray, bboxes, threshold, use_cache=bboxes is layout['bboxes'])
+
+    # 5. تحديد الإجابة النهائية لجميع الأسئلة كعمليات على المصفوفات
+    best = fills.argmax(axis=1)
+    max_ratio = fills.max(axis=1) if len(fills) else fills.sum(axis=1)
+    is_marked = max_ratio >= MIN_MARK_FILL_RATIO
+    confidence, flags = answer_confidence(fills, darkness)
+
+    final_answers = []
+    for row, q_num in enumerate(layout['question_nums'].tolist()):
+        option = int(best[row])
+        marked = bool(is_marked[row])
+        answer = {
+            "id": q_num,
+            "answer": layout['option_letters'][row][option] if marked else "Unanswered",
+            "bubble_id": layout['bubble_ids'][row][option] if marked else None, # إضافة الـ ID الخاص بالفقاعة المظللة
+            "confidence": round(float(confidence[row]), 3),
+        }
+        if flags[row]:
+            answer["flags"] = flags[row]
+        final_answers.append(answer)
+
+    # 6. مربعات الإجابات المكتشفة (للتصور)
+    marked_rows = np.nonzero(is_marked)[0]
+    marked_bboxes = bboxes[marked_rows, best[marked_rows]].tolist()
+
+    return final_answers, marked_bboxes, fills
+
+
+def review_items(answers, fills, darkness, bboxes, layout):
+    """
+    الأسئلة المشكوك فيها في ورقة (الإجابات ذات "flags") مع نسب تظليل كل خياراتها وغمقها
+    ومستطيل السؤال في الصورة الممسوحة (bbox) لاقتطاع قصاصة المراجعة.
+    """
+    items = []
+    for row, answer in enumerate(answers):
+        if "flags" not in answer:
+            continue
+        x_min, y_min = bboxes[row, :, :2].min(axis=0).tolist()
+        x_max, y_max = bboxes[row, :, 2:].max(axis=0).tolist()
+        items.append({
+            "id": answer["id"],
+            "answer": answer["answer"],
+            "confidence": answer["confidence"],
+            "flags": answer["flags"],
+            "fills": {letter: round(float(ratio), 3) for letter, ratio in zip(layout['option_letters'][row], fills[row])},
+            "darkness": {letter: round(float(value), 3)
+                         for letter, value in zip(layout['option_letters'][row], darkness[row])},
+            "bbox": [x_min, y_min, x_max, y_max],
+        })
+    return items
+
+
+def review_snippet_path(triage_dir, stem, question_id):
+    return os.path.join(triage_dir, f"{stem}_Q{question_id}.png")
+
+
+def save_review_snippets(gray, review, triage_dir, stem):
+    """
+    حفظ قصاصة لكل سؤال مشكوك فيه وإضافة مسارها إلى العنصر كـ "snippet": صف الفقاعات مع رقم السؤال
+    المرسوم على يسارها (SNIPPET_LABEL_WIDTH من ارتفاع الفقاعة) وهامش صغير فوقه وتحته.
+    """
+    if not review:
+        return
+    os.makedirs(triage_dir, exist_ok=True)
+    img_h, img_w = gray.shape[:2]
+    for item in review:
+        x_min, y_min, x_max, y_max = item["bbox"]
+        bubble_size = max(1, y_max - y_min)
+        pad = bubble_size // 4
+        crop = gray[max(0, y_min - pad):min(img_h, y_max + pad),
+                    max(0, x_min - int(bubble_size * SNIPPET_LABEL_WIDTH)):min(img_w, x_max + pad)]
+        if crop.size == 0:
+            continue
+        snippet_path = review_snippet_path(triage_dir, stem, item["id"])
+        cv2.imwrite(snippet_path, crop)
+        item["snippet"] = snippet_path
+
+
+def triage_entries(record):
+    """عناصر طابور المراجعة لورقة واحدة: أسئلتها المشكوك فيها مع مصدر الورقة وهوية الطالب وصفحته."""
+    student = record.get("student") or {}
+    return [{"source": record["source"], "student_id": student.get("id"), "student_name": student.get("name"),
+             "model_type": record.get("model_type"), "page": record.get("page"), **item}
+            for item in record.get("review", [])]
+
+
+def build_triage_queue(records):
+    """طابور المراجعة اليدوية لدفعة أوراق: الأسئلة المشكوك فيها فقط، الأقل ثقة أولاً."""
+    items = sorted((entry for record in records for entry in triage_entries(record)), key=lambda e: e["confidence"])
+    return {
+        "total_sheets": len(records),
+        "flagged_sheets": len({entry["source"] for entry in items}),
+        "flagged_questions": len(items),
+        "items": items,
+    }
+
+
+def draw_detected_answers(image, marked_bboxes):
+    """رسم مستطيل أخضر (سمك 3) حول كل إجابة مكتشفة على نسخة ملونة من الصورة (تُنشأ عند الرسم فقط)."""
+    output_image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+    for x_min, y_min, x_max, y_max in marked_bboxes:
+        cv2.rectangle(output_image, (x_min, y_min), (x_max, y_max), (0, 255, 0), 3)
+    return output_image
+
+
+# --- قراءة صور الأوراق بذاكرة منخفضة ---
+
+def scan_read_flag(image_size, page_size=DEFAULT_PAGE_SIZE):
+    """علم القراءة في OpenCV: أكبر تصغير عند فك الترميز يُبقي عرض الصورة قريباً من عرض صفحة التخطيط أو أكبر."""
+    for factor in SCAN_REDUCTION_FACTORS:
+        if image_size[0] / factor >= page_size[0] * SCAN_MIN_SCALE:
+            return getattr(cv2, f"IMREAD_REDUCED_GRAYSCALE_{factor}")
+    return cv2.IMREAD_GRAYSCALE
+
+
+def read_scan(image_path, page_size=DEFAULT_PAGE_SIZE, reduce=True):
+    """
+    قراءة ورقة ممسوحة كصورة رمادية مباشرة (دون نسخة BGR بثلاثة أضعاف الحجم). reduce يصغّرها أثناء فك الترميز
+    إلى دقة التخطيط: أبعاد الصورة تُقرأ من ترويسة الملف فقط (Pillow) قبل فكه، وفك JPEG المصغر لا يمر بالدقة الكاملة.
+    الإحداثيات لا تتغير لأن التسجيل (register_sheet) يحوّل التخطيط إلى أبعاد الصورة أياً كانت.
+    تُرجع None إذا تعذرت القراءة.
+    """
+    try:
+        data = np.fromfile(image_path, dtype=np.uint8)
+    except OSError:
+        return None
+    return decode_scan_bytes(data, page_size, reduce)
+
+
+def decode_scan_bytes(data, page_size=DEFAULT_PAGE_SIZE, reduce=True):
+    """مثل read_scan لمحتوى ملف صورة في الذاكرة (bytes أو مصفوفة uint8)، مثل صورة مرفوعة عبر HTTP."""
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    if not data.size:
+        return None
+    flag = cv2.IMREAD_GRAYSCALE
+    if reduce:
+        try:
+            with Image.open(io.BytesIO(data)) as header:
+                flag = scan_read_flag(header.size, page_size)
+        except (OSError, ValueError):
+            pass
+    return cv2.imdecode(data, flag)
+
+
+def load_scan_libraries():
+    """تحميل OpenCV و NumPy و Pillow فوراً، قبل قراءة الصور من عدة خيوط (مرحلة القراءة في omr_ingest)."""
+    preload(np, cv2, Image)
+
+
+# --- قراءة رمز QR وتوجيه الورقة (الطالب، النموذج، التخطيط) ---
+
+_QR_DETECTOR = None
+
+
+def _qr_detector():
+    """كاشف QR واحد لكل عملية؛ يُفضَّل QRCodeDetectorAruco (أكثر تحملاً للمسح) عند توفره."""
+    global _QR_DETECTOR
+    if _QR_DETECTOR is None:
+        aruco_detector = getattr(cv2, 'QRCodeDetectorAruco', None)
+        _QR_DETECTOR = aruco_detector() if aruco_detector else cv2.QRCodeDetector()
+    return _QR_DETECTOR
+
+
+def parse_qr_payload(text):
+    """
+    تحويل نص QR إلى قاموس موحّد: student_id, student_name, subject_id, exam_id, num_questions,
+    model_type, layout_id, page, page_count. يدعم الصيغة المختصرة الحالية والصيغة القديمة ذات المفاتيح العربية.
+    """
+    try:
+        payload = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(payload, dict):
+        return None
+
+    if 'sid' in payload:
+        return {
+            'student_id': payload.get('sid'),
+            'student_name': payload.get('name'),
+            'subject_id': payload.get('sub'),
+            'exam_id': payload.get('eid'),
+            'num_questions': payload.get('n'),
+            'model_type': payload.get('m'),
+            'layout_id': payload.get('lid'),
+            'page': payload.get('p', 1),
+            'page_count': payload.get('pc', 1),
+        }
+
+    exam_details = payload.get("معلومات الامتحان") or {}
+    return {
+        'student_id': payload.get("ID الطالب"),
+        'student_name': payload.get("اسم الطالب"),
+        'subject_id': payload.get("معرف المادة"),
+        'exam_id': None,
+        'num_questions': payload.get("عدد الأسئلة"),
+        'model_type': exam_details.get("نوع النموذج"),
+        'layout_id': payload.get('layout_id'),
+        'page': 1,
+        'page_count': 1,
+    }
+
+
+def _qr_attempts(crop):
+    """
+    صيغ منطقة QR التي تُجرب بالترتيب (تُحسب عند الحاجة فقط): الصورة الثنائية تكفي غالباً،
+    والمسوحات المموهة أو المائلة تحتاج الرمادي الأصلي أو تكبيره بتنعيم.
+    """
+    yield cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    yield crop
+    yield cv2.resize(crop, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+
+
+def decode_sheet_qr(gray, page_size=DEFAULT_PAGE_SIZE):
+    """
+    قراءة رمز QR من منطقة الرأس المعروفة فقط (QR_SEARCH_REGION) بدلاً من الصفحة كاملة.
+    المسوحات عالية الدقة تُصغَّر أولاً إلى مقياس التخطيط، ثم يُعاد المحاولة بالدقة الكاملة عند الفشل.
+    تُرجع القاموس الموحّد من parse_qr_payload أو None.
+    """
+    img_h, img_w = gray.shape[:2]
+    x0, y0, x1, y1 = QR_SEARCH_REGION
+    crop = gray[int(y0 * img_h):int(y1 * img_h), int(x0 * img_w):int(x1 * img_w)]
+    if crop.size == 0:
+        return None
+
+    scale = img_w / float(page_size[0])
+    candidates = []
+    if scale > 1.25:
+        candidates.append(cv2.resize(crop, None, fx=1.0 / scale, fy=1.0 / scale, interpolation=cv2.INTER_AREA))
+    candidates.append(crop)
+
+    detector = _qr_detector()
+    for candidate in candidates:
+        for attempt in _qr_attempts(candidate):
+            try:
+                text = detector.detectAndDecode(attempt)[0]
+            except cv2.error:
+                text = ''
+            if text:
+                return parse_qr_payload(text)
+    return None
+
+
+def analyze_sheet(gray, default_layout=None, layout_dir=LAYOUT_SEARCH_DIR, answer_keys=None, layouts=None, qr=None):
+    """
+    مسار تحليل ورقة واحدة: QR ← اختيار التخطيط ومفتاح الإجابة ← التسجيل ← تطبيع الشدة ← استخراج الإجابات وثقتها.
+    الأسئلة المشكوك فيها تُجمع في "review" (review_items) للمراجعة اليدوية.
+    تخطيط QR يُبحث عنه أولاً في layouts ({layout_id: تخطيط} في الذاكرة) ثم في سجل layout_dir (None: لا قراءة من القرص).
+    إذا لم يُقرأ QR أو لم يحمل معرف تخطيط، يُستخدم default_layout (إن وُجد).
+    qr نتيجة قراءة سابقة لرمز QR (precheck_sheet؛ {} إذا تعذرت) فلا يُقرأ مرة ثانية.
+    تُرجع (sheet, marked_bboxes, fills) حيث sheet قاموس بحقول السجل، أو ترفع ValueError عند غياب التخطيط.
+    """
+    if qr is None:
+        with instrumentation.timer('scan.qr'):
+            qr = decode_sheet_qr(gray)
+    if not qr:
+        instrumentation.count('scan.qr_unreadable')
+    layout = None
+    if qr and qr.get('layout_id'):
+        layout = (layouts or {}).get(qr['layout_id'])
+        if layout is None and layout_dir:
+            layout = resolve_layout(qr['layout_id'], layout_dir=layout_dir)
+    if layout is None:
+        layout = default_layout
+    if layout is None:
+        raise ValueError("no bubble layout: QR unreadable and no default layout given")
+
+    with instrumentation.timer('scan.register'):
+        registered_bboxes, registration = register_sheet(gray, layout)
+    with instrumentation.timer('scan.extract'):
+        means = bubble_mean_intensity(gray, registered_bboxes, use_cache=registered_bboxes is layout['bboxes'])
+        intensity = sheet_intensity(means, registration.get('ink_level'))
+        darkness = bubble_darkness(means, intensity)
+        final_answers, marked_bboxes, fills = extract_answers(gray, layout, registered_bboxes,
+                                                              intensity['threshold'], darkness)
+        review = review_items(final_answers, fills, darkness, registered_bboxes, layout)
+    if review:
+        instrumentation.count('scan.review_questions', len(review))
+
+    qr = qr or {}
+    model_type = qr.get('model_type')
+    sheet = {
+        "qr": bool(qr),
+        "student": {"id": qr.get('student_id'), "name": qr.get('student_name')} if qr else None,
+        "subject_id": qr.get('subject_id'),
+        "exam_id": qr.get('exam_id'),
+        "model_type": model_type,
+        "layout_id": layout.get('layout_id'),
+        "page": qr.get('page', 1),
+        "page_count": qr.get('page_count', 1),
+        "registration": registration,
+        "intensity": intensity,
+        "answers": final_answers,
+        "fills": np.round(fills, 3).tolist(),
+        "review": review,
+        "answer_key": (answer_keys or {}).get(model_type) if model_type else None,
+    }
+    return sheet, marked_bboxes, fills
+
+
+# --- كشف الأوراق المكررة وإعادة المسح قبل الاستخراج (انظر scan_dedup) ---
+
+def precheck_file(image_path, record, dedup=None):
+    """
+    قبل فك الترميز: بصمة SHA-256 لملف الصورة في السجل، ومع فهرس dedup قرار التكرار في "dedup".
+    تُرجع False إذا كان الملف نفسه معروفاً (السجل بحالة 'skipped' دون قراءة الصورة).
+    """
+    record["image_sha256"] = file_digest(image_path)
+    record["dedup"] = dedup.check_file(record["image_sha256"]) if dedup is not None else None
+    if record["dedup"]:
+        record["status"] = "skipped"
+        instrumentation.count('scan.skipped_duplicate')
+        return False
+    return True
+
+
+def precheck_sheet(gray, record, dedup=None):
+    """
+    بعد فك الترميز وقبل التسجيل والاستخراج: قراءة QR والبصمة الإدراكية للصفحة ("phash" في السجل)، ومع فهرس dedup
+    قرار إعادة المسح لهوية ممسوحة سابقاً في "dedup". تُرجع نتيجة QR لـ analyze_sheet ({} إذا تعذرت قراءته)،
+    أو None إذا تقرر تخطي الورقة (السجل بحالة 'skipped').
+    """
+    with instrumentation.timer('scan.qr'):
+        qr = decode_sheet_qr(gray) or {}
+    with instrumentation.timer('scan.phash'):
+        record["phash"] = perceptual_hash(gray)
+    key = qr_sheet_key(qr) if dedup is not None else None
+    if key is not None:
+        record["dedup"] = dedup.check_sheet(key, record["phash"])
+        if record["dedup"] and record["dedup"]["skipped"]:
+            record["status"] = "skipped"
+            instrumentation.count('scan.skipped_rescan')
+            return None
+    return qr
+
+
+def dedup_note(decision):
+    """وصف قرار التكرار لسطر التقدم."""
+    if decision["decision"] == "duplicate":
+        return f"نفس ملف {decision['original']}"
+    label = "إعادة مسح" if decision["decision"] == "rescan" else "صورة مختلفة بنفس الهوية"
+    distance = f"، مسافة {decision['distance']}" if decision["distance"] is not None else ""
+    return f"{label} لـ {decision['original']}{distance}"
+
+
+def _known_sheet_result(record, dedup, results_db):
+    """نتيجة process_omr_sheet لورقة متخطاة: نتيجتها المخزنة (مع تسجيل رؤية ملفها) بدلاً من الاستخراج."""
+    with ResultsStore(results_db) as store:
+        record, fresh = settle_scan(record, dedup, store)
+        if fresh:
+            print(f"❌ خطأ: {record['error']} (أعد المسح مع --no-dedup).")
+            return None
+        store.record_fingerprint(record)
+    student = record.get("student") or {}
+    print(f"⏭️ الورقة ممسوحة سابقاً ({dedup_note(record['dedup'])}): الطالب {student.get('name')} "
+          f"({student.get('id')}) - النموذج {record.get('model_type')}؛ تم استخدام نتيجتها المخزنة دون استخراج.")
+    return build_output_data([record])
+
+
+def process_omr_sheet(image_path, json_data_path, show=True, results_db=RESULTS_DB_FILE,
+                      rescan_policy=DEFAULT_RESCAN_POLICY):
+    # 0. ملف مسح سابقاً في المخزن يُتخطى قبل فك ترميزه (rescan_policy=None يعطّل كشف التكرار)
+    record = new_scan_record(image_path)
+    dedup = None
+    if rescan_policy and os.path.exists(results_db):
+        with ResultsStore(results_db) as store:
+            dedup = DedupIndex(store.fingerprints(), rescan_policy)
+        if os.path.isfile(image_path) and not precheck_file(image_path, record, dedup):
+            return _known_sheet_result(record, dedup, results_db)
+
+    # 1. تحميل الصورة (رمادية ومصغرة إلى دقة التخطيط) والتحقق من وجودها
+    gray = read_scan(image_path)
+    if gray is None:
+        print(f"❌ خطأ: تعذر تحميل الصورة من المسار {image_path}. يرجى التأكد من وجود ملف 'text_exam.png' في نفس المجلد.")
+        return None
+    
+    print(f"✅ تم تحميل الصورة بنجاح: {image_path}")
+
+    # 2. تحميل بيانات الفقاعات من JSON (تُستخدم فقط إذا لم يحدد رمز QR تخطيط الورقة)
+    questions_data = load_bubble_data(json_data_path) if json_data_path and os.path.exists(json_data_path) else None
+    default_layout = build_layout_arrays(questions_data) if questions_data is not None else None
+
+    # ملاحظة: لم نعد نحتاج إلى Blur، Canny، أو Contours، حيث نعتمد على الإحداثيات مباشرة.
+
+    # إعادة مسح لورقة مخزنة (نفس هوية QR وبصمة إدراكية قريبة) تُتخطى قبل التسجيل والاستخراج
+    qr = precheck_sheet(gray, record, dedup)
+    if qr is None:
+        return _known_sheet_result(record, dedup, results_db)
+
+    try:
+        sheet, marked_bboxes, _ = analyze_sheet(gray, default_layout, qr=qr)
+    except ValueError as e:
+        print(f"❌ خطأ: {e}")
+        return None
+
+    global TOTAL_QUESTIONS
+    TOTAL_QUESTIONS = len(sheet["answers"])
+    if sheet["qr"]:
+        print(f"🔎 QR: الطالب {sheet['student']['name']} ({sheet['student']['id']}) - النموذج {sheet['model_type']} - التخطيط {sheet['layout_id']}")
+    else:
+        print("⚠️ تنبيه: تعذرت قراءة رمز QR، تم استخدام ملف بيانات الفقاعات المحدد.")
+    registration = sheet["registration"]
+    print(f"📐 تسجيل الصفحة: {registration['method']} ({registration['markers']} علامات، {registration['ms']} ms)")
+    if record["dedup"]:
+        print(f"♻️ تحل محل مسح سابق: {dedup_note(record['dedup'])}")
+    for item in sheet["review"]:
+        print(f"🔍 مراجعة السؤال {item['id']}: {item['answer']} (ثقة {item['confidence']}، {', '.join(item['flags'])}) "
+              f"- التظليل {item['fills']}")
+    final_answers = sheet["answers"]
+    output_image = draw_detected_answers(gray, marked_bboxes)
+
+    # 7. حفظ الورقة في مخزن النتائج (إعادة مسح نفس الورقة تُحدّث سجلها). ملف JSON بالبنية المطلوبة لكل أوراق
+    # الامتحان يُصدّر من المخزن عند الطلب (results_store.py --export) لا بعد كل ورقة
+    record.update(sheet, status="ok")
+    record["image_sha256"] = record["image_sha256"] or file_digest(image_path)
+    with ResultsStore(results_db) as store:
+        store.upsert_sheet(record)
+
+    print(f"\n✅ تم حفظ الإجابات في {results_db} لـ {len(final_answers)} سؤال. للتصدير بالبنية المطلوبة: "
+          f"python results_store.py {results_db} --exam {sheet.get('exam_id')} --export student_answers.json")
+    
+    # حفظ وعرض الصورة المعالجة
+    output_image_path = 'output_answers_structured_json_based_image.png'
+    cv2.imwrite(output_image_path, output_image)
+    print(f"✅ تم حفظ الصورة المعالجة في: {output_image_path}")
+
+    # عرض الصورة المعالجة باستخدام OpenCV
+    if show and os.path.exists(image_path):
+        cv2.imshow("OMR Answers Detected (JSON Based)", output_image)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+    # القيمة المُرجعة لهذه الورقة وحدها (بنفس البنية)
+    return build_output_data([record])
+
+
+# --- تجميع صفحات ورقة الإجابة متعددة الصفحات ---
+
+def sheet_identity(record):
+    """هوية الطالب في ورقة ناجحة ذات QR: (الامتحان، الطالب، النموذج)، أو None."""
+    student = record.get("student") or {}
+    if record.get("status") != "ok" or student.get("id") is None:
+        return None
+    return (record.get("exam_id"), student.get("id"), record.get("model_type"))
+
+
+def merge_pages(page_records, duplicates=()):
+    """
+    دمج صفحات طالب واحد (بأي ترتيب) في سجل واحد: الإجابات مرتبة حسب رقم السؤال، و sources/pages بترتيب الصفحات،
+    و missing_pages للصفحات التي لم تُمسح (أسئلتها تُعامل كغير مجابة عند التصحيح).
+    """
+    pages = sorted(page_records, key=lambda r: r["page"])
+    first = pages[0]
+    present = {r["page"] for r in pages}
+    merged = {key: value for key, value in first.items() if key not in ("annotated_image", "latency_seconds", "grade")}
+    merged.update({
+        "page": None,
+        "pages": [r["page"] for r in pages],
+        "missing_pages": [p for p in range(1, first["page_count"] + 1) if p not in present],
+        "sources": [r["source"] for r in pages],
+        "duplicate_sources": list(duplicates),
+        "layout_id": [r["layout_id"] for r in pages],
+        "registration": [r["registration"] for r in pages],
+        "intensity": [r.get("intensity") for r in pages],
+        "answers": sorted((a for r in pages for a in r["answers"]), key=lambda a: a["id"]),
+        "fills": [row for r in pages for row in r.get("fills", [])],
+        "review": [item for r in pages for item in r.get("review", [])],
+    })
+    return merged
+
+
+class PageAssembler:
+    """
+    يجمع صفحات ورقة الإجابة متعددة الصفحات (حسب page/page_count في QR) لكل طالب في سجل واحد، مهما كان ترتيب المسح.
+    add(record) تُرجع السجل نفسه لورقة الصفحة الواحدة (أو الفاشلة)، والسجل المدمج عند وصول آخر صفحات الطالب،
+    و None ما دامت صفحاته ناقصة. flush() تُرجع الطلاب الذين لم تكتمل صفحاتهم (مع missing_pages).
+    الصفحة الممسوحة مرتين تُحسب مرة واحدة (الأولى) ويُسجل مصدر النسخة المكررة في duplicate_sources،
+    حتى إذا وصلت بعد اكتمال الطالب (تُضاف عندها إلى سجله المدمج ولا يُعاد إرجاعه).
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._duplicates = {}
+        self._completed = {}
+
+    def add(self, record):
+        key = sheet_identity(record)
+        if key is None or (record.get("page_count") or 1) <= 1:
+            return record
+        if key in self._completed:
+            self._completed[key]["duplicate_sources"].append(record["source"])
+            return None
+
+        pages = self._pending.setdefault(key, {})
+        if record["page"] in pages:
+            self._duplicates.setdefault(key, []).append(record["source"])
+        else:
+            pages[record["page"]] = record
+        if len(pages) < record["page_count"]:
+            return None
+        merged = merge_pages(self._pending.pop(key).values(), self._duplicates.pop(key, ()))
+        self._completed[key] = merged
+        return merged
+
+    def flush(self):
+        incomplete = [merge_pages(pages.values(), self._duplicates.pop(key, ())) for key, pages in self._pending.items()]
+        self._pending.clear()
+        return incomplete
+
+    def __len__(self):
+        return len(self._pending)
+
+
+# --- 4. المعالجة الدفعية (Batch) بدون واجهة عرض ---
+
+# سياق العملية العاملة: التخطيط الافتراضي، مجلد التخطيطات، ومفاتيح الإجابة (تُحمّل مرة واحدة)
+_WORKER_CONTEXT = {'layout': None, 'layout_dir': LAYOUT_SEARCH_DIR, 'answer_keys': {}, 'full_resolution': False,
+                   'dedup': None}
+
+
+def init_scan_worker(json_data_path=None, layout_id=None, layout_dir=LAYOUT_SEARCH_DIR, answer_keys_path=None,
+                     metrics=False, profile_pattern=None, full_resolution=False, preload_layouts=False, dedup=None):
+    """
+    تهيئة العملية العاملة: تحميل التخطيط الافتراضي (اختياري، للأوراق دون QR مقروء) ومفاتيح الإجابة
+    مرة واحدة بدلاً من كل ورقة. تخطيطات الأوراق المحددة عبر QR تُحمّل عند الحاجة وتُحفظ مؤقتاً،
+    أو كلها مسبقاً مع preload_layouts (للعمليات طويلة العمر في خدمة المسح، فلا تدفع أول ورقة كلفة التحميل).
+    metrics يفعّل القياسات داخل العملية، و profile_pattern (نمط اسم ملف) يحدد الأوراق التي تُحلل أداءها،
+    و full_resolution يقرأ الصور بدقتها الكاملة بدلاً من تصغيرها إلى دقة التخطيط.
+    dedup فهرس البصمات (DedupIndex) لتخطي الأوراق المعروفة قبل فك ترميزها أو استخراجها.
+    """
+    instrumentation.reset()
+    instrumentation.enable(metrics)
+    layout = resolve_layout(layout_id, json_data_path, layout_dir) if (layout_id or json_data_path) else None
+    _WORKER_CONTEXT.update(layout=layout, layout_dir=layout_dir, answer_keys=load_answer_keys(answer_keys_path),
+                           profile_pattern=profile_pattern, full_resolution=full_resolution, dedup=dedup)
+    if preload_layouts:
+        # الأحدث أولاً، بحدود ذاكرة التخطيطات المؤقتة
+        recent = sorted(glob.glob(os.path.join(layout_dir, '*.npz')), key=os.path.getmtime, reverse=True)
+        for path in recent[:LAYOUT_CACHE_SIZE]:
+            resolve_layout(os.path.splitext(os.path.basename(path))[0], layout_dir=layout_dir)
+        _qr_detector()
+
+
+def new_scan_record(image_path):
+    """سجل نتيجة ورقة فارغ (بحالة 'failed' حتى تنجح المعالجة)."""
+    return {"source": image_path, "status": "failed", "scanned_at": scan_timestamp(), "image_sha256": None,
+            "phash": None, "dedup": None, "qr": False, "student": None, "answers": [], "review": [],
+            "registration": None, "error": None, "annotated_image": None}
+
+
+def scan_sheet(image_path, layout=None, annotate_path=None, layout_dir=LAYOUT_SEARCH_DIR, answer_keys=None,
+               triage_dir=None, full_resolution=False, dedup=None):
+    """
+    معالجة ورقة واحدة بدون عرض أو ملفات مشتركة، وإرجاع سجل النتيجة كقاموس:
+    {"source", "status" ('ok' | 'failed' | 'skipped'), "scanned_at", "image_sha256", "phash", "dedup", "qr", "student",
+     "subject_id", "exam_id", "model_type", "layout_id", "page", "page_count", "registration", "intensity", "answers",
+     "fills", "review", "answer_key", "error", "annotated_image"}.
+    الطالب والنموذج والتخطيط تُحدد من رمز QR؛ layout هو التخطيط الاحتياطي فقط.
+    لا يتم إنشاء الصورة المعلّمة إلا عند تمرير annotate_path، ولا قصاصات المراجعة إلا عند تمرير triage_dir.
+    الصورة تُقرأ رمادية ومصغرة إلى دقة التخطيط (read_scan) إلا عند full_resolution.
+    مع فهرس dedup تُتخطى الورقة المعروفة (status='skipped' وقرارها في "dedup") قبل فك الترميز أو قبل الاستخراج.
+    """
+    record = new_scan_record(image_path)
+    try:
+        if dedup is not None and not precheck_file(image_path, record, dedup):
+            return record
+        with instrumentation.timer('scan.imread'):
+            gray = read_scan(image_path, (layout or {}).get('page_size', DEFAULT_PAGE_SIZE), not full_resolution)
+        if gray is None:
+            record["error"] = "could not read image"
+            return record
+        record["image_sha256"] = record["image_sha256"] or file_digest(image_path)
+
+        qr = precheck_sheet(gray, record, dedup)
+        if qr is None:
+            return record
+        sheet, marked_bboxes, _ = analyze_sheet(gray, layout, layout_dir, answer_keys, qr=qr)
+        record.update(sheet)
+        if triage_dir:
+            save_review_snippets(gray, record["review"], triage_dir, os.path.splitext(os.path.basename(image_path))[0])
+
+        if annotate_path:
+            with instrumentation.timer('scan.annotate'):
+                cv2.imwrite(annotate_path, draw_detected_answers(gray, marked_bboxes))
+            record["annotated_image"] = annotate_path
+
+        record["status"] = "ok"
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def _batch_scan_job(job):
+    """
+    مهمة ورقة واحدة داخل المجمع؛ تكتب سجل الورقة في مجلد الإخراج وتعيده.
+    عند تفعيل القياسات تُرفق قياسات العملية في الحقل "metrics" (تُزال في العملية الرئيسية بعد دمجها)،
+    والأوراق المطابقة لـ profile_pattern تُحلل بـ cProfile/tracemalloc في مجلد profiles داخل مجلد الإخراج.
+    """
+    image_path, output_dir, annotate = job
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    annotate_path = os.path.join(output_dir, f"{stem}_annotated.png") if annotate else None
+
+    profile_pattern = _WORKER_CONTEXT.get('profile_pattern')
+    if profile_pattern and fnmatch.fnmatch(os.path.basename(image_path), profile_pattern):
+        profile = instrumentation.profiled(f"sheet_{stem}", os.path.join(output_dir, 'profiles'))
+    else:
+        profile = contextlib.nullcontext()
+
+    with profile, contextlib.redirect_stdout(io.StringIO()), instrumentation.timer('scan.sheet'):
+        record = scan_sheet(image_path, _WORKER_CONTEXT['layout'], annotate_path,
+                            _WORKER_CONTEXT['layout_dir'], _WORKER_CONTEXT['answer_keys'],
+                            os.path.join(output_dir, TRIAGE_DIR_NAME), _WORKER_CONTEXT['full_resolution'],
+                            _WORKER_CONTEXT['dedup'])
+
+    with instrumentation.timer('scan.json_write'):
+        record_path = os.path.join(output_dir, f"{stem}.json")
+        with open(record_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=4)
+    instrumentation.count(f"scan.sheets_{record['status']}")
+
+    metrics = instrumentation.drain()
+    if metrics:
+        record["metrics"] = metrics
+    return record
+
+
+def scan_decoded_sheet(job):
+    """
+    مهمة ورقة مفكوكة مسبقاً (source، صورة رمادية، مجلد قصاصات المراجعة أو None) داخل مجمع عمليات
+    مهيأ بـ init_scan_worker. يستخدمها وضع الاستقبال المستمر (omr_ingest) حيث تتم قراءة الصور في مرحلة منفصلة.
+    إعادة مسح ورقة معروفة في فهرس العملية تُرجع بحالة 'skipped' دون استخراج.
+    """
+    image_path, gray, triage_dir = job
+    record = new_scan_record(image_path)
+    try:
+        qr = precheck_sheet(gray, record, _WORKER_CONTEXT['dedup'])
+        if qr is None:
+            return record
+        with contextlib.redirect_stdout(io.StringIO()):
+            sheet, _, _ = analyze_sheet(gray, _WORKER_CONTEXT['layout'], _WORKER_CONTEXT['layout_dir'],
+                                        _WORKER_CONTEXT['answer_keys'], qr=qr)
+        record.update(sheet)
+        if triage_dir:
+            save_review_snippets(gray, record["review"], triage_dir, os.path.splitext(os.path.basename(image_path))[0])
+        record["status"] = "ok"
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def scan_uploaded_sheet(job):
+    """
+    مهمة صورة مرفوعة (الاسم، محتوى الملف) داخل مجمع عمليات مهيأ بـ init_scan_worker (خدمة المسح omr_service):
+    فك الترميز والاستخراج داخل العملية العاملة. تُرجع سجل الورقة مع بصمة المحتوى، ومع قياسات العملية
+    في "metrics" عند تفعيلها.
+    """
+    name, data = job
+    with instrumentation.timer('scan.sheet'):
+        with instrumentation.timer('scan.imread'):
+            gray = decode_scan_bytes(data, reduce=not _WORKER_CONTEXT['full_resolution'])
+        if gray is None:
+            record = new_scan_record(name)
+            record["error"] = "could not read image"
+        else:
+            record = scan_decoded_sheet((name, gray, None))
+    record["image_sha256"] = hashlib.sha256(data).hexdigest()
+    instrumentation.count(f"scan.sheets_{record['status']}")
+
+    metrics = instrumentation.drain()
+    if metrics:
+        record["metrics"] = metrics
+    return record
+
+
+def assemble_students(records, answer_keys=None):
+    """
+    سجلات أوراق مُسحت معاً ← سجل لكل طالب: صفحات ورقة الإجابة متعددة الصفحات تُدمج (PageAssembler، مع الطلاب
+    ناقصي الصفحات)، والناجحة منها تُصحح بمفاتيح الإجابة إن وُجدت (الدرجة في "grade" بحقول GRADE_FIELDS).
+    """
+    assembler = PageAssembler()
+    students = [student for student in map(assembler.add, records) if student is not None]
+    students.extend(assembler.flush())
+    if answer_keys:
+        graded = [r for r in students if r["status"] == "ok"]
+        for record, grade in zip(graded, grade_records(graded, answer_keys)["students"]):
+            record["grade"] = {key: grade[key] for key in GRADE_FIELDS}
+    return students
+
+
+# --- واجهة المكتبة: المسح في الذاكرة دون ملفات (In-process API) ---
+# لخادم الويب أو أي برنامج يستورد الوحدة مباشرة: الصور والتخطيطات ومفاتيح الإجابة كائنات في الذاكرة،
+# والنتيجة سجلات (قواميس) كما في المعالجة الدفعية، دون قراءة أو كتابة أي ملف ما لم يُمرر layout_dir.
+
+def as_gray_image(image, page_size=DEFAULT_PAGE_SIZE, reduce=True):
+    """
+    صورة ورقة في الذاكرة كمصفوفة رمادية uint8: محتوى ملف صورة (bytes، يُفك ويُصغّر كما في read_scan)، أو مصفوفة
+    NumPy (رمادية، BGR / BGRA كما من OpenCV، أو منطقية من صفحة Pillow بنمط "1")، أو صورة Pillow.
+    تُرجع None إذا تعذر فك ترميز المحتوى.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_scan_bytes(image, page_size, reduce)
+    if isinstance(image, np.ndarray):
+        if image.dtype == np.bool_:
+            image = image.astype(np.uint8) * 255
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+        return np.ascontiguousarray(image, dtype=np.uint8)
+    return np.asarray(image.convert('L'))
+
+
+def scan_image(image, layouts=None, default_layout=None, answer_keys=None, layout_dir=None, name='image'):
+    """
+    مسح ورقة واحدة من الذاكرة (أي صيغة يقبلها as_gray_image) وإرجاع سجلها بنفس حقول scan_sheet، و source هو name.
+    التخطيط يُختار من QR ضمن layouts (مثل answer_sheet_layouts في generate_exams)، ثم من سجل layout_dir
+    إن مُرر، وإلا default_layout. الفشل يُسجل في "error" مع status='failed' بدلاً من رفع استثناء.
+    """
+    record = new_scan_record(name)
+    gray = as_gray_image(image, (default_layout or {}).get('page_size', DEFAULT_PAGE_SIZE))
+    if gray is None:
+        record["error"] = "could not read image"
+        return record
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        record["image_sha256"] = hashlib.sha256(image).hexdigest()
+    try:
+        sheet, _, _ = analyze_sheet(gray, default_layout, layout_dir, answer_keys, layouts)
+        record.update(sheet)
+        record["status"] = "ok"
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def scan_images(images, layouts=None, default_layout=None, answer_keys=None, layout_dir=None, names=None):
+    """
+    مسح عدة أوراق من الذاكرة معاً (صفحات الطالب بأي ترتيب)، ثم دمجها وتصحيحها (assemble_students).
+    تُرجع {"data": ...ملف الإجابات بالبنية المتداخلة...، "sheets": [سجل كل صورة]، "students": [سجل لكل طالب]}.
+    names أسماء الصور (source في السجلات)، والافتراضي image_1، image_2 ...
+    """
+    images = list(images)
+    names = names or [f"image_{index}" for index in range(1, len(images) + 1)]
+    records = [scan_image(image, layouts, default_layout, answer_keys, layout_dir, name)
+               for name, image in zip(names, images)]
+    students = assemble_students(records, answer_keys)
+    return {**build_output_data(students), "sheets": records, "students": students}
+
+
+def collect_scan_paths(inputs):
+    """تحويل مجلد أو نمط glob (أو قائمة منهما) إلى قائمة مرتبة بمسارات صور الأوراق."""
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        paths.extend(p for p in candidates if p.lower().endswith(SCAN_IMAGE_EXTENSIONS) and os.path.isfile(p))
+    return sorted(set(paths))
+
+
+def process_omr_batch(inputs, json_data_path=None, output_dir=BATCH_OUTPUT_DIR, workers=None, annotate=False,
+                      layout_id=None, layout_dir=LAYOUT_SEARCH_DIR, answer_keys_path=None,
+                      metrics_path=None, profile_pattern=None, full_resolution=False, results_db=None,
+                      rescan_policy=DEFAULT_RESCAN_POLICY):
+    """
+    معالجة مجلد (أو نمط glob) من الأوراق الممسوحة عبر مجمع عمليات بدون أي نوافذ عرض.
+    كل ورقة تُوجَّه تلقائياً عبر رمز QR (الطالب، النموذج، التخطيط، مفتاح الإجابة)، لذا يمكن خلط أوراق
+    طلاب ونماذج مختلفة في تشغيل واحد. layout_id أو ملف BubbleData JSON يُستخدمان فقط كتخطيط احتياطي.
+    يُكتب سجل JSON لكل ورقة في output_dir، إضافة إلى ملف مجمّع BATCH_SUMMARY_FILE،
+    وعند تمرير مفاتيح الإجابة تُصحح الدفعة كاملة مرة واحدة في GRADES_FILE.
+    كل صفحة تُحفظ في مخزن النتائج results_db (الافتراضي RESULTS_DB_FILE داخل output_dir) فتتراكم نتائج الدفعات
+    وإعادة مسح ورقة تُحدّث سجلها؛ ملف الإجابات BATCH_ANSWERS_FILE يُصدّر من المخزن (كل طلابه) في نهاية الدفعة.
+    الأسئلة المشكوك فيها (تظليل مزدوج أو قريب من العتبة) تُكتب في طابور المراجعة TRIAGE_FILE مع قصاصاتها
+    في مجلد TRIAGE_DIR_NAME، فلا يُراجع يدوياً إلا ما يحتاج مراجعة.
+    صفحات ورقة الإجابة متعددة الصفحات تُدمج لكل طالب (PageAssembler) قبل الإجابات والتصحيح.
+    metrics_path يفعّل قياس زمن المراحل ويصدرها في نهاية الدفعة (انظر instrumentation).
+    الصور تُقرأ رمادية ومصغرة إلى دقة التخطيط (read_scan) لتقليل ذاكرة كل عملية، إلا عند full_resolution.
+    الأوراق الممسوحة سابقاً في المخزن أو في الدفعة نفسها (scan_dedup) تُتخطى قبل فك الترميز أو الاستخراج وتأخذ
+    نتيجتها المخزنة؛ إعادة مسح هوية معروفة تحل محل نتيجتها مع rescan_policy='replace'، و None يعطّل الفحص.
+    """
+    image_paths = collect_scan_paths(inputs)
+    if not image_paths:
+        print(f"❌ خطأ: لا توجد صور أوراق في: {inputs}")
+        return None
+
+    os.makedirs(output_dir, exist_ok=True)
+    # قصاصات المراجعة تُبنى من جديد في كل دفعة
+    for stale_path in glob.glob(os.path.join(output_dir, TRIAGE_DIR_NAME, '*.png')):
+        os.remove(stale_path)
+
+    if not workers or workers < 1:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(image_paths))
+
+    print(f"🌟 جارٍ معالجة {len(image_paths)} ورقة باستخدام {workers} عملية...")
+
+    jobs = [(path, output_dir, annotate) for path in image_paths]
+    chunksize = max(1, len(jobs) // (workers * 8))
+    records = []
+    # سجلات الطلاب بعد دمج صفحات أوراق الإجابة متعددة الصفحات (للإجابات والتصحيح)
+    students = []
+    assembler = PageAssembler()
+    store = ResultsStore(results_db or os.path.join(output_dir, RESULTS_DB_FILE))
+    dedup = DedupIndex(store.fingerprints(), rescan_policy) if rescan_policy else None
+    start_time = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_scan_worker,
+                                                initargs=(json_data_path, layout_id, layout_dir, answer_keys_path,
+                                                          bool(metrics_path), profile_pattern,
+                                                          full_resolution, False, dedup)) as executor:
+        for index, record in enumerate(executor.map(_batch_scan_job, jobs, chunksize=chunksize), start=1):
+            instrumentation.merge(record.pop("metrics", None))
+            fresh = True
+            if dedup is not None:
+                # العمليات ترى الفهرس كما كان عند بدء الدفعة؛ تكرار أوراق الدفعة نفسها يُحسم هنا
+                record, fresh = settle_scan(record, dedup, store)
+            records.append(record)
+            with instrumentation.timer('scan.store_write'):
+                if fresh:
+                    store.upsert_sheet(record)
+                else:
+                    store.record_fingerprint(record)
+            if dedup is not None and record["status"] == "ok":
+                dedup.add(record)
+            student_record = assembler.add(record)
+            if student_record is not None:
+                students.append(student_record)
+            student = record.get("student") or {}
+            if not fresh:
+                print(f"[{index}/{len(jobs)}] ⏭️ {record['source']} -> {student.get('name', '؟')} "
+                      f"(ممسوحة سابقاً: {dedup_note(record['dedup'])})")
+            elif record["status"] == "ok":
+                replaced = f" ♻️ تحل محل مسح سابق: {dedup_note(record['dedup'])}" if record.get("dedup") else ""
+                print(f"[{index}/{len(jobs)}] ✅ {record['source']} -> {student.get('name', '؟')} "
+                      f"({record.get('model_type')}){replaced}")
+            else:
+                print(f"[{index}/{len(jobs)}] ❌ {record['source']}: {record['error']}")
+
+    incomplete = assembler.flush()
+    students.extend(incomplete)
+    for record in incomplete:
+        print(f"⚠️ ورقة ناقصة: {record['student'].get('name')} ({record['student'].get('id')}) - "
+              f"صفحات غير ممسوحة: {record['missing_pages']}")
+    for record in students:
+        for source in record.get("duplicate_sources", []):
+            print(f"⚠️ صفحة مكررة (لم تُحتسب): {source} - الطالب {record['student'].get('id')}")
+
+    elapsed = time.perf_counter() - start_time
+    triage = build_triage_queue(records)
+    decisions = [dict(record["dedup"], source=record["source"]) for record in records if record.get("dedup")]
+    # المتخطاة تحمل نتيجتها المخزنة (status='ok') لكنها لم تُستخرج في هذه الدفعة، فتُعد وحدها
+    num_skipped = sum(1 for r in records if r["status"] == "ok" and r.get("dedup") and r["dedup"]["skipped"])
+    num_ok = sum(1 for r in records if r["status"] == "ok") - num_skipped
+    summary = {
+        "total": len(records),
+        "ok": num_ok,
+        "skipped": num_skipped,
+        "failed": len(records) - num_ok - num_skipped,
+        "skipped_sheets": [decision for decision in decisions if decision["skipped"]],
+        "replaced_sheets": [decision for decision in decisions if not decision["skipped"]],
+        "students": sum(1 for r in students if r["status"] == "ok"),
+        "incomplete_students": [{"id": r["student"].get("id"), "missing_pages": r["missing_pages"]} for r in incomplete],
+        "duplicate_pages": [source for r in students for source in r.get("duplicate_sources", [])],
+        "flagged_sheets": triage["flagged_sheets"],
+        "flagged_questions": triage["flagged_questions"],
+        "elapsed_seconds": round(elapsed, 3),
+        "sheets_per_minute": round(len(records) / elapsed * 60, 1) if elapsed > 0 else None,
+        "results": records,
+    }
+
+    summary_path = os.path.join(output_dir, BATCH_SUMMARY_FILE)
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
+
+    answers_path = os.path.join(output_dir, BATCH_ANSWERS_FILE)
+    with open(answers_path, 'w', encoding='utf-8') as f:
+        json.dump(store.export_output_data(), f, ensure_ascii=False, indent=4)
+    store_counts = store.counts()
+    store.close()
+
+    print(f"\n📋 تمت معالجة {summary['total']} ورقة: ✅ {summary['ok']} | ⏭️ ممسوحة سابقاً {summary['skipped']} "
+          f"| ❌ {summary['failed']} ({summary['sheets_per_minute']} ورقة/دقيقة)")
+    if summary['replaced_sheets']:
+        print(f"♻️ {len(summary['replaced_sheets'])} ورقة حلت محل مسح سابق لنفس الهوية.")
+    print(f"✅ تم حفظ النتائج المجمّعة في: {summary_path}")
+    print(f"🗄️ مخزن النتائج: {store.path} ({store_counts['sheets']} صفحة لـ {store_counts['students']} طالب)")
+
+    triage_path = os.path.join(output_dir, TRIAGE_FILE)
+    with open(triage_path, 'w', encoding='utf-8') as f:
+        json.dump(triage, f, ensure_ascii=False, indent=4)
+    print(f"🔍 طابور المراجعة: {triage['flagged_questions']} سؤال في {triage['flagged_sheets']} من "
+          f"{triage['total_sheets']} ورقة في: {triage_path}")
+
+    if answer_keys_path:
+        grades = grade_records(students, load_answer_keys(answer_keys_path))
+        grades_path = save_grades(grades, os.path.join(output_dir, GRADES_FILE))
+        print(f"✅ تم تصحيح {grades['num_students']} ورقة (بدون مفتاح: {grades['num_ungraded']}) في: {grades_path}")
+
+    if metrics_path:
+        instrumentation.write_metrics(metrics_path, {'pipeline': 'scan', 'workers': workers,
+                                                     'elapsed_s': summary['elapsed_seconds'],
+                                                     'total': summary['total'], 'failed': summary['failed']})
+        print(f"📈 القياسات: {metrics_path}")
+    return summary
+
+
+# --- تنفيذ الكود ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="تصحيح أوراق الإجابة الممسوحة ضوئياً (OMR).")
+    parser.add_argument('--batch', nargs='+', metavar='PATH',
+                        help="مجلد أو نمط glob لصور الأوراق؛ يفعّل المعالجة الدفعية بدون عرض.")
+    parser.add_argument('--image', default=IMAGE_PATH, help="صورة الورقة في وضع الورقة الواحدة.")
+    parser.add_argument('--bubble-data', help="ملف بيانات الفقاعات (BubbleData JSON) كتخطيط احتياطي للأوراق دون QR مقروء.")
+    parser.add_argument('--layout', metavar='LAYOUT_ID', help="معرف تخطيط احتياطي من السجل المشترك للأوراق دون QR مقروء.")
+    parser.add_argument('--answer-keys', help="ملف JSON لمفاتيح الإجابة لكل نموذج.")
+    parser.add_argument('--layout-dir', default=LAYOUT_SEARCH_DIR, help="مجلد سجل تخطيطات الفقاعات.")
+    parser.add_argument('--output-dir', default=BATCH_OUTPUT_DIR, help="مجلد نتائج المعالجة الدفعية.")
+    parser.add_argument('-w', '--workers', type=int, default=0, help="عدد العمليات المتوازية (0 = عدد الأنوية).")
+    parser.add_argument('--annotate', action='store_true', help="حفظ صورة معلّمة بالإجابات لكل ورقة.")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="تفعيل قياس زمن المراحل وتصديره (JSON lines، أو Prometheus إذا انتهى المسار بـ .prom).")
+    parser.add_argument('--profile-sheets', metavar='PATTERN',
+                        help="نمط أسماء الأوراق (مثل 'scan_00*.png') لتحليلها بـ cProfile/tracemalloc.")
+    parser.add_argument('--full-resolution', action='store_true',
+                        help="قراءة الصور بدقتها الكاملة بدلاً من تصغيرها إلى دقة التخطيط (ذاكرة أكبر).")
+    parser.add_argument('--results-db', help="ملف مخزن النتائج (SQLite)؛ الافتراضي داخل مجلد النتائج للدفعات، "
+                                             f"و {RESULTS_DB_FILE} للورقة الواحدة.")
+    parser.add_argument('--rescan-policy', choices=RESCAN_POLICIES, default=DEFAULT_RESCAN_POLICY,
+                        help="إعادة مسح ورقة مخزنة (نفس هوية QR وصورة قريبة): تخطيها بنتيجتها المخزنة أو استبدالها.")
+    parser.add_argument('--no-dedup', action='store_true',
+                        help="معالجة كل الأوراق كاملة دون كشف الملفات المكررة وإعادة المسح.")
+    args = parser.parse_args()
+    rescan_policy = None if args.no_dedup else args.rescan_policy
+
+    if args.batch:
+        process_omr_batch(args.batch, args.bubble_data, args.output_dir, args.workers, args.annotate,
+                          layout_id=args.layout, layout_dir=args.layout_dir, answer_keys_path=args.answer_keys,
+                          metrics_path=args.metrics, profile_pattern=args.profile_sheets,
+                          full_resolution=args.full_resolution, results_db=args.results_db,
+                          rescan_policy=rescan_policy)
+    else:
+        # تمرير مسار الصورة ومسار ملف JSON إلى الدالة الرئيسية
+        process_omr_sheet(args.image, args.bubble_data or JSON_DATA_PATH,
+                          results_db=args.results_db or RESULTS_DB_FILE, rescan_policy=rescan_policy)
@@ -0,0 +1,265 @@
+import argparse
+import concurrent.futures
+import email.parser
+import email.policy
+import glob
+import json
+import os
+import signal
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from grading import load_answer_keys
+import instrumentation
+from omr_scanner import LAYOUT_SEARCH_DIR, assemble_students, init_scan_worker, scan_uploaded_sheet
+from results_store import ResultsStore, build_output_data
+
+# --- خدمة المسح المحلية (Local Scanning Service) ---
+# خادم HTTP طويل العمر (مكتبة Python القياسية فقط) لمحطة إعادة التدقيق: مجمع عمليات يُهيأ مرة واحدة عند البدء
+# (استيراد OpenCV/NumPy، التخطيطات المسجلة، مفاتيح الإجابة، كاشف QR)، فزمن الورقة الواحدة هو زمن الاستخراج فقط
+# بدلاً من تشغيل python omr_scanner.py من جديد لكل ورقة.
+#   POST /scan     صورة واحدة (محتوى الطلب هو الملف) أو عدة صور (multipart/form-data) ← ملف الإجابات بالبنية المتداخلة
+#   GET  /health   حالة الخدمة (JSON)
+#   GET  /metrics  زمن المراحل والعدادات بصيغة Prometheus
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+SCAN_TIMEOUT_SECONDS = 120.0
+
+
+def _warm_up(_):
+    """مهمة فارغة تُرسل لكل عملية عند البدء حتى تكتمل تهيئتها قبل أول طلب."""
+    return os.getpid()
+
+
+def parse_multipart(body, content_type):
+    """ملفات طلب multipart/form-data كقائمة (الاسم، المحتوى) بترتيبها في الطلب."""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode('latin-1') + b"\r\n\r\n" + body)
+    uploads = []
+    for index, part in enumerate(message.iter_parts(), start=1):
+        data = part.get_payload(decode=True)
+        if data:
+            uploads.append((part.get_filename() or part.get_param('name', header='content-disposition')
+                            or f"upload_{index}", data))
+    return uploads
+
+
+class ScanService:
+    """
+    مجمع عمليات المسح الدافئ وحالته. scan(uploads) يعالج صوراً مرفوعة [(الاسم، المحتوى)] ويُرجع
+    {"data": ...ملف الإجابات..., "sheets": [سجل كل صورة]}؛ صفحات ورقة الإجابة متعددة الصفحات المرفوعة معاً تُدمج لكل طالب.
+    القياسات مفعلة دائماً في الخدمة (كلفتها مهملة مقارنة بالاستخراج) لتُعرض في /metrics.
+    """
+
+    def __init__(self, workers=0, json_data_path=None, layout_id=None, layout_dir=LAYOUT_SEARCH_DIR,
+                 answer_keys_path=None, full_resolution=False, results_db=None):
+        self.workers = workers if workers and workers > 0 else (os.cpu_count() or 1)
+        self.layout_dir = layout_dir
+        self.worker_args = (json_data_path, layout_id, layout_dir, answer_keys_path, True, None, full_resolution, True)
+        self.answer_keys = load_answer_keys(answer_keys_path)
+        self.store = ResultsStore(results_db) if results_db else None
+        self.started_at = time.time()
+        self.in_flight = 0
+        self.pool = None
+        # القياسات والمخزن مشتركة بين خيوط الطلبات
+        self._lock = threading.Lock()
+
+    def start(self):
+        """إنشاء المجمع وتهيئة كل عملياته قبل استقبال الطلبات."""
+        instrumentation.enable(True)
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_scan_worker,
+                                                           initargs=self.worker_args)
+        list(self.pool.map(_warm_up, range(self.workers)))
+
+    def _restart_pool(self):
+        """عملية عاملة توقفت فجأة (BrokenProcessPool): مجمع جديد بدلاً من رفض كل الطلبات التالية."""
+        with self._lock:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_scan_worker,
+                                                               initargs=self.worker_args)
+            instrumentation.count('service.pool_restarts')
+
+    def scan(self, uploads):
+        start = time.perf_counter()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            pool = self.pool
+            futures = [pool.submit(scan_uploaded_sheet, upload) for upload in uploads]
+            try:
+                records = [future.result(timeout=SCAN_TIMEOUT_SECONDS) for future in futures]
+            except concurrent.futures.process.BrokenProcessPool:
+                self._restart_pool()
+                raise
+
+            students = assemble_students(records, self.answer_keys)
+
+            with self._lock:
+                for record in records:
+                    instrumentation.merge(record.pop("metrics", None))
+                if self.store is not None:
+                    self.store.upsert_sheets(records)
+                instrumentation.count('service.requests')
+                instrumentation.add_time('service.request', time.perf_counter() - start)
+            return {**build_output_data(students), "sheets": records,
+                    "students": [{"student": r.get("student"), "model_type": r.get("model_type"),
+                                  "missing_pages": r.get("missing_pages", []), "grade": r.get("grade")}
+                                 for r in students if r["status"] == "ok"]}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def health(self):
+        with self._lock:
+            counters = instrumentation.snapshot()['counters']
+        return {
+            "status": "ok",
+            "workers": self.workers,
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "in_flight": self.in_flight,
+            "requests": counters.get('service.requests', 0),
+            "sheets_ok": counters.get('scan.sheets_ok', 0),
+            "sheets_failed": counters.get('scan.sheets_failed', 0),
+            "layouts": len(glob.glob(os.path.join(self.layout_dir, '*.npz'))),
+            "answer_keys": sorted(self.answer_keys),
+            "results_db": self.store.path if self.store else None,
+        }
+
+    def metrics_text(self):
+        with self._lock:
+            text = instrumentation.prometheus_text()
+        return text + (f"# TYPE omr_service_uptime_seconds gauge\nomr_service_uptime_seconds "
+                       f"{round(time.time() - self.started_at, 1)}\n"
+                       f"# TYPE omr_service_in_flight gauge\nomr_service_in_flight {self.in_flight}\n"
+                       f"# TYPE omr_service_workers gauge\nomr_service_workers {self.workers}\n")
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        if self.store is not None:
+            self.store.close()
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+    server_version = "OMRScanService/1"
+    # اتصال دائم (keep-alive) لمحطة تُرسل أوراقاً متتالية
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self._send_json(self.server.service.health())
+        elif path == '/metrics':
+            self._send(HTTPStatus.OK, self.server.service.metrics_text().encode('utf-8'),
+                       'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            self._send_json({"error": "not found"}, HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/scan':
+            self._send_json({"error": "not found"}, HTTPStatus.NOT_FOUND)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            # طول غير مقروء: لا يمكن معرفة نهاية الجسم، فيُغلق الاتصال بعد الرد
+            self._send_json({"error": "invalid Content-Length header"}, HTTPStatus.BAD_REQUEST)
+            self.close_connection = True
+            return
+        if length <= 0:
+            self._send_json({"error": "empty request body"}, HTTPStatus.BAD_REQUEST)
+            return
+        if length > MAX_UPLOAD_BYTES:
+            self._send_json({"error": f"request body larger than {MAX_UPLOAD_BYTES} bytes"},
+                            HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            self.close_connection = True
+            return
+        body = self.rfile.read(length)
+
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            uploads = parse_multipart(body, content_type)
+        else:
+            name = (parse_qs(url.query).get('name') or [self.headers.get('X-Filename') or 'upload'])[0]
+            uploads = [(name, body)]
+        if not uploads:
+            self._send_json({"error": "no files in request"}, HTTPStatus.BAD_REQUEST)
+            return
+
+        start = time.perf_counter()
+        try:
+            result = self.server.service.scan(uploads)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._send_json({"error": "scan worker crashed; retry"}, HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        except concurrent.futures.TimeoutError:
+            self._send_json({"error": "scan timed out"}, HTTPStatus.GATEWAY_TIMEOUT)
+            return
+        self._send_json(result)
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        for record in result["sheets"]:
+            if record["status"] == "ok":
+                student = record.get("student") or {}
+                print(f"✅ {record['source']} -> {student.get('name', '؟')} ({record.get('model_type')}) "
+                      f"[{elapsed_ms:.0f} ms]")
+            else:
+                print(f"❌ {record['source']}: {record['error']}")
+
+    def _send_json(self, payload, status=HTTPStatus.OK):
+        self._send(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # كل ورقة تُطبع سطراً واحداً في do_POST؛ لا حاجة لسجل الطلبات الافتراضي
+        pass
+
+
+def serve(service, host=SERVICE_HOST, port=SERVICE_PORT):
+    """تشغيل الخادم حتى الإيقاف (Ctrl+C أو SIGTERM)؛ المجمع يُهيأ بالكامل قبل فتح المنفذ."""
+    service.start()
+    server = ThreadingHTTPServer((host, port), ScanRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    # shutdown() تنتظر انتهاء حلقة الخادم، لذا تُستدعى من خيط آخر
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    print(f"🌐 خدمة المسح على http://{host}:{server.server_address[1]} ({service.workers} عملية، "
+          f"{service.health()['layouts']} تخطيط) - POST /scan ، GET /health ، GET /metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    print("\n🛑 تم إيقاف خدمة المسح.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="خدمة HTTP محلية لتصحيح أوراق الإجابة بعمليات جاهزة مسبقاً.")
+    parser.add_argument('--host', default=SERVICE_HOST, help="عنوان الاستماع (الافتراضي: الجهاز المحلي فقط).")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help="منفذ الاستماع.")
+    parser.add_argument('-w', '--workers', type=int, default=0, help="عدد عمليات المسح (0 = عدد الأنوية).")
+    parser.add_argument('--bubble-data', help="ملف بيانات الفقاعات كتخطيط احتياطي للأوراق دون QR مقروء.")
+    parser.add_argument('--layout', metavar='LAYOUT_ID', help="معرف تخطيط احتياطي من السجل المشترك.")
+    parser.add_argument('--layout-dir', default=LAYOUT_SEARCH_DIR, help="مجلد سجل تخطيطات الفقاعات.")
+    parser.add_argument('--answer-keys', help="ملف JSON لمفاتيح الإجابة لكل نموذج (تصحيح فوري لكل طلب).")
+    parser.add_argument('--results-db', help="حفظ كل ورقة ممسوحة في مخزن النتائج (SQLite) أيضاً.")
+    parser.add_argument('--full-resolution', action='store_true',
+                        help="قراءة الصور بدقتها الكاملة بدلاً من تصغيرها إلى دقة التخطيط (ذاكرة أكبر).")
+    args = parser.parse_args()
+
+    serve(ScanService(args.workers, args.bubble_data, args.layout, args.layout_dir, args.answer_keys,
+                      args.full_resolution, args.results_db), args.host, args.port)
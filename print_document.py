@@ -0,0 +1,264 @@
+import glob
+import io
+import os
+import zlib
+
+from lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+ImageSequence = lazy_import('PIL.ImageSequence')
+TiffImagePlugin = lazy_import('PIL.TiffImagePlugin')
+
+# --- مستندات الطباعة متعددة الصفحات (Print Documents) ---
+# بدلاً من صورة PNG ملونة لكل صفحة، تُرسم الصفحات بالأبيض والأسود ("1") أو الرمادي ("L")
+# وتُكتب كل صفحة في المستند فور اكتمالها: PDF أو TIFF مضغوط بـ CCITT Group 4 (الضغط القياسي للفاكس والطابعات).
+# لا تبقى في الذاكرة إلا الصفحة الحالية، والمستند يُكتب في ملف مؤقت ولا يظهر باسمه النهائي إلا بعد اكتماله.
+
+PRINT_FORMATS = ('pdf', 'tiff')
+PRINT_DPI = 150
+# ضغط صفحات TIFF حسب نمط الصورة (G4 يدعم الصور ثنائية اللون فقط)
+TIFF_COMPRESSION = {'1': 'group4', 'L': 'tiff_adobe_deflate', 'RGB': 'tiff_adobe_deflate'}
+PDF_COLOR_SPACES = {'1': b'/DeviceGray', 'L': b'/DeviceGray', 'RGB': b'/DeviceRGB'}
+BATCH_PREFIX = 'PrintBatch'
+
+
+def document_format(path):
+    """صيغة المستند من امتداد الملف ('pdf' أو 'tiff')."""
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    fmt = 'tiff' if extension == 'tif' else extension
+    if fmt not in PRINT_FORMATS:
+        raise ValueError(f"صيغة مستند غير مدعومة: {path}")
+    return fmt
+
+
+def _g4_encode(img):
+    """ترميز صفحة ثنائية اللون بـ CCITT Group 4 وإرجاع بيانات الصورة فقط (شريط واحد) لتضمينها في PDF."""
+    buffer = io.BytesIO()
+    img.save(buffer, 'TIFF', compression='group4', strip_size=(img.width + 7) // 8 * img.height)
+    with Image.open(io.BytesIO(buffer.getvalue())) as tiff:
+        offset = tiff.tag_v2[TiffImagePlugin.STRIPOFFSETS][0]
+        length = tiff.tag_v2[TiffImagePlugin.STRIPBYTECOUNTS][0]
+    return buffer.getvalue()[offset:offset + length]
+
+
+class _PdfStreamWriter:
+    """
+    كاتب PDF متدفق: كل صفحة (صورة + محتوى + كائن الصفحة) تُكتب فور إضافتها،
+    وشجرة الصفحات وجدول الإزاحات (xref) في النهاية فقط؛ الزمن خطي مع عدد الصفحات.
+    """
+
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, f, dpi):
+        self.f = f
+        self.dpi = dpi
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = self.PAGES_ID + 1
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write_object(self, object_id, body, stream=None):
+        self.offsets[object_id] = self.f.tell()
+        self.f.write(b"%d 0 obj\n" % object_id + body)
+        if stream is not None:
+            self.f.write(b"\nstream\n" + stream + b"\nendstream")
+        self.f.write(b"\nendobj\n")
+
+    def _allocate(self):
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def add_page(self, img):
+        if img.mode == '1':
+            data = _g4_encode(img)
+            image_filter = (b"/Filter [/CCITTFaxDecode] /DecodeParms [<< /K -1 /BlackIs1 true /Columns %d /Rows %d >>]"
+                            % (img.width, img.height))
+            bits = 1
+        else:
+            data = zlib.compress(img.tobytes())
+            image_filter = b"/Filter /FlateDecode"
+            bits = 8
+
+        image_id, contents_id, page_id = self._allocate(), self._allocate(), self._allocate()
+        self._write_object(image_id, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s "
+                                     b"/BitsPerComponent %d %s /Length %d >>"
+                           % (img.width, img.height, PDF_COLOR_SPACES[img.mode], bits, image_filter, len(data)), data)
+
+        # حجم الصفحة بالنقاط (1/72 إنش) حسب دقة الطباعة
+        width_pt, height_pt = img.width * 72.0 / self.dpi, img.height * 72.0 / self.dpi
+        contents = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (width_pt, height_pt)
+        self._write_object(contents_id, b"<< /Length %d >>" % len(contents), contents)
+        self._write_object(page_id, b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.4f %.4f] "
+                                    b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+                           % (self.PAGES_ID, width_pt, height_pt, image_id, contents_id))
+        self.page_ids.append(page_id)
+
+    def close(self):
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.page_ids)
+        self._write_object(self.PAGES_ID, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_ids)))
+        self._write_object(self.CATALOG_ID, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES_ID)
+
+        xref_offset = self.f.tell()
+        self.f.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_id)
+        for object_id in range(1, self.next_id):
+            self.f.write(b"%010d 00000 n \n" % self.offsets[object_id])
+        self.f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                     % (self.next_id, self.CATALOG_ID, xref_offset))
+
+
+class _TiffStreamWriter:
+    """كاتب TIFF متعدد الصفحات بنفس واجهة _PdfStreamWriter: كل صفحة تُضاف كإطار جديد بضغط يناسب نمطها."""
+
+    def __init__(self, f, dpi):
+        self.dpi = dpi
+        self._writer = TiffImagePlugin.AppendingTiffWriter(f, new=True)
+
+    def add_page(self, img):
+        img.save(self._writer, format='TIFF', compression=TIFF_COMPRESSION[img.mode], dpi=(self.dpi, self.dpi))
+        self._writer.newFrame()
+
+    def close(self):
+        self._writer.close()
+
+
+_DOCUMENT_WRITERS = {'pdf': _PdfStreamWriter, 'tiff': _TiffStreamWriter}
+
+
+def _printable(img):
+    """الصفحة بنمط ألوان يدعمه المستند ("1" أو "L" أو "RGB")."""
+    return img if img.mode in TIFF_COMPRESSION else img.convert('RGB')
+
+
+def document_bytes(pages, fmt, dpi=PRINT_DPI):
+    """مستند طباعة كامل (fmt: 'pdf' أو 'tiff') من صفحات في الذاكرة، يُرجع محتواه (bytes) دون كتابة أي ملف."""
+    if fmt not in PRINT_FORMATS:
+        raise ValueError(f"صيغة مستند غير مدعومة: {fmt}")
+    buffer = io.BytesIO()
+    writer = _DOCUMENT_WRITERS[fmt](buffer, dpi)
+    for page in pages:
+        writer.add_page(_printable(page))
+    writer.close()
+    return buffer.getvalue()
+
+
+class PrintDocument:
+    """
+    مستند طباعة متعدد الصفحات (PDF أو TIFF حسب الامتداد) تُضاف إليه الصفحات واحدة تلو الأخرى.
+    الاستخدام:
+        with PrintDocument(path) as document:
+            document.add_page(img)
+            ...
+            document.finish()
+    إذا خرجت الكتلة دون finish() (فشل أثناء الرسم) يُحذف الملف المؤقت ولا يُترك مستند ناقص.
+    """
+
+    def __init__(self, path, dpi=PRINT_DPI):
+        self.path = path
+        self.format = document_format(path)
+        self.dpi = dpi
+        self.pages = 0
+        self.finished = False
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file = None
+        self._writer = None
+
+    def add_page(self, img):
+        if self._writer is None:
+            # كاتب TIFF يقرأ ما كتبه لتحديث إزاحات الإطارات، لذا يُفتح الملف للقراءة والكتابة
+            self._file = open(self._tmp_path, 'w+b')
+            self._writer = _DOCUMENT_WRITERS[self.format](self._file, self.dpi)
+        self._writer.add_page(_printable(img))
+        self.pages += 1
+
+    def finish(self):
+        """إغلاق المستند ونقله إلى اسمه النهائي. تُرجع المسار (أو None إذا لم تُضف أي صفحة)."""
+        self._close_writer(complete=True)
+        self.finished = True
+        if not self.pages:
+            return None
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self._close_writer(complete=False)
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+    def _close_writer(self, complete):
+        if self._writer is None:
+            return
+        if complete:
+            self._writer.close()
+        self._file.close()
+        self._writer = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self.finished:
+            self.abort()
+
+
+def iter_document_pages(path):
+    """صفحات مستند TIFF واحدة تلو الأخرى (لا تُحمّل كلها في الذاكرة)."""
+    with Image.open(path) as img:
+        for page in ImageSequence.Iterator(img):
+            yield page
+
+
+class PrintBatchWriter:
+    """
+    تجميع مستندات الطلاب (TIFF) بالترتيب في مستندات دفعات طباعة، كل منها students_per_batch طالباً:
+    <BATCH_PREFIX>_001.pdf ، <BATCH_PREFIX>_002.pdf ...  تُحذف مستندات الدفعات القديمة في المجلد عند البدء
+    لأن الدفعات تُبنى من جديد في كل تشغيل (مستندات الطلاب نفسها تبقى لإعادة الطباعة والتوليد التزايدي).
+    """
+
+    def __init__(self, output_dir, fmt, students_per_batch, dpi=PRINT_DPI):
+        self.output_dir = output_dir
+        self.format = fmt
+        self.students_per_batch = students_per_batch
+        self.dpi = dpi
+        self.paths = []
+        self._document = None
+        self._students = 0
+        for stale_path in glob.glob(os.path.join(output_dir, f"{BATCH_PREFIX}_*.{fmt}")):
+            os.remove(stale_path)
+
+    def add_document(self, path):
+        """إلحاق صفحات مستند طالب بدفعة الطباعة الحالية، وإغلاقها عند اكتمال عدد طلابها."""
+        if self._document is None:
+            batch_path = os.path.join(self.output_dir, f"{BATCH_PREFIX}_{len(self.paths) + 1:03d}.{self.format}")
+            self._document = PrintDocument(batch_path, self.dpi)
+        for page in iter_document_pages(path):
+            self._document.add_page(page)
+        self._students += 1
+        if self._students >= self.students_per_batch:
+            self._finish_batch()
+
+    def _finish_batch(self):
+        path = self._document.finish()
+        if path:
+            self.paths.append(path)
+            print(f"🖨️ دفعة طباعة: {path} ({self._students} طالب، {self._document.pages} صفحة)")
+        self._document = None
+        self._students = 0
+
+    def close(self):
+        if self._document is not None:
+            self._finish_batch()
+        return self.paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._document is not None:
+            if exc[0] is None:
+                self._finish_batch()
+            else:
+                self._document.abort()
@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+# --- مخزن نتائج المسح (Results Store) ---
+# قاعدة SQLite واحدة تتراكم فيها نتائج كل الأوراق الممسوحة (بدلاً من ملف JSON يُعاد كتابته لكل تشغيل):
+#   sheets  : صف لكل صفحة ممسوحة (الامتحان، الطالب، النموذج، الصفحة، المصدر، بصمة الصورة، وقت المسح، الحالة)
+#   answers : صف لكل سؤال في الصفحة (الإجابة، الثقة، نسب التظليل، علامات المراجعة)
+# مفتاح الصفحة هو هويتها من رمز QR (الامتحان، الطالب، النموذج، رقم الصفحة)، فإعادة مسح الورقة نفسها تُحدّث صفها
+# (Upsert) ولا تضيف صفاً جديداً؛ الأوراق دون QR مقروء تُعرّف ببصمة SHA-256 لملف الصورة.
+# ملف الإجابات بالبنية المتداخلة (data.users[].exam[].answer) يُبنى من المخزن عند الطلب (export_output_data).
+#   scan_fingerprints : صف لكل ملف صورة رآه المخزن (بصمة SHA-256، البصمة الإدراكية، مفتاح الصفحة، المصدر الأول)؛
+#                       فهرس كشف الأوراق المكررة وإعادة المسح قبل الاستخراج (انظر scan_dedup).
+
+RESULTS_DB_FILE = 'omr_results.db'
+STORE_SCHEMA_VERSION = 2
+
+# أعمدة الهوية بلا نوع معلن حتى تبقى القيم كما في QR (رقم أو نص) ولا تُحوّل عند التخزين
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheets (
+    id INTEGER PRIMARY KEY,
+    sheet_key TEXT NOT NULL UNIQUE,
+    exam_id, subject_id, student_id, student_name TEXT, model_type TEXT,
+    page INTEGER, page_count INTEGER, layout_id TEXT,
+    status TEXT NOT NULL, error TEXT, source TEXT, image_sha256 TEXT,
+    scanned_at TEXT NOT NULL, scan_count INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS sheets_exam ON sheets (exam_id, model_type);
+CREATE INDEX IF NOT EXISTS sheets_student ON sheets (student_id, exam_id);
+CREATE INDEX IF NOT EXISTS sheets_model ON sheets (model_type);
+CREATE INDEX IF NOT EXISTS sheets_image ON sheets (image_sha256);
+CREATE TABLE IF NOT EXISTS answers (
+    sheet_id INTEGER NOT NULL,
+    question_id INTEGER NOT NULL,
+    answer TEXT,
+    confidence REAL,
+    fills TEXT,
+    flags TEXT,
+    PRIMARY KEY (sheet_id, question_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scan_fingerprints (
+    image_sha256 TEXT PRIMARY KEY,
+    sheet_key TEXT NOT NULL,
+    phash TEXT,
+    source TEXT,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    seen_count INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS fingerprints_sheet ON scan_fingerprints (sheet_key);
+"""
+
+# مخزن من الإصدار 1: بصمات ملفات الأوراق المخزنة فيه تُنقل إلى الفهرس (دون بصمة إدراكية)
+_MIGRATE_FINGERPRINTS = """
+INSERT OR IGNORE INTO scan_fingerprints (image_sha256, sheet_key, source, first_seen, last_seen, seen_count)
+SELECT image_sha256, sheet_key, source, scanned_at, scanned_at, scan_count FROM sheets WHERE image_sha256 IS NOT NULL
+"""
+
+_SHEET_COLUMNS = ('sheet_key', 'exam_id', 'subject_id', 'student_id', 'student_name', 'model_type', 'page',
+                  'page_count', 'layout_id', 'status', 'error', 'source', 'image_sha256', 'scanned_at')
+
+
+def sheet_key(record):
+    """مفتاح الصفحة في المخزن: هويتها من QR، أو بصمة ملف الصورة للأوراق دون هوية (أو مساره إذا تعذرت قراءته)."""
+    student = record.get("student") or {}
+    if student.get("id") is not None:
+        identity = [record.get("exam_id"), student.get("id"), record.get("model_type"), record.get("page") or 1]
+        return json.dumps(identity, ensure_ascii=False)
+    if record.get("image_sha256"):
+        return f"sha256:{record['image_sha256']}"
+    return f"source:{record.get('source')}"
+
+
+def scan_fingerprint(record):
+    """صف فهرس البصمات لسجل ورقة: بصمة ملفها، ومفتاح صفحتها، وبصمتها الإدراكية (phash)، ومصدرها."""
+    return {"image_sha256": record.get("image_sha256"), "sheet_key": sheet_key(record),
+            "phash": record.get("phash"), "source": record.get("source")}
+
+
+def scan_timestamp(seconds=None):
+    """وقت المسح بصيغة ISO 8601 (UTC)، قابل للترتيب كنص."""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def build_output_data(records):
+    """
+    بناء ملف الإجابات بالبنية المطلوبة (data.users[].exam[].answer) من سجلات الأوراق الناجحة،
+    بهوية الطالب والنموذج المقروءة من رمز QR لكل ورقة. المرحلة واسم المادة لا يحملهما QR ولا سجل الورقة،
+    فلا يُكتب مفتاحاهما (stage و subject_name) بدلاً من قيم فارغة.
+    """
+    ok_records = [r for r in records if r.get("status") == "ok"]
+    first = ok_records[0] if ok_records else {}
+    model_types = sorted({r.get("model_type") for r in ok_records if r.get("model_type")})
+    total_questions = max((len(r["answers"]) for r in ok_records), default=0)
+
+    users = []
+    for record in ok_records:
+        student = record.get("student") or {}
+        users.append({
+            "id": student.get("id"),
+            "name": student.get("name"),
+            "model_type": record.get("model_type"),
+            "exam": [
+              {
+                "id": record.get("exam_id"),
+                "answer": record["answers"]
+              }
+            ]
+        })
+
+    return {
+      "data": {
+        "subject_id": first.get("subject_id"),
+        "exam_info": { "id": first.get("exam_id") },
+        "n_of_Q": total_questions,
+        "model_type": model_types[0] if len(model_types) == 1 else model_types,
+        "number_of_groups": str(len(model_types)),
+        "number_of_questions": total_questions,
+        "users": users
+      }
+    }
+
+
+class ResultsStore:
+    """
+    مخزن النتائج في ملف SQLite (WAL). الاستخدام:
+        with ResultsStore(path) as store:
+            store.upsert_sheet(record)
+            store.student_sheets(student_id, exam_id)
+    الاتصال يُستخدم من خيط واحد في كل مرة (مرحلة الكتابة في omr_ingest تعمل من خيوط متعاقبة).
+    """
+
+    def __init__(self, path=RESULTS_DB_FILE):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # المخطط يُكتب عند إنشاء المخزن أو ترقيته فقط، فلا يدفع كل فتح معاملة كتابة
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != STORE_SCHEMA_VERSION:
+            with self.conn:
+                self.conn.executescript(_SCHEMA)
+                if 0 < version < 2:
+                    self.conn.execute(_MIGRATE_FINGERPRINTS)
+                self.conn.execute(f"PRAGMA user_version={STORE_SCHEMA_VERSION}")
+
+    # --- الكتابة ---
+
+    def upsert_sheet(self, record, commit=True):
+        """
+        إضافة سجل صفحة ممسوحة (كما يُرجعه scan_sheet) أو تحديثه إذا سبق مسحها، مع استبدال إجاباتها.
+        السجل المدمج لطالب متعدد الصفحات (merge_pages) لا يُخزن، فصفحاته مخزنة كل منها على حدة.
+        تُرجع معرف الصف.
+        """
+        student = record.get("student") or {}
+        key = sheet_key(record)
+        values = {
+            'sheet_key': key,
+            'exam_id': record.get("exam_id"),
+            'subject_id': record.get("subject_id"),
+            'student_id': student.get("id"),
+            'student_name': student.get("name"),
+            'model_type': record.get("model_type"),
+            'page': record.get("page"),
+            'page_count': record.get("page_count"),
+            'layout_id': record.get("layout_id"),
+            'status': record.get("status", "failed"),
+            'error': record.get("error"),
+            'source': record.get("source"),
+            'image_sha256': record.get("image_sha256"),
+            'scanned_at': record.get("scanned_at") or scan_timestamp(),
+        }
+        updates = ', '.join(f"{column} = excluded.{column}" for column in _SHEET_COLUMNS[1:])
+        self.conn.execute(
+            f"INSERT INTO sheets ({', '.join(_SHEET_COLUMNS)}) VALUES ({', '.join('?' * len(_SHEET_COLUMNS))}) "
+            f"ON CONFLICT (sheet_key) DO UPDATE SET {updates}, scan_count = scan_count + 1",
+            [values[column] for column in _SHEET_COLUMNS])
+        sheet_id = self.conn.execute("SELECT id FROM sheets WHERE sheet_key = ?", (key,)).fetchone()[0]
+
+        # نفس ملف الصورة خُزن سابقاً بمفتاح آخر (مثلاً فشل مسحه قبل قراءة QR): النتيجة الجديدة تحل محله
+        if values['image_sha256']:
+            stale = [row[0] for row in self.conn.execute(
+                "SELECT id FROM sheets WHERE image_sha256 = ? AND id != ?", (values['image_sha256'], sheet_id))]
+            self._delete_sheets(stale)
+
+        self.record_fingerprint(record, commit=False)
+        fills = record.get("fills") or []
+        self.conn.execute("DELETE FROM answers WHERE sheet_id = ?", (sheet_id,))
+        self.conn.executemany(
+            "INSERT INTO answers (sheet_id, question_id, answer, confidence, fills, flags) VALUES (?, ?, ?, ?, ?, ?)",
+            [(sheet_id, answer["id"], answer["answer"], answer.get("confidence"),
+              json.dumps(fills[row]) if row < len(fills) else None,
+              ','.join(answer["flags"]) if answer.get("flags") else None)
+             for row, answer in enumerate(record.get("answers", []))])
+        if commit:
+            self.conn.commit()
+        return sheet_id
+
+    def upsert_sheets(self, records):
+        """إضافة/تحديث عدة صفحات في معاملة واحدة."""
+        with self.conn:
+            return [self.upsert_sheet(record, commit=False) for record in records]
+
+    def record_fingerprint(self, record, commit=True):
+        """
+        تسجيل ملف صورة الورقة في فهرس البصمات (upsert_sheet تسجله تلقائياً). الملف المعروف سابقاً يُحدّث وقت
+        آخر رؤية وعدد مراته فقط، فيبقى مصدره الأول. السجل دون بصمة ملف لا يُسجل.
+        """
+        fingerprint = scan_fingerprint(record)
+        if not fingerprint["image_sha256"]:
+            return
+        seen = record.get("scanned_at") or scan_timestamp()
+        self.conn.execute(
+            "INSERT INTO scan_fingerprints (image_sha256, sheet_key, phash, source, first_seen, last_seen) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (image_sha256) DO UPDATE SET sheet_key = excluded.sheet_key, "
+            "phash = COALESCE(excluded.phash, phash), last_seen = excluded.last_seen, seen_count = seen_count + 1",
+            (fingerprint["image_sha256"], fingerprint["sheet_key"], fingerprint["phash"], fingerprint["source"],
+             seen, seen))
+        if commit:
+            self.conn.commit()
+
+    def _delete_sheets(self, sheet_ids):
+        for sheet_id in sheet_ids:
+            self.conn.execute("DELETE FROM answers WHERE sheet_id = ?", (sheet_id,))
+            self.conn.execute("DELETE FROM sheets WHERE id = ?", (sheet_id,))
+
+    def commit(self):
+        self.conn.commit()
+
+    # --- الاستعلام ---
+
+    def sheets(self, exam_id=None, student_id=None, model_type=None, status="ok", with_answers=True):
+        """
+        صفحات المخزن كقواميس (بترتيب أول مسح)، مصفاة حسب الامتحان و/أو الطالب و/أو النموذج والحالة
+        (None = بلا تصفية). مع with_answers تُرفق إجابات كل صفحة في "answers" بصيغة سجلات المسح.
+        """
+        conditions, params = [], []
+        for column, value in (('exam_id', exam_id), ('student_id', student_id), ('model_type', model_type),
+                              ('status', status)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = [dict(row) for row in self.conn.execute(f"SELECT * FROM sheets{where} ORDER BY id", params)]
+        if with_answers:
+            for row in rows:
+                row["answers"] = self._sheet_answers(row["id"])
+        return rows
+
+    def student_sheets(self, student_id, exam_id=None):
+        return self.sheets(exam_id=exam_id, student_id=student_id)
+
+    def exam_sheets(self, exam_id, model_type=None):
+        return self.sheets(exam_id=exam_id, model_type=model_type)
+
+    def _sheet_answers(self, sheet_id):
+        answers = []
+        for row in self.conn.execute("SELECT question_id, answer, confidence, fills, flags FROM answers "
+                                     "WHERE sheet_id = ? ORDER BY question_id", (sheet_id,)):
+            answer = {
+                "id": row["question_id"],
+                "answer": row["answer"],
+                "bubble_id": f"Q{row['question_id']}-{row['answer']}" if row["answer"] != "Unanswered" else None,
+                "confidence": row["confidence"],
+            }
+            if row["flags"]:
+                answer["flags"] = row["flags"].split(',')
+            if row["fills"]:
+                answer["fills"] = json.loads(row["fills"])
+            answers.append(answer)
+        return answers
+
+    def sheet_record(self, key):
+        """
+        الصفحة المخزنة بمفتاحها (sheet_key) كسجل مسح (نفس حقول scan_sheet، دون التسجيل والمراجعة)، أو None.
+        تُستخدم نتيجةً لورقة مكررة تُتخطى دون استخراج.
+        """
+        row = self.conn.execute("SELECT * FROM sheets WHERE sheet_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        answers = self._sheet_answers(row["id"])
+        return {
+            "source": row["source"],
+            "status": row["status"],
+            "scanned_at": row["scanned_at"],
+            "image_sha256": row["image_sha256"],
+            "phash": None,
+            "qr": row["student_id"] is not None,
+            "student": {"id": row["student_id"], "name": row["student_name"]} if row["student_id"] is not None else None,
+            "subject_id": row["subject_id"],
+            "exam_id": row["exam_id"],
+            "model_type": row["model_type"],
+            "layout_id": row["layout_id"],
+            "page": row["page"],
+            "page_count": row["page_count"],
+            "registration": None,
+            "answers": [{k: v for k, v in answer.items() if k != "fills"} for answer in answers],
+            "fills": [answer.get("fills") for answer in answers],
+            "review": [],
+            "error": row["error"],
+            "annotated_image": None,
+        }
+
+    def fingerprints(self, status="ok"):
+        """
+        صفوف فهرس البصمات (image_sha256، sheet_key، phash، source) لملفات صفحاتها المخزنة بالحالة status
+        (None = كلها). الملفات التي فشل مسحها لا تُعد مكررة افتراضياً فتُعاد محاولتها.
+        """
+        query = ("SELECT f.image_sha256, f.sheet_key, f.phash, f.source FROM scan_fingerprints f "
+                 "JOIN sheets s ON s.sheet_key = f.sheet_key")
+        params = ()
+        if status is not None:
+            query += " WHERE s.status = ?"
+            params = (status,)
+        return [dict(row) for row in self.conn.execute(query + " ORDER BY f.first_seen", params)]
+
+    def student_records(self, exam_id=None):
+        """
+        سجل واحد لكل طالب (صفحاته مدمجة وإجاباتها مرتبة حسب رقم السؤال) من الصفحات الناجحة،
+        بترتيب أول مسح لكل طالب. الأوراق دون هوية يبقى كل منها سجلاً مستقلاً.
+        """
+        students = {}
+        for sheet in self.sheets(exam_id=exam_id):
+            if sheet["student_id"] is not None:
+                key = (sheet["exam_id"], sheet["student_id"], sheet["model_type"])
+            else:
+                key = ('sheet', sheet["id"])
+            record = students.get(key)
+            if record is None:
+                record = students[key] = {
+                    "status": "ok",
+                    "student": {"id": sheet["student_id"], "name": sheet["student_name"]}
+                    if sheet["student_id"] is not None else None,
+                    "subject_id": sheet["subject_id"],
+                    "exam_id": sheet["exam_id"],
+                    "model_type": sheet["model_type"],
+                    "sources": [],
+                    "answers": [],
+                }
+            record["sources"].append(sheet["source"])
+            record["answers"].extend({k: v for k, v in answer.items() if k != "fills"} for answer in sheet["answers"])
+        for record in students.values():
+            record["answers"].sort(key=lambda answer: answer["id"])
+        return list(students.values())
+
+    def export_output_data(self, exam_id=None):
+        """ملف الإجابات بالبنية المتداخلة (build_output_data) لكل طلاب المخزن أو لامتحان واحد."""
+        return build_output_data(self.student_records(exam_id))
+
+    def counts(self):
+        row = self.conn.execute("SELECT COUNT(*), COUNT(DISTINCT student_id), COUNT(DISTINCT exam_id), "
+                                "SUM(status = 'ok') FROM sheets").fetchone()
+        images = self.conn.execute("SELECT COUNT(*), SUM(seen_count) FROM scan_fingerprints").fetchone()
+        return {"sheets": row[0], "students": row[1], "exams": row[2], "ok": row[3] or 0,
+                "images": images[0], "images_seen": images[1] or 0}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _parse_id(value):
+    """معرفات QR أرقام عادةً؛ القيمة من سطر الأوامر تُحوّل إلى رقم إذا أمكن لتطابق المخزن."""
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="استعلام مخزن نتائج المسح وتصدير ملف الإجابات منه.")
+    parser.add_argument('db', nargs='?', default=RESULTS_DB_FILE, help="ملف قاعدة النتائج (SQLite).")
+    parser.add_argument('--exam', help="معرف الامتحان.")
+    parser.add_argument('--student', help="معرف الطالب: عرض صفحاته وإجاباتها.")
+    parser.add_argument('--model', help="النموذج.")
+    parser.add_argument('--export', metavar='PATH',
+                        help="تصدير ملف الإجابات بالبنية المتداخلة (data.users[].exam[].answer).")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"❌ خطأ: المخزن غير موجود: {args.db}")
+    else:
+        with ResultsStore(args.db) as store:
+            exam_id = _parse_id(args.exam)
+            if args.export:
+                output_data = store.export_output_data(exam_id)
+                with open(args.export, 'w', encoding='utf-8') as f:
+                    json.dump(output_data, f, ensure_ascii=False, indent=4)
+                print(f"✅ تم تصدير إجابات {len(output_data['data']['users'])} طالب إلى: {args.export}")
+            elif args.student or args.exam or args.model:
+                for sheet in store.sheets(exam_id, _parse_id(args.student), args.model, status=None):
+                    flagged = sum(1 for answer in sheet["answers"] if answer.get("flags"))
+                    print(f"📄 {sheet['student_name']} ({sheet['student_id']}) - {sheet['model_type']} - "
+                          f"صفحة {sheet['page']}/{sheet['page_count']} - {sheet['status']} - {sheet['scanned_at']} "
+                          f"(مسح {sheet['scan_count']} مرة، {len(sheet['answers'])} سؤال، {flagged} للمراجعة) - "
+                          f"{sheet['source']}")
+            else:
+                counts = store.counts()
+                print(f"📋 {counts['sheets']} صفحة ({counts['ok']} ناجحة) لـ {counts['students']} طالب "
+                      f"في {counts['exams']} امتحان، من {counts['images']} ملف صورة "
+                      f"(قُدمت {counts['images_seen']} مرة).")
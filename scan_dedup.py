@@ -0,0 +1,131 @@
+from lazy_import import lazy_import
+from results_store import scan_fingerprint, sheet_key
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# --- كشف الأوراق المكررة وإعادة المسح قبل الاستخراج (Duplicate / Re-scan Detection) ---
+# إعادة تغذية دفعة كاملة أو ملف نُسخ مرتين أو ورقة أُعيد مسحها بعد انحشار الورق كانت تدفع فك الترميز والاستخراج
+# كاملين، ثم تحل نتيجتها محل السابقة في المخزن دون تنبيه. الفحص الآن على مرحلتين رخيصتين:
+#   1. قبل فك الترميز: بصمة SHA-256 لملف الصورة معروفة ← 'duplicate' (نفس البايتات، تُتخطى دائماً).
+#   2. بعد قراءة QR وقبل التسجيل والاستخراج: هوية الصفحة (الامتحان، الطالب، النموذج، الصفحة) ممسوحة سابقاً
+#      ← مقارنة البصمة الإدراكية للصفحة المصغرة (dHash) بصورها السابقة:
+#        قريبة ← 'rescan' (نفس الورقة بمسح آخر): تُتخطى مع السياسة 'skip' أو تحل محل السابقة مع 'replace'؛
+#        بعيدة ← 'changed' (صورة مختلفة بنفس الهوية، مثل مسح مشوه سابق): تُستخرج وتحل محل السابقة وتُبلّغ.
+# البصمة الإدراكية لصفحة كاملة لا ترى علامات القلم (تغيير إجابة لا يغيرها)، ولا تميز أوراق الطلاب المطبوعة
+# من القالب نفسه؛ الهوية تأتي من QR، والبصمة تؤكد فقط أن الصورة الجديدة للصفحة نفسها.
+# الورقة المتخطاة تأخذ نتيجتها المخزنة، فتبقى في ملف الإجابات والتصحيح كما لو استُخرجت.
+# الفهرس دائم في مخزن النتائج (scan_fingerprints)، فإعادة تغذية جلسة كاملة لا تكلف إلا قراءة الملفات وبصمتها.
+
+# dHash: صورة رمادية مصغرة (PHASH_SIZE+1)×PHASH_SIZE، بت لكل بكسلين متجاورين أفقياً (64 بت، 16 خانة ست عشرية)
+PHASH_SIZE = 8
+# تصغير أولي بمعامل صحيح إلى هذا العرض تقريباً (أسرع بكثير من تصغير INTER_AREA مباشرة من دقة المسح إلى 9×8)
+PHASH_PREVIEW_WIDTH = 144
+# أقصى مسافة Hamming (من 64) بين صورتين لنفس الهوية لتُعتبر الثانية إعادة مسح للورقة نفسها.
+# إعادة المسح (دوران حتى 3°، إزاحة، ضغط JPEG) تبعد 2-7 بتات؛ الصفحة البيضاء تبعد أكثر من 20.
+RESCAN_MAX_DISTANCE = 10
+RESCAN_POLICIES = ('skip', 'replace')
+DEFAULT_RESCAN_POLICY = 'skip'
+
+
+def perceptual_hash(gray):
+    """البصمة الإدراكية (dHash) لصورة الصفحة الرمادية كنص ست عشري؛ لا تتأثر بدقة المسح أو ضغط الصورة."""
+    factor = gray.shape[1] // PHASH_PREVIEW_WIDTH
+    if factor > 1:
+        gray = cv2.resize(gray, None, fx=1.0 / factor, fy=1.0 / factor, interpolation=cv2.INTER_AREA)
+    small = cv2.resize(gray, (PHASH_SIZE + 1, PHASH_SIZE), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes().hex()
+
+
+def hash_distance(a, b):
+    """مسافة Hamming بين بصمتين إدراكيتين (عدد البتات المختلفة)."""
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def qr_sheet_key(qr):
+    """مفتاح الصفحة في المخزن (sheet_key) من نتيجة decode_sheet_qr، أو None إذا لم يحمل QR هوية طالب."""
+    if not qr or qr.get('student_id') is None:
+        return None
+    return sheet_key({"student": {"id": qr['student_id']}, "exam_id": qr.get('exam_id'),
+                      "model_type": qr.get('model_type'), "page": qr.get('page', 1)})
+
+
+class DedupIndex:
+    """
+    فهرس بصمات الأوراق المعروفة (من ResultsStore.fingerprints، ثم أوراق التشغيل الحالي عبر add).
+        index.check_file(image_sha256)  قبل فك الترميز
+        index.check_sheet(key, phash)   بعد QR وقبل الاستخراج
+    كلاهما يُرجع قرار التكرار كقاموس {"decision", "match", "distance", "original", "sheet_key", "skipped"} أو None.
+    الفهرس يُرسل كما هو إلى العمليات العاملة (init_scan_worker)، فتفحص الأوراق قبل أي كلفة.
+    """
+
+    def __init__(self, fingerprints=(), policy=DEFAULT_RESCAN_POLICY):
+        if policy not in RESCAN_POLICIES:
+            raise ValueError(f"unknown rescan policy: {policy!r} (expected one of {RESCAN_POLICIES})")
+        self.policy = policy
+        self.files = {}
+        self.sheets = {}
+        for fingerprint in fingerprints:
+            self.add(fingerprint)
+
+    def add(self, fingerprint):
+        """تسجيل ملف صورة معروف (صف فهرس، أو سجل ورقة ناجحة). الملف المسجل سابقاً يبقى بمصدره الأول."""
+        if "sheet_key" not in fingerprint:
+            fingerprint = scan_fingerprint(fingerprint)
+        if not fingerprint["image_sha256"] or fingerprint["image_sha256"] in self.files:
+            return
+        self.files[fingerprint["image_sha256"]] = fingerprint
+        self.sheets.setdefault(fingerprint["sheet_key"], []).append(fingerprint)
+
+    def check_file(self, image_sha256):
+        """ملف الصورة نفسه (نفس البايتات) معروف ← 'duplicate'، يُتخطى أياً كانت السياسة."""
+        known = self.files.get(image_sha256)
+        if known is None:
+            return None
+        return {"decision": "duplicate", "match": "sha256", "distance": 0, "original": known["source"],
+                "sheet_key": known["sheet_key"], "skipped": True}
+
+    def check_sheet(self, key, phash):
+        """
+        صورة جديدة لهوية صفحة معروفة: أقرب صورة سابقة لها ضمن RESCAN_MAX_DISTANCE ← 'rescan'، وإلا 'changed'
+        (وكذلك إذا لم تُحفظ بصمة إدراكية للصور السابقة، كصفحات مخزن الإصدار 1). هوية غير معروفة ← None.
+        """
+        known = self.sheets.get(key)
+        if not known:
+            return None
+        hashed = [fingerprint for fingerprint in known if fingerprint["phash"]]
+        nearest, distance = known[-1], None
+        if hashed and phash:
+            distance, nearest = min(((hash_distance(f["phash"], phash), f) for f in hashed), key=lambda d: d[0])
+        decision = 'rescan' if distance is not None and distance <= RESCAN_MAX_DISTANCE else 'changed'
+        return {"decision": decision, "match": "phash", "distance": distance, "original": nearest["source"],
+                "sheet_key": key, "skipped": decision == 'rescan' and self.policy == 'skip'}
+
+    def __len__(self):
+        return len(self.files)
+
+
+def settle_scan(record, index, store):
+    """
+    القرار النهائي لورقة في العملية الرئيسية (العمليات العاملة ترى الفهرس كما كان عند بدء التشغيل فقط):
+    الورقة الناجحة تُفحص مجدداً مقابل أوراق هذا التشغيل، والمتخطاة تأخذ نتيجتها المخزنة (بمصدرها وقرارها).
+    تُرجع (السجل، fresh): fresh يعني نتيجة جديدة تُخزن بـ upsert_sheet، وإلا تُسجل بصمة ملفها فقط
+    (record_fingerprint). إذا لم تعد نتيجة الورقة الأصلية في المخزن تُسجل المتخطاة فاشلة فتُعاد لاحقاً.
+    المستدعي يضيف الورقة الناجحة إلى الفهرس (index.add) بعد تخزينها، بمصدرها النهائي.
+    """
+    if record["status"] == "ok":
+        decision = index.check_file(record["image_sha256"])
+        if decision is None and record.get("qr"):
+            decision = index.check_sheet(sheet_key(record), record.get("phash"))
+        record["dedup"] = decision
+    decision = record.get("dedup")
+    if not decision or not decision["skipped"]:
+        return record, True
+
+    stored = store.sheet_record(decision["sheet_key"])
+    if stored is None or stored["status"] != "ok":
+        record["status"] = "failed"
+        record["error"] = f"{decision['decision']} of {decision['original']}, but its stored result is missing"
+        return record, True
+    return {**stored, "source": record["source"], "scanned_at": record["scanned_at"],
+            "image_sha256": record["image_sha256"], "phash": record.get("phash"), "dedup": decision}, False
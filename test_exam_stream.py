@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+from exam_stream import ExamStream
+
+QUESTIONS = [{"id": 1, "question_text": {"text": "س؟", "files": []}, "options": []}]
+META = {"stage": "stage 1", "subject_name": "حاسوب", "subject_id": 1, "model_type": "Group A"}
+
+
+def write_exam(tmp_path, data):
+    path = tmp_path / "exam.json"
+    path.write_text(json.dumps({"data": data}, ensure_ascii=False), encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 16])
+def test_models_after_users_are_resolved(tmp_path, chunk_size):
+    path = write_exam(tmp_path, {**META, "users": [{"id": 1, "name": "أ", "exam_ref": "Group A"},
+                                                   {"id": 2, "name": "ب", "model_type": "Group A"}],
+                                 "models": {"Group A": QUESTIONS}})
+    stream = ExamStream(path, chunk_size=chunk_size)
+    users = list(stream)
+    assert list(stream.models) == ["Group A"]
+    assert [user["exam"] for user in users] == [QUESTIONS, QUESTIONS]
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 16])
+def test_original_format_streams_embedded_exams(tmp_path, chunk_size):
+    path = write_exam(tmp_path, {**META, "users": [{"id": 1, "name": "أ", "exam": QUESTIONS},
+                                                   {"id": 2, "name": "ب", "exam": QUESTIONS}]})
+    stream = ExamStream(path, chunk_size=chunk_size)
+    assert [user["id"] for user in stream] == [1, 2]
+    assert stream.models == {} and stream.meta == META
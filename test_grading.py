@@ -0,0 +1,38 @@
+from grading import grade_records
+from omr_scanner import merge_pages
+
+# مفتاح 100 سؤال على صفحتين (60 + 40)، وسجل مدمج لم تُمسح منه إلا الصفحة الأولى
+NUM_QUESTIONS = 100
+FIRST_PAGE_QUESTIONS = 60
+KEY = ['ABCD'[i % 4] for i in range(NUM_QUESTIONS)]
+
+
+def page_record(page, question_ids):
+    return {
+        "status": "ok", "source": f"page{page}.png", "page": page, "page_count": 2,
+        "student": {"id": 1, "name": "طالب"}, "model_type": "Group A",
+        "layout_id": f"q{NUM_QUESTIONS}_p{page}", "registration": {},
+        "answers": [{"id": q, "answer": KEY[q - 1]} for q in question_ids],
+    }
+
+
+def test_merged_record_with_missing_page_grades_missing_questions_as_unanswered():
+    record = merge_pages([page_record(1, range(1, FIRST_PAGE_QUESTIONS + 1))])
+    assert record["missing_pages"] == [2]
+
+    report = grade_records([record], {"Group A": KEY})
+    student = report["students"][0]
+    assert student["score"] == FIRST_PAGE_QUESTIONS
+    assert student["max_score"] == NUM_QUESTIONS
+    assert student["unanswered"] == NUM_QUESTIONS - FIRST_PAGE_QUESTIONS
+    assert student["percent"] == 60.0
+    assert len(report["question_correct_rate"]) == NUM_QUESTIONS
+
+
+def test_complete_merged_record_grades_every_page():
+    record = merge_pages([page_record(2, range(FIRST_PAGE_QUESTIONS + 1, NUM_QUESTIONS + 1)),
+                          page_record(1, range(1, FIRST_PAGE_QUESTIONS + 1))])
+    assert record["missing_pages"] == []
+
+    student = grade_records([record], {"Group A": KEY})["students"][0]
+    assert (student["score"], student["max_score"], student["unanswered"]) == (NUM_QUESTIONS, NUM_QUESTIONS, 0)
@@ -0,0 +1,62 @@
+import os
+import random
+
+import cv2
+import numpy as np
+import pytest
+
+import generate_exams
+from omr_scanner import scan_image
+
+NUM_QUESTIONS = 20
+EXAM_INFO = {'stage': 'stage 1', 'subject_name': 'حاسوب', 'subject_id': 1, 'model_type': 'Group A', 'exam_id': 1}
+
+
+@pytest.fixture(scope='module')
+def filled_sheet():
+    """ورقة إجابة طالب واحد مرسومة في الذاكرة ومظللة (رمادية)، مع تخطيطاتها والإجابات المظللة."""
+    previous_font_path = generate_exams.FONT_PATH
+    generate_exams.FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), previous_font_path)
+    try:
+        exam = [{"id": q, "question_text": {"text": f"السؤال {q}؟", "files": []}, "question_type": "options",
+                 "options": [{"text": f"خيار {o}", "files": []} for o in range(4)]} for q in range(1, NUM_QUESTIONS + 1)]
+        user = {"id": 17, "name": "طالب", "model_type": "Group A", "exam": exam}
+        pages = generate_exams.render_student_pages(EXAM_INFO, user)
+    finally:
+        generate_exams.FONT_PATH = previous_font_path
+
+    sheet = np.asarray(pages['answer_pages'][0].convert('L')).copy()
+    layout = next(iter(pages['layouts'].values()))
+    rng = random.Random(0)
+    expected = {}
+    for q_num, boxes in zip(layout['question_nums'].tolist(), layout['bboxes']):
+        option = rng.randrange(5)
+        if option == 4:
+            expected[q_num] = "Unanswered"
+            continue
+        x0, y0, x1, y1 = (int(v) for v in boxes[option])
+        cv2.circle(sheet, ((x0 + x1) // 2, (y0 + y1) // 2), (x1 - x0) // 2 - 4, 40, -1)
+        expected[q_num] = "ABCD"[option]
+    return sheet, pages['layouts'], expected
+
+
+def simulate_scan(sheet, angle, shift, scale):
+    """هامش أبيض ثم دوران حول المركز وإزاحة وتغيير دقة، كما يفعل الماسح الضوئي بالورقة."""
+    img = cv2.copyMakeBorder(sheet, 40, 40, 40, 40, cv2.BORDER_CONSTANT, value=255)
+    h, w = img.shape
+    out_w, out_h = int(w * scale), int(h * scale)
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, scale)
+    matrix[:, 2] += ((out_w - w) / 2 + shift[0], (out_h - h) / 2 + shift[1])
+    return cv2.warpAffine(img, matrix, (out_w, out_h), flags=cv2.INTER_LINEAR, borderValue=255)
+
+
+@pytest.mark.parametrize("angle, shift, scale", [(0.0, (0, 0), 1.0), (2.5, (25, -15), 1.0), (-3.0, (-20, 30), 1.0),
+                                                 (1.5, (10, 10), 1.25), (-1.0, (0, 20), 0.8)])
+def test_warped_sheet_registers_onto_its_layout(filled_sheet, angle, shift, scale):
+    sheet, layouts, expected = filled_sheet
+    record = scan_image(simulate_scan(sheet, angle, shift, scale), layouts=layouts)
+
+    assert record["status"] == "ok", record["error"]
+    assert record["registration"]["method"] == 'homography'
+    assert record["student"]["id"] == 17
+    assert {a["id"]: a["answer"] for a in record["answers"]} == expected
@@ -0,0 +1,105 @@
+import sqlite3
+
+import pytest
+
+from results_store import _SCHEMA, STORE_SCHEMA_VERSION, ResultsStore, sheet_key
+from scan_dedup import RESCAN_MAX_DISTANCE, DedupIndex, settle_scan
+
+BASE_HASH = '0' * 16
+
+
+def phash_at(distance):
+    """بصمة إدراكية تبعد distance بتاً عن BASE_HASH."""
+    return format((1 << distance) - 1, '016x')
+
+
+def scan_record(source, image_sha256, phash=BASE_HASH, student_id=7):
+    return {
+        "source": source, "status": "ok", "scanned_at": "2026-01-01T00:00:00Z", "error": None,
+        "image_sha256": image_sha256, "phash": phash, "dedup": None, "qr": True,
+        "student": {"id": student_id, "name": "طالب"}, "subject_id": 1, "exam_id": 1,
+        "model_type": "Group A", "layout_id": "q3", "page": 1, "page_count": 1,
+        "answers": [{"id": q, "answer": "A", "confidence": 1.0} for q in (1, 2, 3)],
+    }
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        DedupIndex(policy='merge')
+
+
+@pytest.mark.parametrize("policy", ['skip', 'replace'])
+def test_same_file_is_a_skipped_duplicate_under_any_policy(policy):
+    index = DedupIndex([scan_record("a.png", "sha-a")], policy)
+    assert index.check_file("sha-unknown") is None
+    decision = index.check_file("sha-a")
+    assert decision["decision"] == 'duplicate' and decision["skipped"] is True
+    assert decision["original"] == "a.png"
+
+
+@pytest.mark.parametrize("policy, skipped", [('skip', True), ('replace', False)])
+def test_rescan_within_max_distance_follows_policy(policy, skipped):
+    original = scan_record("a.png", "sha-a")
+    index = DedupIndex([original], policy)
+    decision = index.check_sheet(sheet_key(original), phash_at(RESCAN_MAX_DISTANCE))
+    assert decision["decision"] == 'rescan'
+    assert decision["distance"] == RESCAN_MAX_DISTANCE
+    assert decision["skipped"] is skipped
+
+
+def test_sheet_beyond_max_distance_is_changed_and_extracted():
+    original = scan_record("a.png", "sha-a")
+    decision = DedupIndex([original]).check_sheet(sheet_key(original), phash_at(RESCAN_MAX_DISTANCE + 1))
+    assert decision["decision"] == 'changed' and decision["skipped"] is False
+
+
+def test_unknown_sheet_or_missing_phash():
+    original = scan_record("a.png", "sha-a", phash=None)
+    index = DedupIndex([original])
+    assert index.check_sheet(sheet_key(scan_record("b.png", "sha-b", student_id=8)), BASE_HASH) is None
+    # صور سابقة دون بصمة إدراكية (مخزن الإصدار 1) لا تُعد إعادة مسح
+    decision = index.check_sheet(sheet_key(original), BASE_HASH)
+    assert decision["decision"] == 'changed' and decision["distance"] is None
+
+
+def test_settle_scan_reuses_stored_result_of_a_rescan(tmp_path):
+    with ResultsStore(str(tmp_path / "r.db")) as store:
+        original = scan_record("a.png", "sha-a")
+        store.upsert_sheet(original)
+        index = DedupIndex(store.fingerprints())
+
+        record, fresh = settle_scan(scan_record("b.png", "sha-b", phash_at(2)), index, store)
+        assert fresh is False
+        assert record["source"] == "b.png" and record["image_sha256"] == "sha-b"
+        assert record["dedup"]["decision"] == 'rescan'
+        assert [a["answer"] for a in record["answers"]] == ["A", "A", "A"]
+
+
+def test_settle_scan_fails_a_skipped_sheet_whose_stored_result_is_missing(tmp_path):
+    with ResultsStore(str(tmp_path / "r.db")) as store:
+        # الفهرس يعرف الورقة لكن نتيجتها لم تعد في المخزن
+        index = DedupIndex([scan_record("a.png", "sha-a")])
+        record, fresh = settle_scan(scan_record("b.png", "sha-b", phash_at(2)), index, store)
+        assert fresh is True
+        assert record["status"] == "failed"
+        assert "stored result is missing" in record["error"]
+
+
+def test_version_1_store_migrates_fingerprints(tmp_path):
+    path = str(tmp_path / "v1.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(_SCHEMA)
+    conn.execute("DROP TABLE scan_fingerprints")
+    conn.execute("INSERT INTO sheets (sheet_key, exam_id, student_id, model_type, page, status, source, image_sha256, "
+                 "scanned_at, scan_count) VALUES (?, 1, 7, 'Group A', 1, 'ok', 'a.png', 'sha-a', "
+                 "'2026-01-01T00:00:00Z', 2)", (sheet_key(scan_record("a.png", "sha-a")),))
+    conn.execute("PRAGMA user_version=1")
+    conn.commit()
+    conn.close()
+
+    with ResultsStore(path) as store:
+        assert store.conn.execute("PRAGMA user_version").fetchone()[0] == STORE_SCHEMA_VERSION
+        assert store.fingerprints() == [{"image_sha256": "sha-a", "sheet_key": sheet_key(scan_record("a.png", "sha-a")),
+                                         "phash": None, "source": "a.png"}]
+        assert store.counts()["images_seen"] == 2
+        assert DedupIndex(store.fingerprints()).check_file("sha-a")["decision"] == 'duplicate'
@@ -0,0 +1,84 @@
+import functools
+import unicodedata
+
+import instrumentation
+from lazy_import import lazy_import
+
+arabic_reshaper = lazy_import('arabic_reshaper')
+bidi_algorithm = lazy_import('bidi.algorithm')
+
+# --- محرك تخطيط النصوص (Text Layout) ---
+# النص يُقسم إلى أسطر حسب العرض الحقيقي بالبكسل قبل خطوة bidi (على الترتيب المنطقي للكلمات)،
+# ثم يُعكس كل سطر على حدة. بهذا يبقى ترتيب الأسطر صحيحاً للفقرات العربية الطويلة،
+# ويُقاس كل حرف مرة واحدة فقط لكل خط (عرض الكلمة = مجموع عروض حروفها بعد التشكيل).
+
+GLYPH_CACHE_SIZE = 8192
+PARAGRAPH_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=GLYPH_CACHE_SIZE)
+def glyph_advance(font, char):
+    """عرض التقدم (Advance) لحرف واحد بعد التشكيل بخط معين."""
+    return font.getlength(char)
+
+
+def text_advance(font, text):
+    """عرض النص بالبكسل كمجموع عروض حروفه المحفوظة مؤقتاً (مطابق لـ font.getlength في التخطيط الأساسي)."""
+    return sum(glyph_advance(font, char) for char in text)
+
+
+def paragraph_direction(text):
+    """اتجاه الفقرة حسب أول حرف قوي الاتجاه ('R' أو 'L')، والافتراضي من اليمين لليسار."""
+    for char in text:
+        direction = unicodedata.bidirectional(char)
+        if direction in ('R', 'AL'):
+            return 'R'
+        if direction == 'L':
+            return 'L'
+    return 'R'
+
+
+@functools.lru_cache(maxsize=PARAGRAPH_CACHE_SIZE)
+def wrap_paragraph(text, font, max_width):
+    """
+    تقسيم فقرة إلى أسطر لا يتجاوز عرض أي منها max_width بكسل (الكلمة الأطول من السطر تبقى وحدها).
+    تُرجع الأسطر جاهزة للرسم (بعد توصيل الأحرف و bidi) بترتيبها من الأعلى إلى الأسفل.
+    """
+    if not text:
+        return ()
+    with instrumentation.timer('gen.text_wrap'):
+        return _wrap_paragraph(text, font, max_width)
+
+
+def _wrap_paragraph(text, font, max_width):
+    base_dir = paragraph_direction(text)
+    space_width = glyph_advance(font, ' ')
+
+    lines = []
+    current = []
+    current_width = 0.0
+    for word in arabic_reshaper.reshape(text).split():
+        word_width = text_advance(font, word)
+        if current and current_width + space_width + word_width > max_width:
+            lines.append(' '.join(current))
+            current = [word]
+            current_width = word_width
+        else:
+            current_width = word_width if not current else current_width + space_width + word_width
+            current.append(word)
+    if current:
+        lines.append(' '.join(current))
+
+    return tuple(bidi_algorithm.get_display(line, base_dir=base_dir) for line in lines)
+
+
+def layout_cache_stats():
+    return {
+        'glyph_advances': glyph_advance.cache_info()._asdict(),
+        'wrapped_paragraphs': wrap_paragraph.cache_info()._asdict(),
+    }
+
+
+def clear_layout_caches():
+    glyph_advance.cache_clear()
+    wrap_paragraph.cache_clear()
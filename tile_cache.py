@@ -0,0 +1,75 @@
+import collections
+
+# --- ذاكرة مربعات الأسئلة المرسومة مسبقاً (Question Tile Cache) ---
+# نص السؤال وخياراته لا يتغير بين طلاب النموذج الواحد، لذلك يُرسم كل سؤال مرة واحدة كقناع (Mask)
+# ويُلصق بعدها في صفحات جميع الطلاب. الحد الأقصى للذاكرة بالبايت وليس بعدد العناصر
+# لأن حجم المربع يختلف كثيراً بين سؤال قصير وفقرة طويلة؛ عند تجاوزه يُحذف الأقدم استخداماً (LRU).
+
+DEFAULT_TILE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def tile_size_bytes(tile):
+    """حجم المربع في الذاكرة بالبايت تقريباً (صورة Pillow أو None للسؤال الفارغ)."""
+    if tile is None:
+        return 0
+    return tile.width * tile.height * len(tile.getbands())
+
+
+class TileCache:
+    """
+    ذاكرة LRU محدودة بالبايت: القيم صفوف أولها صورة المربع (أو None)، ومفاتيحها بصمة المحتوى.
+    المربع الأكبر من الحد كله لا يُحفظ (يُرسم ويُستخدم ثم يُهمل).
+    """
+
+    def __init__(self, max_bytes=DEFAULT_TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        size = tile_size_bytes(value[0])
+        if size > self.max_bytes:
+            return value
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[0]
+        self._entries[key] = (size, value)
+        self.bytes += size
+        self._evict()
+        return value
+
+    def resize(self, max_bytes):
+        """تغيير الحد الأقصى (مع حذف الأقدم استخداماً إذا صار الحجم الحالي أكبر منه)."""
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            _, (evicted_size, _) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cache_info(self):
+        """إحصائيات بنفس مفاتيح functools.lru_cache إضافة إلى الحجم بالبايت وعدد المحذوفات."""
+        return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.max_bytes, 'currsize': len(self._entries),
+                'bytes': self.bytes, 'evictions': self.evictions}